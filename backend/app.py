@@ -4,19 +4,17 @@ import json
 import threading
 import uuid
 from datetime import datetime
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
-from flask_jwt_extended import JWTManager
+from flask_jwt_extended import JWTManager, jwt_required, get_jwt_identity, verify_jwt_in_request
 from flask_bcrypt import Bcrypt
 from flask_cors import CORS
-import subprocess
-import re
 import hashlib
-import zipfile
-import tempfile
-import shutil
+import base64
+import time
+from urllib.parse import urlsplit, urlunsplit, quote
+from werkzeug.utils import send_file as werkzeug_send_file
 from dotenv import load_dotenv
-import openai
 
 # Carica variabili ambiente
 load_dotenv()
@@ -31,682 +29,1328 @@ CORS(app, origins=[
 ])
 
 # Configurazione Database e JWT
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///maat_database.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///maat_database.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['JWT_SECRET_KEY'] = 'maat-secret-key-change-in-production'
 
 # Inizializza estensioni
-from models import db
+from models import db, JobHistory
 db.init_app(app)
 jwt = JWTManager(app)
 bcrypt = Bcrypt(app)
 
-# Configura OpenAI
-openai.api_key = os.getenv('OPENAI_API_KEY')
+# Token RS256: firma locale (deployment unico) o verifica con il JWKS del servizio auth (JWT_JWKS_URL)
+from jwt_keys import configure_jwt
+jwt_role = configure_jwt(app, jwt)
 
 # Importa blueprint autenticazione
 from auth import auth_bp
 
-# Registra blueprint
-app.register_blueprint(auth_bp, url_prefix='/api/auth')
+# Moduli di estrazione
+from task_control import TaskControl, TaskCancelled
+from extractor import TimestampClipExtractor, SOCIAL_FORMAT_PROFILES, SUBTITLE_MODES, PREVIEW_ENABLED, OPENAI_API_KEY
+from task_store import TaskStore, INCOMPLETE_STATUSES
+from job_queue import JobQueue
+from tracing import Tracer, trace_span
+from structured_log import get_logger, log_context, log_stats
+from lanes import LaneScheduler, PRIORITY_CLASSES, LANE_NICE, LANE_QUEUE_PRIORITY, classify_job
+from webhooks import WebhookDispatcher, validate_callback_url, PUBLIC_BASE_URL
+from batches import BatchStore, BATCH_MAX_VIDEOS, merge_batch_entries, split_video_job, batch_progress, video_folder_name, build_batch_package, start_batch_package
+
+logger = get_logger('app')
+
+# Registra blueprint (con servizio auth separato login e registrazione sono serviti da lì)
+if jwt_role == 'issuer':
+    app.register_blueprint(auth_bp, url_prefix='/api/auth')
 
 # Global storage per task progress (in produzione usare Redis)
 task_progress = {}
 task_results = {}
+task_clips = {}  # task_id -> {clip_index: clip} pubblicate mentre il task è in corso
+
+# Single-flight: job con spec identica in corso condividono lo stesso task
+inflight_jobs = {}  # job_key -> task_id
+inflight_lock = threading.Lock()
+
+# Controllo task attivi (cancellazione, processi figli, ultimo poll)
+task_controls = {}
+
+# Annulla automaticamente i task non interrogati da N secondi (0 = disattivato)
+TASK_ABANDON_TIMEOUT = int(os.getenv('TASK_ABANDON_TIMEOUT', '900'))
+
+# Slot di esecuzione dei task (modalità thread), una parte riservata ai job interattivi
+lane_scheduler = LaneScheduler(
+    int(os.getenv('EXTRACTION_SLOTS', '4')),
+    int(os.getenv('INTERACTIVE_RESERVED_SLOTS', '1'))
+)
+
+# Ammissione: rifiuta nuovi job se il lavoro stimato in corso supera N secondi (0 = disattivata)
+ADMISSION_MAX_BACKLOG_SECONDS = float(os.getenv('ADMISSION_MAX_BACKLOG_SECONDS', '0'))
+
+# Storico job: dimensione massima di una pagina
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+FINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+# Elenco clip di un task: dimensione massima di una pagina
+CLIPS_PAGE_SIZE = 50
+CLIPS_MAX_PAGE_SIZE = 200
+
+# Cache HTTP delle anteprime (segmenti e playlist VOD non cambiano più)
+PREVIEW_CACHE_SECONDS = int(os.getenv('PREVIEW_CACHE_SECONDS', '86400'))
+PREVIEW_MIMETYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t',
+    '.jpg': 'image/jpeg'
+}
 
 # Directory per file temporanei
-TEMP_DIR = "temp_clips"
+TEMP_DIR = os.getenv('TEMP_DIR', 'temp_clips')  # stessa variabile di worker.py (--temp-dir)
 os.makedirs(TEMP_DIR, exist_ok=True)
 
-class TimestampClipExtractor:
-    """Classe principale per estrazione clip"""
-    
-    def __init__(self, temp_dir):
-        self.temp_dir = temp_dir
-        self.setup_extractor()
-    
-    def setup_extractor(self):
-        """Setup iniziale"""
-        print("🔧 Setup Timestamp Clip Extractor...")
-        
-        # Verifica yt-dlp
-        result = subprocess.run("yt-dlp --version", shell=True, capture_output=True, text=True)
-        if result.returncode != 0:
-            print("📦 Installando yt-dlp...")
-            subprocess.run("pip install yt-dlp --upgrade --quiet", shell=True)
-        
-        # Verifica OpenAI API key
-        if not openai.api_key:
-            print("⚠️ ATTENZIONE: OPENAI_API_KEY non configurata - sottotitoli disabilitati")
-        else:
-            print("✅ OpenAI API key configurata")
-        
-        print("✅ Setup completato!")
+# Download serviti dal reverse proxy: l'app autorizza e risponde solo con un header.
+#   'none'       -> send_file (gunicorn usa sendfile() verso il socket, con supporto Range)
+#   'x-accel'    -> nginx: X-Accel-Redirect verso una location interna, es.
+#                     location /protected-files/ { internal; alias /app/temp_clips/; }
+#   'x-sendfile' -> Apache mod_xsendfile / lighttpd: X-Sendfile con il percorso assoluto
+FILE_OFFLOAD = os.getenv('FILE_OFFLOAD', 'none')
+FILE_OFFLOAD_ROOT = os.path.abspath(os.getenv('FILE_OFFLOAD_ROOT', TEMP_DIR))
+FILE_OFFLOAD_PREFIX = '/' + os.getenv('FILE_OFFLOAD_PREFIX', '/protected-files/').strip('/') + '/'
 
-    def generate_subtitles(self, video_file):
-        """Genera sottotitoli usando OpenAI Whisper API"""
-        try:
-            if not openai.api_key:
-                print("  ⚠️ API key OpenAI mancante - saltando sottotitoli")
-                return None
-                
-            print(f"  📝 Generando sottotitoli con OpenAI per {os.path.basename(video_file)}...")
-            
-            # Controlla dimensione file (limite OpenAI: 25MB)
-            file_size = os.path.getsize(video_file)
-            if file_size > 25 * 1024 * 1024:  # 25MB
-                print(f"  ⚠️ File troppo grande ({file_size/1024/1024:.1f}MB) - saltando sottotitoli")
-                return None
-            
-            # Chiamata API OpenAI Whisper
-            with open(video_file, 'rb') as audio_file:
-                response = openai.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file,
-                    response_format="srt"
-                )
-            
-            # Salva file SRT
-            srt_file = video_file.replace('.mp4', '.srt')
-            with open(srt_file, 'w', encoding='utf-8') as f:
-                f.write(response)
-            
-            print(f"    ✅ Sottotitoli salvati: {os.path.basename(srt_file)}")
-            return srt_file
-            
-        except openai.APIError as e:
-            print(f"    ❌ Errore API OpenAI: {e}")
-            return None
-        except Exception as e:
-            print(f"    ❌ Errore generazione sottotitoli: {e}")
-            return None
-
-    def seconds_to_srt_time(self, seconds):
-        """Converte secondi in formato SRT (HH:MM:SS,mmm)"""
-        hours = int(seconds // 3600)
-        minutes = int((seconds % 3600) // 60)
-        secs = int(seconds % 60)
-        millis = int((seconds % 1) * 1000)
-        return f"{hours:02d}:{minutes:02d}:{secs:02d},{millis:03d}"
-    
-    def parse_timestamp(self, timestamp_str):
-        """Converte timestamp in secondi"""
-        timestamp_str = timestamp_str.strip()
-        
-        if timestamp_str.isdigit():
-            return int(timestamp_str)
-        
-        parts = timestamp_str.split(':')
-        
-        if len(parts) == 2:  # MM:SS
-            minutes, seconds = map(int, parts)
-            return minutes * 60 + seconds
-        elif len(parts) == 3:  # HH:MM:SS
-            hours, minutes, seconds = map(int, parts)
-            return hours * 3600 + minutes * 60 + seconds
-        else:
-            raise ValueError(f"Formato timestamp non valido: {timestamp_str}")
-    
-    def parse_timestamps_input(self, timestamps_text):
-        """Estrae timestamp da testo formattato o formato semplice"""
-        print("📋 Parsing timestamp...")
-        
-        # Controlla se è formato "Stream Time Marker"
-        if "Stream Time Marker" in timestamps_text:
-            pattern = r'(\d+:\d+:\d+)\s+Stream Time Marker\s*-?\s*(.*)'
-            matches = re.findall(pattern, timestamps_text, re.MULTILINE)
-            
-            if not matches:
-                print("⚠️ Nessun timestamp 'Stream Time Marker' trovato")
-                return []
-            
-            timestamps = []
-            for match in matches:
-                try:
-                    seconds = self.parse_timestamp(match[0])
-                    timestamps.append({
-                        'original': match[0],
-                        'seconds': seconds,
-                        'description': match[1].strip() if match[1].strip() else f"Evento al {match[0]}"
-                    })
-                except ValueError as e:
-                    print(f"⚠️ Errore timestamp {match[0]}: {e}")
-            
-            print(f"✅ Trovati {len(timestamps)} timestamp validi")
-            return timestamps
-        
-        # Formato semplice: "0:01-0:03,0:05-0:07" 
-        else:
-            timestamps = []
-            ranges = timestamps_text.split(',')
-            
-            for i, range_str in enumerate(ranges):
-                range_str = range_str.strip()
-                if '-' in range_str:
-                    start_str, end_str = range_str.split('-', 1)
-                    try:
-                        start_seconds = self.parse_timestamp(start_str.strip())
-                        end_seconds = self.parse_timestamp(end_str.strip())
-                        # Usa il momento centrale del range
-                        timestamp_seconds = (start_seconds + end_seconds) // 2
-                        timestamps.append({
-                            'original': range_str,
-                            'seconds': timestamp_seconds,
-                            'description': f"Clip {i+1}"
-                        })
-                    except ValueError as e:
-                        print(f"⚠️ Errore range {range_str}: {e}")
-            
-            print(f"✅ Trovati {len(timestamps)} timestamp validi")
-            return timestamps
-    
-    def download_clip_from_timestamp(self, video_url, timestamp_seconds, clip_duration=60, url_hash="", clip_index=0, social_formats=None, subtitles_enabled=False):
-        """Scarica clip da timestamp specifico"""
-        
-        start_time = max(0, timestamp_seconds - clip_duration)
-        
-        timestamp_min = timestamp_seconds // 60
-        timestamp_sec = timestamp_seconds % 60
-        
-        # File base (originale)
-        base_output_file = os.path.join(
-            self.temp_dir, 
-            f"temp_base_{url_hash}_{clip_index+1}_{timestamp_min:02d}m{timestamp_sec:02d}s.mp4"
-        )
-        
-        # Comando per scaricare clip base
-        cmd = [
-            'yt-dlp',
-            '--no-check-certificates',
-            '-f', 'best[height<=720]',  # Ottimizzato per trial
-            '--external-downloader', 'ffmpeg',
-            '--external-downloader-args', f'ffmpeg:-ss {start_time} -t {clip_duration}',
-            '-o', base_output_file,
-            video_url
-        ]        
-        
-        try:
-            # Scarica clip base
-            print(f"  ⬇️ Scaricando clip base...")
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=1800)
-            
-            if result.returncode != 0 or not os.path.exists(base_output_file):
-                print(f"  ❌ Errore download clip base")
-                print(f"  Error: {result.stderr}")
-                return {
-                    'success': False,
-                    'timestamp': timestamp_seconds,
-                    'error': result.stderr
-                }
-            
-            # Genera sottotitoli se richiesti
-            srt_file = None
-            if subtitles_enabled:
-                print(f"  📝 Generando sottotitoli...")
-                srt_file = self.generate_subtitles(base_output_file)
-                if srt_file:
-                    print(f"    ✅ Sottotitoli generati")
-                else:
-                    print(f"    ⚠️ Sottotitoli non disponibili")
-            
-            # Genera formati social
-            social_files = []
-            total_size = 0
-            
-            if social_formats is None:
-                social_formats = {'youtube': True}  # Default
-            
-            # TikTok - 9:16 verticale
-            if social_formats.get('tiktok', False):
-                tiktok_file = os.path.join(
-                    self.temp_dir,
-                    f"tiktok_{url_hash}_{clip_index+1}_{timestamp_min:02d}m{timestamp_sec:02d}s.mp4"
-                )
-                
-                # Comando TikTok ottimizzato
-                if srt_file and os.path.exists(srt_file):
-                    # Con sottotitoli stilizzati
-                    tiktok_cmd = [
-                        'ffmpeg', '-i', base_output_file,
-                        '-vf', f'scale=720:1280:force_original_aspect_ratio=decrease,pad=720:1280:(ow-iw)/2:(oh-ih)/2:black,subtitles={srt_file}:force_style=\'FontSize=18,BackColour=&H80000000,Bold=1,Alignment=2,MarginV=40\'',
-                        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '28',
-                        '-c:a', 'copy', '-y', tiktok_file
-                    ]
-                    print(f"    🎬 TikTok con sottotitoli stilizzati (720p ottimizzato)")
-                else:
-                    # Senza sottotitoli - OTTIMIZZATO
-                    tiktok_cmd = [
-                       'ffmpeg', '-i', base_output_file,
-                       '-vf', 'scale=720:1280:force_original_aspect_ratio=decrease,pad=720:1280:(ow-iw)/2:(oh-ih)/2:black',
-                       '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '28',
-                       '-c:a', 'copy', '-y', tiktok_file
-                    ]
-                    print(f"    🎬 TikTok senza sottotitoli (720p ottimizzato)")
-                    
-                tiktok_result = subprocess.run(tiktok_cmd, capture_output=True, text=True)
-                if tiktok_result.returncode == 0 and os.path.exists(tiktok_file):
-                    size_mb = os.path.getsize(tiktok_file) / (1024*1024)
-                    total_size += size_mb
-                    social_files.append({
-                        'format': 'TikTok (720p)',
-                        'file': tiktok_file,
-                        'filename': os.path.basename(tiktok_file),
-                        'size_mb': size_mb
-                    })
-                    print(f"    ✅ TikTok: {size_mb:.1f} MB")
-            
-            # Instagram - 1:1 quadrato
-            if social_formats.get('instagram', False):
-                instagram_file = os.path.join(
-                    self.temp_dir,
-                    f"instagram_{url_hash}_{clip_index+1}_{timestamp_min:02d}m{timestamp_sec:02d}s.mp4"
-                )
-                
-                # Comando Instagram ottimizzato
-                if srt_file and os.path.exists(srt_file):
-                    instagram_cmd = [
-                        'ffmpeg', '-i', base_output_file,
-                        '-vf', f'scale=720:720:force_original_aspect_ratio=decrease,pad=720:720:(ow-iw)/2:(oh-ih)/2:black,subtitles={srt_file}:force_style=\'FontSize=16,BackColour=&H80000000,Bold=1,Alignment=2,MarginV=30\'',
-                        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '28',
-                        '-c:a', 'copy', '-y', instagram_file
-                    ]
-                    print(f"    🎬 Instagram con sottotitoli (720p ottimizzato)")
-                else:
-                    instagram_cmd = [
-                        'ffmpeg', '-i', base_output_file,
-                        '-vf', 'scale=720:720:force_original_aspect_ratio=decrease,pad=720:720:(ow-iw)/2:(oh-ih)/2:black',
-                        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '28',
-                        '-c:a', 'copy', '-y', instagram_file
-                    ]
-                    print(f"    🎬 Instagram senza sottotitoli (720p ottimizzato)")
-                
-                instagram_result = subprocess.run(instagram_cmd, capture_output=True, text=True)
-                if instagram_result.returncode == 0 and os.path.exists(instagram_file):
-                    size_mb = os.path.getsize(instagram_file) / (1024*1024)
-                    total_size += size_mb
-                    social_files.append({
-                        'format': 'Instagram (720p)',
-                        'file': instagram_file,
-                        'filename': os.path.basename(instagram_file),
-                        'size_mb': size_mb
-                    })
-                    print(f"    ✅ Instagram: {size_mb:.1f} MB")
-            
-            # Facebook - 16:9 orizzontale
-            if social_formats.get('facebook', False):
-                facebook_file = os.path.join(
-                    self.temp_dir,
-                    f"facebook_{url_hash}_{clip_index+1}_{timestamp_min:02d}m{timestamp_sec:02d}s.mp4"
-                )
-                
-                # Comando Facebook ottimizzato
-                if srt_file and os.path.exists(srt_file):
-                    facebook_cmd = [
-                        'ffmpeg', '-i', base_output_file,
-                        '-vf', f'scale=1280:720:force_original_aspect_ratio=decrease,pad=1280:720:(ow-iw)/2:(oh-ih)/2:black,subtitles={srt_file}:force_style=\'FontSize=14,BackColour=&H80000000,Bold=1,Alignment=2,MarginV=50\'',
-                        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '28',
-                        '-c:a', 'copy', '-y', facebook_file
-                    ]
-                    print(f"    🎬 Facebook con sottotitoli (720p ottimizzato)")
-                else:
-                    facebook_cmd = [
-                        'ffmpeg', '-i', base_output_file,
-                        '-vf', 'scale=1280:720:force_original_aspect_ratio=decrease,pad=1280:720:(ow-iw)/2:(oh-ih)/2:black',
-                        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '28',
-                        '-c:a', 'copy', '-y', facebook_file
-                    ]
-                    print(f"    🎬 Facebook senza sottotitoli (720p ottimizzato)")
-                
-                facebook_result = subprocess.run(facebook_cmd, capture_output=True, text=True)
-                if facebook_result.returncode == 0 and os.path.exists(facebook_file):
-                    size_mb = os.path.getsize(facebook_file) / (1024*1024)
-                    total_size += size_mb
-                    social_files.append({
-                        'format': 'Facebook (720p)',
-                        'file': facebook_file,
-                        'filename': os.path.basename(facebook_file),
-                        'size_mb': size_mb
-                    })
-                    print(f"    ✅ Facebook: {size_mb:.1f} MB")
-            
-            # YouTube - 16:9 HD ottimizzato
-            if social_formats.get('youtube', False):
-                youtube_file = os.path.join(
-                    self.temp_dir,
-                    f"youtube_{url_hash}_{clip_index+1}_{timestamp_min:02d}m{timestamp_sec:02d}s.mp4"
-                )
-                
-                # Comando YouTube ottimizzato
-                if srt_file and os.path.exists(srt_file):
-                    youtube_cmd = [
-                        'ffmpeg', '-i', base_output_file,
-                        '-vf', f'scale=1280:720:force_original_aspect_ratio=decrease,pad=1280:720:(ow-iw)/2:(oh-ih)/2:black,subtitles={srt_file}:force_style=\'FontSize=16,BackColour=&H80000000,Bold=1,Alignment=2,MarginV=60\'',
-                        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '28',
-                        '-c:a', 'aac', '-b:a', '128k', '-y', youtube_file
-                    ]
-                    print(f"    🎬 YouTube con sottotitoli (720p ottimizzato)")
-                else:
-                    youtube_cmd = [
-                        'ffmpeg', '-i', base_output_file,
-                        '-vf', 'scale=1280:720:force_original_aspect_ratio=decrease,pad=1280:720:(ow-iw)/2:(oh-ih)/2:black',
-                        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '28',
-                        '-c:a', 'aac', '-b:a', '128k', '-y', youtube_file
-                    ]
-                    print(f"    🎬 YouTube senza sottotitoli (720p ottimizzato)")
-                
-                youtube_result = subprocess.run(youtube_cmd, capture_output=True, text=True)
-                if youtube_result.returncode == 0 and os.path.exists(youtube_file):
-                    size_mb = os.path.getsize(youtube_file) / (1024*1024)
-                    total_size += size_mb
-                    social_files.append({
-                        'format': 'YouTube (720p)',
-                        'file': youtube_file,
-                        'filename': os.path.basename(youtube_file),
-                        'size_mb': size_mb
-                    })
-                    print(f"    ✅ YouTube: {size_mb:.1f} MB")
-            
-            # Rimuovi file temporanei
-            if os.path.exists(base_output_file):
-                os.remove(base_output_file)
-            if srt_file and os.path.exists(srt_file):
-                os.remove(srt_file)
-            
-            if social_files:
-                subtitle_status = " con sottotitoli" if srt_file else " senza sottotitoli"
-                print(f"  ✅ Clip {clip_index+1}{subtitle_status} - Generati {len(social_files)} formati ({total_size:.1f} MB totali)")
-                return {
-                    'success': True,
-                    'social_files': social_files,
-                    'timestamp': timestamp_seconds,
-                    'start_time': start_time,
-                    'duration': clip_duration,
-                    'size_mb': total_size,
-                    'formats_count': len(social_files),
-                    'has_subtitles': bool(srt_file)
-                }
-            else:
-                print(f"  ❌ Nessun formato generato per clip {clip_index+1}")
-                return {
-                    'success': False,
-                    'timestamp': timestamp_seconds,
-                    'error': 'Nessun formato social selezionato o errori nella conversione'
-                }
-                
-        except subprocess.TimeoutExpired:
-            print(f"  ⏰ Timeout clip {clip_index+1}")
-            return {
-                'success': False,
-                'timestamp': timestamp_seconds,
-                'error': 'Timeout'
-            }
-        except Exception as e:
-            print(f"  ❌ Errore generico clip {clip_index+1}: {str(e)}")
-            return {
-                'success': False,
-                'timestamp': timestamp_seconds,
-                'error': str(e)
-            }
+# Piani dei task persistiti su disco per la ripresa dopo un riavvio
+task_store = TaskStore(
+    os.getenv('TASK_STORE_DIR', os.path.join(TEMP_DIR, 'tasks')),
+    retention_hours=int(os.getenv('TASK_PLAN_RETENTION_HOURS', '24'))
+)
 
-    def create_zip_package(self, clips, task_id):
-        """Crea ZIP con tutte le clip riuscite"""
-        
-        zip_filename = f"timestamp_clips_{task_id}.zip"
-        zip_path = os.path.join(self.temp_dir, zip_filename)
-        
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            files_added = 0
-            
-            for clip in clips:
-                if clip.get('success') and clip.get('social_files'):
-                    # Aggiungi tutti i file social della clip
-                    for social_file in clip['social_files']:
-                        if os.path.exists(social_file['file']):
-                            # Nome file con prefisso formato
-                            zip_name = f"{social_file['format'].replace(' ', '_').replace('(', '').replace(')', '')}_{social_file['filename']}"
-                            zipf.write(social_file['file'], zip_name)
-                            files_added += 1
-            
-            # Aggiungi report JSON
-            report_data = {
-                'extraction_date': datetime.now().isoformat(),
-                'total_clips': len(clips),
-                'successful_clips': files_added,
-                'clips': clips
-            }
-            
-            report_json = json.dumps(report_data, indent=2)
-            zipf.writestr('extraction_report.json', report_json)
-        
-        if files_added > 0:
-            return zip_path, files_added
-        else:
-            os.remove(zip_path)
-            return None, 0
-    
-    def extract_clips(self, video_url, timestamps_input, clip_duration, task_id, social_formats=None, subtitles_enabled=False, progress_callback=None):
-        """Funzione principale per estrazione clip"""
-        
-        try:
-            # Parse timestamps
-            if progress_callback:
-                progress_callback(10, "Parsing timestamp...")
-            
-            timestamps_data = self.parse_timestamps_input(timestamps_input)
-            
-            if not timestamps_data:
-                return {
-                    'success': False,
-                    'error': 'Nessun timestamp valido trovato'
-                }
-            
-            # Hash per nomi file
-            url_hash = hashlib.md5(video_url.encode()).hexdigest()[:6]
-            
-            # Download clips
-            clips = []
-            total_clips = len(timestamps_data)
-            
-            for i, timestamp_data in enumerate(timestamps_data):
-                if progress_callback:
-                    progress = 20 + (i / total_clips) * 60  # 20-80%
-                    subtitle_msg = " con sottotitoli" if subtitles_enabled else ""
-                    progress_callback(int(progress), f"Scaricando clip {i+1}/{total_clips}{subtitle_msg}...")
-                
-                clip = self.download_clip_from_timestamp(
-                    video_url, 
-                    timestamp_data['seconds'], 
-                    clip_duration, 
-                    url_hash, 
-                    i,
-                    social_formats,
-                    subtitles_enabled
-                )
-                
-                # Aggiungi descrizione
-                if clip:
-                    clip['description'] = timestamp_data['description']
-                
-                clips.append(clip)
-            
-            # Crea ZIP
-            if progress_callback:
-                progress_callback(85, "Creando pacchetto ZIP...")
-            
-            zip_path, successful_count = self.create_zip_package(clips, task_id)
-            
-            if progress_callback:
-                progress_callback(100, "Completato!")
-            
-            # Calcola statistiche
-            successful_clips = [c for c in clips if c.get('success')]
-            total_size_mb = 0
-            total_files = 0
-            clips_with_subtitles = 0
-            
-            for clip in successful_clips:
-                if clip.get('social_files'):
-                    total_size_mb += clip.get('size_mb', 0)
-                    total_files += len(clip.get('social_files', []))
-                    if clip.get('has_subtitles'):
-                        clips_with_subtitles += 1
-            
-            return {
-                'success': True,
-                'clips': clips,
-                'successful_clips': len(successful_clips),
-                'total_files': total_files,
-                'total_clips': total_clips,
-                'total_size_mb': total_size_mb,
-                'clips_with_subtitles': clips_with_subtitles,
-                'subtitles_enabled': subtitles_enabled,
-                'zip_path': zip_path,
-                'zip_filename': os.path.basename(zip_path) if zip_path else None,
-                'download_url': f'/api/download/{task_id}' if zip_path else None
-            }
-            
-        except Exception as e:
-            return {
-                'success': False,
-                'error': str(e)
-            }
+# Batch di più video: manifest dei task figli e pacchetti combinati
+batch_store = BatchStore(
+    os.path.join(os.getenv('TASK_STORE_DIR', os.path.join(TEMP_DIR, 'tasks')), 'batches'),
+    retention_hours=int(os.getenv('TASK_PLAN_RETENTION_HOURS', '24'))
+)
+
+# Modalità di esecuzione: 'thread' (estrazione nel processo web) o 'queue'
+# (l'app accoda soltanto, i job sono eseguiti da worker.py)
+EXTRACTION_MODE = os.getenv('EXTRACTION_MODE', 'thread')
+job_queue = JobQueue(os.getenv('JOB_QUEUE_PATH', os.path.join(TEMP_DIR, 'jobs.db'))) if EXTRACTION_MODE == 'queue' else None
+
+# Notifiche di fine task ai callback URL dei client (pool limitato di consegna)
+webhooks = WebhookDispatcher()
 
-# Istanza globale dell'extractor
+# Istanza globale dell'extractor (setup degli strumenti differito al warm-up)
 extractor = TimestampClipExtractor(TEMP_DIR)
 
-def process_clips_async(video_url, timestamps_input, clip_duration, task_id, social_formats, subtitles_enabled):
+# Stato dell'avvio: il processo serve richieste subito, il warm-up gira in background
+startup_state = {
+    'started_at': time.time(),
+    'database': False,
+    'extractor': False,
+    'ready_at': None,
+    'error': None
+}
+
+def normalize_video_url(video_url):
+    """Normalizza URL video (schema/host minuscoli, senza frammento)"""
+    parts = urlsplit(video_url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ''))
+
+def build_job_key(video_url, timestamps_data, clip_duration, social_formats, subtitles_enabled, subtitle_mode=None, preview_enabled=False):
+    """Calcola chiave della spec normalizzata del job per deduplicazione"""
+    if social_formats is None:
+        social_formats = {'youtube': True}
+    spec = {
+        'video_url': normalize_video_url(video_url),
+        'timestamps': [t['seconds'] for t in timestamps_data],
+        'clip_duration': int(clip_duration),
+        'social_formats': sorted(name for name, enabled in social_formats.items() if enabled),
+        'subtitles_enabled': bool(subtitles_enabled),
+        'subtitle_mode': subtitle_mode if subtitles_enabled else None,
+        'preview_enabled': bool(preview_enabled)
+    }
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+def find_inflight_task(job_key):
+    """Ritorna il task ancora in corso con la stessa spec (chiamare con inflight_lock)"""
+    if job_queue:
+        return job_queue.find_active(job_key)
+    task_id = inflight_jobs.get(job_key)
+    if task_id and task_progress.get(task_id, {}).get('status') in ('starting', 'processing'):
+        return task_id
+    return None
+
+def process_clips_async(video_url, timestamps_input, clip_duration, task_id, social_formats, subtitles_enabled, job_key=None, completed_clips=None, subtitle_mode=None, preview_enabled=PREVIEW_ENABLED, priority='bulk'):
     """Funzione asincrona per processare le clip"""
     
-    print(f"🚀 AVVIO PROCESSO ASINCRONO - Task ID: {task_id}")
-    print(f"📹 Video URL: {video_url}")
-    print(f"📋 Timestamps: {timestamps_input[:100]}...")
-    print(f"🎯 Formati: {social_formats}")
-    print(f"📝 Sottotitoli: {'ATTIVI' if subtitles_enabled else 'DISATTIVI'}")
+    # Un solo processo alla volta può eseguire il task (es. più worker gunicorn al riavvio)
+    lock_fd = task_store.acquire(task_id)
+    if lock_fd is None:
+        logger.warning(f"⏭️ Task {task_id} già in esecuzione in un altro processo")
+        # Niente stato locale per un task che non gira qui: la deduplicazione non deve agganciarlo
+        if job_key:
+            with inflight_lock:
+                if inflight_jobs.get(job_key) == task_id:
+                    del inflight_jobs[job_key]
+        task_controls.pop(task_id, None)
+        task_clips.pop(task_id, None)
+        task_progress.pop(task_id, None)
+        return
+
+    # Il piano può essere cambiato prima del lock (es. task concluso da un altro processo)
+    plan = task_store.load(task_id)
+    if plan and plan.get('status') not in INCOMPLETE_STATUSES:
+        task_store.release(task_id, lock_fd)
+        logger.warning(f"⏭️ Task {task_id} già concluso ({plan.get('status')}) da un altro processo")
+        if job_key:
+            with inflight_lock:
+                if inflight_jobs.get(job_key) == task_id:
+                    del inflight_jobs[job_key]
+        task_controls.pop(task_id, None)
+        task_clips.pop(task_id, None)
+        if plan.get('result'):
+            task_results[task_id] = plan['result']
+        task_progress[task_id] = {
+            'progress': 100 if plan.get('status') == 'completed' else task_progress.get(task_id, {}).get('progress', 0),
+            'message': 'Completato!' if plan.get('status') == 'completed' else plan.get('error', plan.get('status')),
+            'status': plan.get('status')
+        }
+        return
+    if plan:
+        completed_clips = task_store.completed_clips(plan)
+        task_clips[task_id] = dict(completed_clips)
+
+    logger.info(f"🚀 Avvio elaborazione task {task_id}", extra={
+        'task_id': task_id,
+        'video_url': video_url,
+        'timestamps': timestamps_input[:100],
+        'formats': [name for name, enabled in (social_formats or {}).items() if enabled],
+        'subtitles': bool(subtitles_enabled),
+        'priority': priority
+    })
+    
+    control = task_controls.get(task_id)
+    ready_clips = task_clips.setdefault(task_id, {})
+    final_status, result, error = 'failed', None, None
+    slot_acquired = False
+    
+    def on_wait():
+        task_progress[task_id] = dict(task_progress.get(task_id, {}), message=f'In attesa di uno slot ({priority})...')
+    
+    def clip_callback(clip_index, clip):
+        ready_clips[clip_index] = clip
+        task_store.mark_clip(task_id, clip_index, clip)
     
-    def progress_callback(progress, message):
-        print(f"📊 Progress: {progress}% - {message}")
+    def progress_callback(progress, message, eta_seconds=None):
+        if control and control.is_cancelled():
+            return
+        logger.debug(f"📊 Progress: {progress}% - {message}")
         task_progress[task_id] = {
             'progress': progress,
             'message': message,
-            'status': 'processing'
+            'status': 'processing',
+            'eta_seconds': eta_seconds if eta_seconds is not None else task_progress.get(task_id, {}).get('eta_seconds')
         }    
     try:
-        result = extractor.extract_clips(
-            video_url,
-            timestamps_input,
-            clip_duration,
-            task_id,
-            social_formats,
-            subtitles_enabled,
-            progress_callback
-        )
+        # I job bulk usano solo gli slot non riservati ai job interattivi
+        lane_scheduler.acquire(priority, control, on_wait)
+        slot_acquired = True
+        with log_context(task_id=task_id, priority=priority), Tracer(task_id).activate(), trace_span('task', mode='thread', priority=priority, resumed_clips=len(completed_clips or {})):
+            result = extractor.extract_clips(
+                video_url,
+                timestamps_input,
+                clip_duration,
+                task_id,
+                social_formats,
+                subtitles_enabled,
+                progress_callback,
+                control,
+                completed_clips,
+                clip_callback,
+                subtitle_mode,
+                preview_enabled
+            )
         
         task_progress[task_id]['status'] = 'completed'
         task_results[task_id] = result
+        task_store.finish(task_id, 'completed', result=result)
+        final_status = 'completed'
         
+    except TaskCancelled as e:
+        logger.warning(f"🛑 Task {task_id} annullato: {e}")
+        task_progress[task_id] = {
+            'progress': task_progress.get(task_id, {}).get('progress', 0),
+            'message': f'Annullato: {str(e)}',
+            'status': 'cancelled'
+        }
+        task_store.finish(task_id, 'cancelled', error=str(e))
+        final_status, error = 'cancelled', str(e)
     except Exception as e:
+        logger.error(f"❌ Task {task_id} fallito: {e}")
         task_progress[task_id] = {
             'progress': 0,
             'message': f'Errore: {str(e)}',
             'status': 'failed',
             'error': str(e)
         }
+        task_store.finish(task_id, 'failed', error=str(e))
+        error = str(e)
+    finally:
+        if slot_acquired:
+            lane_scheduler.release(priority)
+        task_store.release(task_id, lock_fd)
+        # Libera la chiave single-flight: nuove richieste avvieranno un nuovo task
+        if job_key:
+            with inflight_lock:
+                if inflight_jobs.get(job_key) == task_id:
+                    del inflight_jobs[job_key]
+        task_controls.pop(task_id, None)
+        task_clips.pop(task_id, None)
+        finish_job_history(task_id, final_status, result, error)
+        # Dopo il rilascio della chiave: nessuna richiesta può più agganciare un callback
+        notify_task_callbacks(task_store.load(task_id), final_status, result, error)
 
-# API ENDPOINTS
+def notify_task_callbacks(plan, status, result=None, error=None):
+    """Accoda il webhook di fine task per i callback registrati nel piano"""
+    if plan and plan.get('callback_urls'):
+        webhooks.notify_task(plan['callback_urls'], plan['task_id'], status, result, error, plan.get('public_base_url'))
 
-@app.route('/api/extract-clips', methods=['POST'])
-def extract_clips_endpoint():
-    """Endpoint principale per estrazione clip"""
+def send_download(path, download_name, mimetype=None):
+    """Risposta per scaricare un file: redirect interno al proxy se configurato, altrimenti sendfile"""
+    path = os.path.abspath(path)
+    relative_path = os.path.relpath(path, FILE_OFFLOAD_ROOT)
+    if FILE_OFFLOAD not in ('x-accel', 'x-sendfile') or relative_path.startswith('..'):
+        return send_file(path, as_attachment=True, download_name=download_name, mimetype=mimetype, conditional=True)
     
+    # Nessun byte passa dal worker: header, Content-Disposition e tipo, il resto lo fa il proxy
+    response = werkzeug_send_file(
+        path,
+        request.environ,
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=download_name,
+        use_x_sendfile=True,
+        response_class=app.response_class,
+        conditional=False
+    )
+    if FILE_OFFLOAD == 'x-accel':
+        del response.headers['X-Sendfile']
+        response.headers['X-Accel-Redirect'] = FILE_OFFLOAD_PREFIX + quote(relative_path.replace(os.sep, '/'))
+    return response
+
+def current_user_id():
+    """Utente del token JWT, se presente e valido (le estrazioni restano possibili senza login)"""
+    try:
+        verify_jwt_in_request(optional=True)
+        return get_jwt_identity()
+    except Exception:
+        return None
+
+def record_job_history(user_id, plan):
+    """Aggiunge il job allo storico dell'utente (una riga per utente e task)"""
+    if not user_id:
+        return
     try:
-        data = request.get_json()
+        if JobHistory.query.filter_by(user_id=user_id, task_id=plan['task_id']).first():
+            return
+        db.session.add(JobHistory(
+            user_id=user_id,
+            task_id=plan['task_id'],
+            video_url=plan['video_url'],
+            spec={
+                'clip_duration': plan['clip_duration'],
+                'social_formats': sorted(name for name, enabled in (plan['social_formats'] or {}).items() if enabled),
+                'subtitles_enabled': bool(plan['subtitles_enabled']),
+                'subtitle_mode': plan.get('subtitle_mode'),
+                'preview_enabled': bool(plan.get('preview_enabled')),
+                'priority': plan.get('priority'),
+                'timestamps': [t['seconds'] for t in plan.get('timestamps') or []]
+            },
+            clip_count=len(plan.get('timestamps') or [])
+        ))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning(f"⚠️ Storico job non registrato per {plan['task_id']}: {e}")
+
+def finish_job_history(task_id, status, result=None, error=None):
+    """Stato finale, statistiche e posizione degli output nelle righe di storico del task"""
+    with app.app_context():
+        try:
+            rows = JobHistory.query.filter_by(task_id=task_id).all()
+            if not rows:
+                return
+            files = []
+            for clip in (result or {}).get('clips', []):
+                if not clip or not clip.get('success'):
+                    continue
+                for social_file in clip.get('social_files', []):
+                    files.append({'format': social_file['format'], 'filename': social_file['filename'], 'path': social_file['file']})
+                if clip.get('subtitle_file'):
+                    files.append({'format': 'SRT', 'filename': clip['subtitle_file']['filename'], 'path': clip['subtitle_file']['file']})
+            for row in rows:
+                row.status = status
+                row.error = error
+                row.finished_at = datetime.utcnow()
+                if result:
+                    row.successful_clips = result.get('successful_clips')
+                    row.total_files = result.get('total_files')
+                    row.total_size_mb = result.get('total_size_mb')
+                    row.zip_path = result.get('zip_path')
+                    row.files = files
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.warning(f"⚠️ Storico job non aggiornato per {task_id}: {e}")
+
+def final_task_state(task_id):
+    """(stato, risultato, errore) di un task terminato, dalla coda o dal piano su disco"""
+    if job_queue:
+        job = job_queue.get(task_id)
+        if job and job['status'] in FINAL_STATUSES:
+            return job['status'], job['result'], job['error']
+        return None
+    plan = task_store.load(task_id)
+    if plan and plan.get('status') in FINAL_STATUSES:
+        return plan['status'], plan.get('result'), plan.get('error')
+    return None
+
+def encode_history_cursor(row):
+    raw = json.dumps([row.created_at.isoformat(), row.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_history_cursor(cursor):
+    """(created_at, id) dell'ultima riga della pagina precedente"""
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    created_at, row_id = json.loads(raw)
+    return datetime.fromisoformat(created_at), int(row_id)
+
+def abandoned_tasks_watchdog(interval=30):
+    """Annulla i task che nessun client interroga da TASK_ABANDON_TIMEOUT secondi"""
+    while True:
+        time.sleep(interval)
+        for task_id, control in list(task_controls.items()):
+            if not control.has_callbacks and control.idle_seconds() > TASK_ABANDON_TIMEOUT:
+                logger.warning(f"🛑 Task {task_id} abbandonato (nessun poll da {int(control.idle_seconds())}s) - annullo")
+                control.cancel('Task abbandonato (nessun poll)')
+
+if TASK_ABANDON_TIMEOUT > 0 and not job_queue:
+    threading.Thread(target=abandoned_tasks_watchdog, daemon=True).start()
+
+def start_task_thread(plan, completed_clips=None):
+    """Avvia il thread di elaborazione per un piano di task"""
+    thread = threading.Thread(
+        target=process_clips_async,
+        args=(
+            plan['video_url'],
+            plan['timestamps_input'],
+            plan['clip_duration'],
+            plan['task_id'],
+            plan['social_formats'],
+            plan['subtitles_enabled'],
+            plan.get('job_key'),
+            completed_clips,
+            plan.get('subtitle_mode'),
+            plan.get('preview_enabled', PREVIEW_ENABLED),
+            plan.get('priority', 'bulk')
+        )
+    )
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def resume_incomplete_tasks():
+    """Al riavvio ripristina lo stato dei task persistiti e riprende quelli incompleti"""
+    resumed = 0
+    for plan in task_store.load_all():
+        task_id = plan['task_id']
+        status = plan.get('status')
         
-        video_url = data.get('video_url', '').strip()
-        timestamps_input = data.get('timestamps_input', '').strip()
-        clip_duration = int(data.get('clip_duration', 60))
-        social_formats = data.get('social_formats', {
+        if status in INCOMPLETE_STATUSES:
+            completed_clips = task_store.completed_clips(plan)
+            task_progress[task_id] = {
+                'progress': 0,
+                'message': f'Ripresa elaborazione ({len(completed_clips)} clip già completate)...',
+                'status': 'starting'
+            }
+            task_controls[task_id] = TaskControl(task_id, nice=LANE_NICE[plan.get('priority', 'bulk')])
+            task_controls[task_id].has_callbacks = bool(plan.get('callback_urls'))
+            task_clips[task_id] = dict(completed_clips)
+            if plan.get('job_key'):
+                with inflight_lock:
+                    inflight_jobs[plan['job_key']] = task_id
+            start_task_thread(plan, completed_clips)
+            resumed += 1
+        elif status == 'completed' and plan.get('result'):
+            task_progress[task_id] = {
+                'progress': 100,
+                'message': 'Completato!',
+                'status': 'completed'
+            }
+            task_results[task_id] = plan['result']
+        else:
+            task_progress[task_id] = {
+                'progress': 0,
+                'message': plan.get('error', status),
+                'status': status
+            }
+    
+    if resumed:
+        logger.info(f"♻️ Ripresi {resumed} task incompleti")
+
+def lookup_task_progress(task_id):
+    """Stato corrente del task (locale o dalla coda); registra il poll del client"""
+    if job_queue:
+        state = job_queue.poll_state(task_id)
+        return job_queue.progress_data(state) if state else None
+    
+    if task_id not in task_progress:
+        return None
+    if task_id in task_controls:
+        task_controls[task_id].touch()
+    return task_progress[task_id].copy()
+
+def lookup_task_result(task_id):
+    """Risultato di un task completato (locale o dalla coda)"""
+    if job_queue:
+        job = job_queue.get(task_id)
+        return job['result'] if job and job['status'] == 'completed' else None
+    return task_results.get(task_id)
+
+def lookup_poll_state(task_id):
+    """(progresso, stato delle clip) per l'ETag dei poll, senza caricare clip e risultati dalla coda"""
+    if job_queue:
+        state = job_queue.poll_state(task_id)
+        if not state:
+            return None, None
+        return job_queue.progress_data(state), state['clips_version']
+    progress_data = lookup_task_progress(task_id)
+    if progress_data is None:
+        return None, None
+    clips = lookup_task_clips(task_id)
+    return progress_data, [clips_version(clips), len(clips)]
+
+def lookup_task_output(task_id):
+    """(clip pronte, risultato se completato) con una sola lettura del job in modalità coda"""
+    if job_queue:
+        job = job_queue.get(task_id)
+        if not job:
+            return {}, None
+        return job['clips'], job['result'] if job['status'] == 'completed' else None
+    return lookup_task_clips(task_id), lookup_task_result(task_id)
+
+def lookup_task_clips(task_id):
+    """Clip già pronte di un task, anche in corso: {clip_index: clip}"""
+    if job_queue:
+        job = job_queue.get(task_id)
+        return job['clips'] if job else {}
+    if task_id in task_clips:
+        return dict(task_clips[task_id])
+    result = task_results.get(task_id) or {}
+    return dict(enumerate(result.get('clips', [])))
+
+def public_clip(task_id, clip_index, clip):
+    """Vista di una clip pronta per il client (senza percorsi locali)"""
+    files = [
+        {
+            'format': social_file['format'],
+            'filename': social_file['filename'],
+            'size_mb': social_file['size_mb'],
+            'download_url': f"/api/download/{task_id}/{social_file['filename']}"
+        }
+        for social_file in clip.get('social_files', [])
+    ]
+    if clip.get('subtitle_file'):
+        filename = clip['subtitle_file']['filename']
+        files.append({
+            'format': 'SRT',
+            'filename': filename,
+            'download_url': f"/api/download/{task_id}/{filename}"
+        })
+    preview = None
+    if clip.get('preview'):
+        preview_url = f"/api/preview/{task_id}/{clip_index}"
+        preview = {
+            'playlist_url': f"{preview_url}/{clip['preview']['playlist']}",
+            'sprite_url': f"{preview_url}/{clip['preview']['sprite']}" if clip['preview']['sprite'] else None,
+            'sprite_interval': clip['preview']['sprite_interval'],
+            'sprite_columns': clip['preview']['sprite_columns'],
+            'sprite_rows': clip['preview']['sprite_rows']
+        }
+    return {
+        'index': clip_index,
+        'version': clip.get('version', 0),
+        'success': bool(clip.get('success')),
+        'timestamp': clip.get('timestamp'),
+        'description': clip.get('description'),
+        'error': clip.get('error'),
+        'files': files,
+        'preview': preview
+    }
+
+def clips_version(clips):
+    """Versione delle clip del task: quella dell'ultima clip pubblicata (0 se nessuna)"""
+    return max((clip.get('version', 0) for clip in clips.values() if clip), default=0)
+
+def json_etag(*state):
+    """ETag debole dallo stato (piccolo) da cui dipende la risposta"""
+    return hashlib.sha1(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()[:20]
+
+def not_modified(etag):
+    """Risposta 304 se il client ha già questa versione, altrimenti None"""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = app.response_class(status=304)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def conditional_json(payload, etag):
+    """JSON con ETag: il client (o il browser) rivalida a ogni poll"""
+    response = jsonify(payload)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def read_job_request(data):
+    """Opzioni di estrazione dal body JSON; ritorna (opzioni, None) o (None, errore)"""
+    if not isinstance(data, dict):
+        return None, 'Body JSON richiesto'
+    job = {
+        'video_url': (data.get('video_url') or '').strip(),
+        'timestamps_input': (data.get('timestamps_input') or '').strip(),
+        'clip_duration': int(data.get('clip_duration', 60)),
+        'social_formats': data.get('social_formats', {
             'tiktok': True,
             'instagram': True, 
             'facebook': True,
             'youtube': True
-        })
-        subtitles_enabled = data.get('subtitles_enabled', False)
+        }),
+        'subtitles_enabled': data.get('subtitles_enabled', False),
+        # 'burn' / 'soft' / 'auto', oppure {formato: modalità}
+        'subtitle_mode': data.get('subtitle_mode'),
+        'preview_enabled': bool(data.get('preview_enabled', PREVIEW_ENABLED)),
+        # Webhook di fine task (alternativa al polling di /api/progress)
+        'callback_url': data.get('callback_url'),
+        # 'interactive' / 'bulk'; se assente dedotta dalla dimensione del job
+        'priority': data.get('priority')
+    }
+    
+    if not job['video_url'] or not job['timestamps_input']:
+        return None, 'URL video e timestamp sono richiesti'
+    
+    subtitle_mode = job['subtitle_mode']
+    modes = subtitle_mode.items() if isinstance(subtitle_mode, dict) else [(None, subtitle_mode)]
+    for format_name, mode in modes:
+        if (format_name is not None and format_name not in SOCIAL_FORMAT_PROFILES) or (mode is not None and mode not in SUBTITLE_MODES):
+            return None, f"subtitle_mode non valido: usa uno tra {', '.join(SUBTITLE_MODES)}"
+    
+    if job['priority'] is not None and job['priority'] not in PRIORITY_CLASSES:
+        return None, f"priority non valida: usa uno tra {', '.join(PRIORITY_CLASSES)}"
+    
+    if job['callback_url'] is not None:
+        callback_error = validate_callback_url(job['callback_url'])
+        if callback_error:
+            return None, callback_error
+        job['callback_url'] = job['callback_url'].strip()
+    
+    job['timestamps'] = extractor.parse_timestamps_input(job['timestamps_input'])
+    job['priority'] = classify_job(len(job['timestamps']), job['clip_duration'], job['priority'])
+    return job, None
+
+def backlog_seconds():
+    """Secondi di lavoro stimati ancora da eseguire per i task attivi"""
+    if job_queue:
+        return job_queue.backlog_seconds()
+    return sum(
+        progress.get('eta_seconds') or 0
+        for progress in list(task_progress.values())
+        if progress.get('status') in ('starting', 'processing')
+    )
+
+def admission_check(estimate):
+    """Decisione di ammissione per un job con la stima data"""
+    backlog = backlog_seconds()
+    admitted = not ADMISSION_MAX_BACKLOG_SECONDS or backlog + estimate['wall_seconds'] <= ADMISSION_MAX_BACKLOG_SECONDS
+    return {
+        'admitted': admitted or backlog == 0,  # un job solo è sempre ammesso
+        'backlog_seconds': round(backlog, 1),
+        'max_backlog_seconds': ADMISSION_MAX_BACKLOG_SECONDS or None
+    }
+
+def submit_job(job, estimate, user_id, base_url, check_admission=True):
+    """Avvia il task di un job o aggancia quello identico già in corso.
+
+    Ritorna (task_id, subscriber_id, deduplicated, admission): subscriber_id
+    identifica il richiedente per l'annullamento; se il job non è ammesso task_id
+    è None e admission contiene la decisione."""
+    video_url = job['video_url']
+    clip_duration = job['clip_duration']
+    social_formats = job['social_formats']
+    subtitles_enabled = job['subtitles_enabled']
+    subtitle_mode = job['subtitle_mode']
+    preview_enabled = job['preview_enabled']
+    callback_url = job['callback_url']
+    priority = job['priority']
+    timestamps_data = job['timestamps']
+    subscriber_id = str(uuid.uuid4())
+    
+    # Spec normalizzata del job per single-flight
+    job_key = build_job_key(video_url, timestamps_data, clip_duration, social_formats, subtitles_enabled, subtitle_mode, preview_enabled) if timestamps_data else None
+    
+    with inflight_lock:
+        existing_task_id = find_inflight_task(job_key) if job_key else None
+        if existing_task_id:
+            lookup_task_progress(existing_task_id)
+            # Ogni richiedente può solo staccarsi: il task si annulla quando l'ultimo rinuncia
+            (job_queue or task_store).add_subscriber(existing_task_id, subscriber_id)
+            if callback_url:
+                (job_queue or task_store).add_callback(existing_task_id, callback_url)
+                if existing_task_id in task_controls:
+                    task_controls[existing_task_id].has_callbacks = True
+            if user_id:
+                existing_plan = (job_queue.get(existing_task_id) or {}).get('spec') if job_queue else task_store.load(existing_task_id)
+                if existing_plan:
+                    record_job_history(user_id, dict(existing_plan, task_id=existing_task_id))
+            logger.warning(f"🔁 Richiesta identica già in corso - aggancio al task {existing_task_id}")
+            return existing_task_id, subscriber_id, True, None
         
-        if not video_url or not timestamps_input:
-            return jsonify({
-                'success': False,
-                'error': 'URL video e timestamp sono richiesti'
-            }), 400
+        if estimate and check_admission:
+            admission = admission_check(estimate)
+            if not admission['admitted']:
+                return None, None, False, admission
         
         # Genera task ID unico
         task_id = str(uuid.uuid4())
         
+        plan = {
+            'task_id': task_id,
+            'video_url': video_url,
+            'timestamps_input': job['timestamps_input'],
+            'timestamps': timestamps_data,
+            'clip_duration': clip_duration,
+            'social_formats': social_formats,
+            'subtitles_enabled': subtitles_enabled,
+            'subtitle_mode': subtitle_mode,
+            'preview_enabled': preview_enabled,
+            'callback_urls': [callback_url] if callback_url else [],
+            'subscribers': [subscriber_id],
+            'public_base_url': base_url,
+            'estimate': estimate,
+            'priority': priority,
+            'job_key': job_key
+        }
+        record_job_history(user_id, plan)
+        
+        # Modalità coda: i worker esterni eseguiranno il job
+        if job_queue:
+            job_queue.enqueue(task_id, plan, job_key, priority=LANE_QUEUE_PRIORITY[priority])
+            logger.info(f"📥 Task {task_id} accodato")
+            return task_id, subscriber_id, False, None
+        
         # Inizializza progress
         task_progress[task_id] = {
             'progress': 0,
             'message': 'Iniziando elaborazione...',
-            'status': 'starting'
+            'status': 'starting',
+            'eta_seconds': estimate['wall_seconds'] if estimate else None
         }
+        task_controls[task_id] = TaskControl(task_id, nice=LANE_NICE[priority])
+        task_controls[task_id].has_callbacks = bool(callback_url)
+        if job_key:
+            inflight_jobs[job_key] = task_id
+    
+    # Persisti il piano prima di avviare il lavoro
+    task_store.save_plan(task_id, plan)
+    
+    # Avvia processo asincrono
+    start_task_thread(plan)
+    return task_id, subscriber_id, False, None
+
+def request_task_cancel(task_id, subscriber_id=None):
+    """Annullamento per conto di un richiedente.
+
+    Ritorna (esito, stato) con esito 'requested' | 'detached' (altri richiedenti
+    attendono ancora il task) | 'forbidden' | 'not_found' | 'finished'."""
+    
+    # Modalità coda: il worker vede la richiesta al prossimo heartbeat
+    if job_queue:
+        state = job_queue.poll_state(task_id)
+        if not state:
+            return 'not_found', None
+        if state['status'] not in ('queued', 'running'):
+            return 'finished', state['status']
+        remaining = job_queue.remove_subscriber(task_id, subscriber_id)
+        if remaining is None:
+            return 'forbidden', state['status']
+        if remaining:
+            return 'detached', state['status']
+        if not job_queue.request_cancel(task_id):
+            return 'finished', job_queue.poll_state(task_id)['status']
+        # Job mai preso in carico: annullato qui, nessun worker invierà il webhook
+        job = job_queue.get(task_id)
+        if job['status'] == 'cancelled':
+            notify_task_callbacks(dict(job['spec'], task_id=task_id), 'cancelled', error='Annullato dall\'utente')
+        return 'requested', job['status']
+    
+    if task_id not in task_progress:
+        return 'not_found', None
+    
+    control = task_controls.get(task_id)
+    if not control:
+        return 'finished', task_progress[task_id].get('status')
+    
+    remaining = task_store.remove_subscriber(task_id, subscriber_id)
+    if remaining is None:
+        return 'forbidden', task_progress[task_id].get('status')
+    if remaining:
+        return 'detached', task_progress[task_id].get('status')
+    
+    control.cancel('Annullato dall\'utente')
+    task_progress[task_id]['status'] = 'cancelling'
+    task_progress[task_id]['message'] = 'Annullamento in corso...'
+    return 'requested', 'cancelling'
+
+# API ENDPOINTS
+
+@app.route('/api/estimate', methods=['POST'])
+def estimate_endpoint():
+    """Dry run: timestamp interpretati e costi stimati del job, senza avviarlo"""
+    try:
+        job, error = read_job_request(request.get_json(silent=True))
+        if error:
+            return jsonify({
+                'success': False,
+                'error': error
+            }), 400
+        if not job['timestamps']:
+            return jsonify({
+                'success': False,
+                'error': 'Nessun timestamp valido trovato'
+            }), 400
+        
+        estimate = extractor.estimate_job(len(job['timestamps']), job['clip_duration'], job['social_formats'], job['subtitles_enabled'])
+        return jsonify({
+            'success': True,
+            'timestamps': job['timestamps'],
+            'estimate': estimate,
+            'priority': job['priority'],
+            'admission': admission_check(estimate)
+        })
+    except Exception as e:
+        logger.error(f"❌ Errore stima job: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/extract-clips', methods=['POST'])
+def extract_clips_endpoint():
+    """Endpoint principale per estrazione clip"""
+    
+    try:
+        job, error = read_job_request(request.get_json(silent=True))
+        if error:
+            return jsonify({
+                'success': False,
+                'error': error
+            }), 400
         
-        # Avvia processo asincrono
-        print(f"🔥 STO PER AVVIARE IL THREAD - Task ID: {task_id}")
-        print(f"🔥 Parametri: URL={video_url[:50]}, Durata={clip_duration}")
-        print(f"🔥 Formati ricevuti: {social_formats}")
-        print(f"🔥 Sottotitoli: {subtitles_enabled}")
+        timestamps_data = job['timestamps']
         
-        thread = threading.Thread(
-            target=process_clips_async,
-            args=(video_url, timestamps_input, clip_duration, task_id, social_formats, subtitles_enabled)
-        )
-        thread.daemon = True
-        thread.start()
+        # Costi stimati dalle medie storiche: ETA iniziale e ammissione
+        estimate = extractor.estimate_job(len(timestamps_data), job['clip_duration'], job['social_formats'], job['subtitles_enabled']) if timestamps_data else None
         
-        print(f"🔥 THREAD AVVIATO!")
+        task_id, subscriber_id, deduplicated, admission = submit_job(job, estimate, current_user_id(), PUBLIC_BASE_URL or request.host_url)
+        
+        if admission:
+            logger.warning(f"🚦 Job rifiutato: backlog stimato {admission['backlog_seconds']}s")
+            response = jsonify({
+                'success': False,
+                'error': 'Servizio al limite di capacità, riprova più tardi',
+                'estimate': estimate,
+                'admission': admission
+            })
+            response.headers['Retry-After'] = str(int(min(admission['backlog_seconds'], 300)) or 30)
+            return response, 503
+        
+        if deduplicated:
+            return jsonify({
+                'success': True,
+                'task_id': task_id,
+                'subscriber_id': subscriber_id,
+                'message': 'Elaborazione identica già in corso',
+                'subtitles_enabled': job['subtitles_enabled'],
+                'deduplicated': True
+            })
         
         return jsonify({
             'success': True,
             'task_id': task_id,
-            'message': 'Elaborazione avviata',
-            'subtitles_enabled': subtitles_enabled
+            'subscriber_id': subscriber_id,
+            'message': 'Elaborazione accodata' if job_queue else 'Elaborazione avviata',
+            'subtitles_enabled': job['subtitles_enabled'],
+            'deduplicated': False,
+            'priority': job['priority'],
+            'estimate': estimate
+        })
+        
+    except Exception as e:
+        logger.error(f"❌ ERRORE nell'endpoint: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/batch', methods=['POST'])
+def create_batch():
+    """Batch di più video (URL + timestamp) elaborati come un unico job"""
+    
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get('videos'), list) or not data['videos']:
+            return jsonify({
+                'success': False,
+                'error': 'Lista videos richiesta'
+            }), 400
+        if len(data['videos']) > BATCH_MAX_VIDEOS:
+            return jsonify({
+                'success': False,
+                'error': f'Massimo {BATCH_MAX_VIDEOS} video per batch'
+            }), 400
+        
+        # Opzioni comuni del batch, sovrascrivibili per singolo video; i batch sono bulk salvo richiesta esplicita
+        shared = {key: value for key, value in data.items() if key != 'videos'}
+        shared.setdefault('priority', 'bulk')
+        
+        jobs = []
+        for position, entry in enumerate(data['videos']):
+            job, error = read_job_request(dict(shared, **entry) if isinstance(entry, dict) else None)
+            if not error and not job['timestamps']:
+                error = 'Nessun timestamp valido trovato'
+            if error:
+                return jsonify({
+                    'success': False,
+                    'error': f'Video {position + 1}: {error}'
+                }), 400
+            jobs.append(job)
+        
+        # Voci con lo stesso URL -> un solo task (sorgente risolta una volta)
+        videos = merge_batch_entries(jobs, normalize_video_url, extractor.parse_timestamps_input)
+        # Video lunghi -> più task per intervalli di clip, distribuiti sugli slot liberi
+        chunks = [split_video_job(job) for job in videos]
+        estimates = [
+            [extractor.estimate_job(len(chunk['timestamps']), chunk['clip_duration'], chunk['social_formats'], chunk['subtitles_enabled']) for chunk in video_chunks]
+            for video_chunks in chunks
+        ]
+        flat_estimates = [chunk_estimate for video_estimates in estimates for chunk_estimate in video_estimates]
+        estimate = {
+            'wall_seconds': sum(chunk_estimate['wall_seconds'] for chunk_estimate in flat_estimates),
+            'encode_cpu_seconds': sum(chunk_estimate['encode_cpu_seconds'] for chunk_estimate in flat_estimates),
+            'output_bytes': sum(chunk_estimate['output_bytes'] for chunk_estimate in flat_estimates)
+        }
+        
+        # Ammissione sull'intero batch: o parte tutto o niente
+        admission = admission_check(estimate)
+        if not admission['admitted']:
+            logger.warning(f"🚦 Batch rifiutato: backlog stimato {admission['backlog_seconds']}s")
+            response = jsonify({
+                'success': False,
+                'error': 'Servizio al limite di capacità, riprova più tardi',
+                'estimate': estimate,
+                'admission': admission
+            })
+            response.headers['Retry-After'] = str(int(min(admission['backlog_seconds'], 300)) or 30)
+            return response, 503
+        
+        batch_id = str(uuid.uuid4())
+        user_id = current_user_id()
+        base_url = PUBLIC_BASE_URL or request.host_url
+        manifest_videos = []
+        for job, video_chunks, video_estimates in zip(videos, chunks, estimates):
+            tasks = []
+            for chunk, chunk_estimate in zip(video_chunks, video_estimates):
+                task_id, subscriber_id, deduplicated, _ = submit_job(chunk, chunk_estimate, user_id, base_url, check_admission=False)
+                tasks.append({
+                    'task_id': task_id,
+                    'subscriber_id': subscriber_id,
+                    'clip_offset': chunk['clip_offset'],
+                    'clip_count': len(chunk['timestamps']),
+                    'deduplicated': deduplicated
+                })
+            manifest_videos.append({
+                'video_url': job['video_url'],
+                'entry_indexes': job['entry_indexes'],
+                'clip_count': len(job['timestamps']),
+                'tasks': tasks
+            })
+        
+        batch_store.save(batch_id, {
+            'videos': manifest_videos,
+            'priority': shared['priority'],
+            'estimate': estimate
+        })
+        logger.info(f"📦 Batch {batch_id}: {len(data['videos'])} voci in {len(manifest_videos)} video, {len(flat_estimates)} task", extra={
+            'batch_id': batch_id,
+            'clips': sum(video['clip_count'] for video in manifest_videos)
+        })
+        
+        return jsonify({
+            'success': True,
+            'batch_id': batch_id,
+            'message': f'Batch avviato: {len(manifest_videos)} video',
+            'videos': manifest_videos,
+            'estimate': estimate,
+            'status_url': f'/api/batch/{batch_id}'
         })
         
     except Exception as e:
-        print(f"❌ ERRORE nell'endpoint: {str(e)}")
+        logger.error(f"❌ Errore creazione batch: {e}")
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
+def batch_task_state(task):
+    """Stato corrente di un task figlio del batch (registra anche il poll)"""
+    progress = lookup_task_progress(task['task_id']) or {
+        'progress': 0,
+        'message': 'Task non trovato',
+        'status': 'failed'
+    }
+    state = dict(
+        task,
+        status=progress['status'],
+        progress=progress.get('progress', 0),
+        message=progress.get('message'),
+        eta_seconds=progress.get('eta_seconds'),
+        clips_ready=sum(1 for clip in lookup_task_clips(task['task_id']).values() if clip),
+        download_url=None
+    )
+    if progress['status'] == 'completed':
+        result = lookup_task_result(task['task_id']) or {}
+        state['successful_clips'] = result.get('successful_clips')
+        state['download_url'] = result.get('download_url')
+        state['zip_path'] = result.get('zip_path')
+    return state
+
+def batch_videos_state(manifest):
+    """Stato corrente di ogni video del batch, aggregato sui suoi task figli"""
+    videos = []
+    for video in manifest['videos']:
+        tasks = [batch_task_state(task) for task in video['tasks']]
+        summary = batch_progress(tasks)
+        videos.append(dict(
+            video,
+            tasks=[{key: value for key, value in task.items() if key != 'zip_path'} for task in tasks],
+            status=summary['status'],
+            progress=summary['progress'],
+            message=tasks[0]['message'] if len(tasks) == 1 else f"{summary['videos_done']}/{len(tasks)} parti completate",
+            eta_seconds=summary['eta_seconds'],
+            clips_ready=sum(task['clips_ready'] for task in tasks),
+            successful_clips=sum(task.get('successful_clips') or 0 for task in tasks),
+            zip_paths=[task.get('zip_path') for task in tasks]
+        ))
+    return videos
+
+def batch_package_path(batch_id):
+    return os.path.join(TEMP_DIR, f"batch_clips_{batch_id}.zip")
+
+def build_batch_zip(batch_id, manifest, videos):
+    """Pacchetto combinato del batch (eseguito in background da start_batch_package)"""
+    zip_path = batch_package_path(batch_id)
+    package_videos = [
+        dict(video, folder=video_folder_name(position, video['video_url']))
+        for position, video in enumerate(videos)
+    ]
+    report = {
+        'batch_id': batch_id,
+        'created_at': manifest['created_at'],
+        'packaged_at': datetime.now().isoformat(),
+        'videos': [
+            dict(
+                {key: video[key] for key in ('folder', 'video_url', 'entry_indexes', 'clip_count', 'status', 'message')},
+                task_ids=[task['task_id'] for task in video['tasks']]
+            )
+            for video in package_videos
+        ]
+    }
+    with trace_span('batch_package', videos=len(package_videos)):
+        built_path, files_added = build_batch_package(zip_path, package_videos, report)
+    if built_path:
+        logger.info(f"📦 Pacchetto batch {batch_id} creato ({files_added} file)", extra={'batch_id': batch_id})
+    return built_path, files_added
+
+def batch_package_status(batch_id, manifest, videos, summary):
+    """Stato del pacchetto combinato; a batch concluso ne avvia la costruzione in background"""
+    if summary['status'] not in ('completed', 'partial'):
+        return None
+    return start_batch_package(batch_package_path(batch_id), lambda: build_batch_zip(batch_id, manifest, videos))
+
+@app.route('/api/batch/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    """Progresso del batch: aggregato e per singolo video"""
+    
+    manifest = batch_store.load(batch_id)
+    if not manifest:
+        return jsonify({
+            'success': False,
+            'error': 'Batch non trovato'
+        }), 404
+    
+    videos = batch_videos_state(manifest)
+    summary = batch_progress(videos)
+    package_status = batch_package_status(batch_id, manifest, videos, summary)
+    return jsonify(dict(
+        summary,
+        success=True,
+        batch_id=batch_id,
+        created_at=manifest['created_at'],
+        videos=[{key: value for key, value in video.items() if key != 'zip_paths'} for video in videos],
+        package_status=package_status,
+        download_url=f'/api/batch/{batch_id}/download' if package_status == 'ready' else None
+    ))
+
+@app.route('/api/batch/<batch_id>/cancel', methods=['POST'])
+def cancel_batch(batch_id):
+    """Annulla tutti i video ancora in corso del batch"""
+    
+    manifest = batch_store.load(batch_id)
+    if not manifest:
+        return jsonify({
+            'success': False,
+            'error': 'Batch non trovato'
+        }), 404
+    
+    cancelled = [
+        task['task_id']
+        for video in manifest['videos'] for task in video['tasks']
+        if request_task_cancel(task['task_id'], task.get('subscriber_id'))[0] in ('requested', 'detached')
+    ]
+    return jsonify({
+        'success': True,
+        'batch_id': batch_id,
+        'cancelled_tasks': cancelled,
+        'message': f'Annullamento richiesto per {len(cancelled)} task'
+    })
+
+@app.route('/api/batch/<batch_id>/download', methods=['GET'])
+def download_batch(batch_id):
+    """Pacchetto unico del batch: una cartella per video (costruito in background a batch concluso)"""
+    
+    manifest = batch_store.load(batch_id)
+    if not manifest:
+        return jsonify({
+            'success': False,
+            'error': 'Batch non trovato'
+        }), 404
+    
+    zip_path = batch_package_path(batch_id)
+    if not os.path.exists(zip_path):
+        videos = batch_videos_state(manifest)
+        summary = batch_progress(videos)
+        package_status = batch_package_status(batch_id, manifest, videos, summary)
+        if package_status is None:
+            return jsonify({
+                'success': False,
+                'error': 'Batch non ancora completato' if summary['videos_done'] < summary['videos_total'] else 'Nessun file da scaricare',
+                'status': summary['status']
+            }), 409
+        if package_status == 'empty':
+            return jsonify({
+                'success': False,
+                'error': 'Nessun file da scaricare'
+            }), 404
+        if package_status == 'building':
+            # Copia in corso in background: il client riprova più tardi
+            response = jsonify({
+                'success': False,
+                'error': 'Pacchetto in preparazione',
+                'status': summary['status'],
+                'package_status': package_status
+            })
+            response.headers['Retry-After'] = '10'
+            return response, 202
+    
+    return send_download(zip_path, f"batch_clips_{batch_id}.zip", 'application/zip')
+
+@app.route('/api/history', methods=['GET'])
+@jwt_required()
+def job_history():
+    """Storico job dell'utente, dal più recente, paginato a cursore (keyset)"""
+    
+    user_id = get_jwt_identity()
+    limit = min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+    query = JobHistory.query.filter(JobHistory.user_id == user_id)
+    
+    status = request.args.get('status')
+    if status:
+        query = query.filter(JobHistory.status == status)
+    
+    # Cursore = (created_at, id) dell'ultima riga vista: nessun OFFSET, costo costante per pagina
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            created_at, row_id = decode_history_cursor(cursor)
+        except (ValueError, TypeError):
+            return jsonify({
+                'success': False,
+                'error': 'Cursore non valido'
+            }), 400
+        query = query.filter(db.or_(
+            JobHistory.created_at < created_at,
+            db.and_(JobHistory.created_at == created_at, JobHistory.id < row_id)
+        ))
+    
+    rows = query.order_by(JobHistory.created_at.desc(), JobHistory.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    # Job conclusi senza aggiornamento dello storico (modalità coda, riavvii)
+    for row in rows:
+        if row.status not in FINAL_STATUSES:
+            state = final_task_state(row.task_id)
+            if state:
+                finish_job_history(row.task_id, *state)
+                db.session.refresh(row)
+    
+    return jsonify({
+        'success': True,
+        'jobs': [row.to_dict() for row in rows],
+        'next_cursor': encode_history_cursor(rows[-1]) if has_more else None
+    })
+
 @app.route('/api/progress/<task_id>', methods=['GET'])
 def get_progress(task_id):
-    """Endpoint per ottenere il progresso di un task"""
+    """Endpoint per ottenere il progresso di un task.
+
+    ?since=<version>: solo le clip pubblicate dopo quella versione e risultati
+    senza l'elenco delle clip (paginato su /api/clips/<task_id>).
+    ETag: 304 senza corpo se dallo scorso poll non è cambiato nulla."""
     
-    if task_id not in task_progress:
+    progress_data, clips_state = lookup_poll_state(task_id)
+    if progress_data is None:
         return jsonify({
             'success': False,
             'error': 'Task non trovato'
         }), 404
     
-    progress_data = task_progress[task_id].copy()
+    since = request.args.get('since', type=int)
+    
+    # Il tag dipende solo dallo stato piccolo: clip e risultati non vengono letti per un 304
+    etag = json_etag(progress_data, clips_state, since)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    
+    clips, result = lookup_task_output(task_id)
+    progress_data['version'] = clips_version(clips)
+    progress_data['clips_total'] = sum(1 for clip in clips.values() if clip)
+    
+    # Clip già pronte: scaricabili prima della fine del task (con since solo quelle nuove)
+    progress_data['clips_ready'] = [
+        public_clip(task_id, clip_index, clip)
+        for clip_index, clip in sorted(clips.items())
+        if clip and (since is None or clip.get('version', 0) > since)
+    ]
     
     # Se completato, aggiungi risultati
-    if progress_data['status'] == 'completed' and task_id in task_results:
-        progress_data['results'] = task_results[task_id]
+    if progress_data['status'] == 'completed':
+        if result is not None:
+            if since is None:
+                progress_data['results'] = result
+            else:
+                progress_data['results'] = {key: value for key, value in result.items() if key != 'clips'}
+                progress_data['results']['clips_url'] = f'/api/clips/{task_id}'
+    
+    return conditional_json(progress_data, etag)
+
+@app.route('/api/clips/<task_id>', methods=['GET'])
+def list_task_clips(task_id):
+    """Clip pronte del task, paginate per indice (cursore = ultimo indice ricevuto)"""
+    
+    progress_data, clips_state = lookup_poll_state(task_id)
+    if progress_data is None:
+        return jsonify({
+            'success': False,
+            'error': 'Task non trovato'
+        }), 404
+    
+    limit = min(max(request.args.get('limit', CLIPS_PAGE_SIZE, type=int), 1), CLIPS_MAX_PAGE_SIZE)
+    cursor = request.args.get('cursor', -1, type=int)
+    
+    etag = json_etag(clips_state, cursor, limit)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    
+    clips = lookup_task_clips(task_id)
+    version = clips_version(clips)
+    indexes = sorted(clip_index for clip_index, clip in clips.items() if clip and clip_index > cursor)
+    page = indexes[:limit]
+    return conditional_json({
+        'success': True,
+        'task_id': task_id,
+        'version': version,
+        'clips_total': sum(1 for clip in clips.values() if clip),
+        'clips': [public_clip(task_id, clip_index, clips[clip_index]) for clip_index in page],
+        'next_cursor': page[-1] if len(indexes) > limit else None
+    }, etag)
+
+@app.route('/api/cancel/<task_id>', methods=['POST'])
+def cancel_task(task_id):
+    """Annulla un task in corso terminando i processi yt-dlp/ffmpeg attivi.
+
+    Con richieste deduplicate il body (o la query) indica il subscriber_id ricevuto
+    all'avvio: il richiedente si stacca e il task si ferma solo con l'ultimo."""
+    
+    data = request.get_json(silent=True) or {}
+    subscriber_id = data.get('subscriber_id') or request.args.get('subscriber_id')
+    outcome, status = request_task_cancel(task_id, subscriber_id)
+    if outcome == 'not_found':
+        return jsonify({
+            'success': False,
+            'error': 'Task non trovato'
+        }), 404
+    if outcome == 'finished':
+        return jsonify({
+            'success': False,
+            'error': 'Task già terminato',
+            'status': status
+        }), 409
+    if outcome == 'forbidden':
+        return jsonify({
+            'success': False,
+            'error': 'subscriber_id mancante o non valido: il task è condiviso con altre richieste'
+        }), 403
+    if outcome == 'detached':
+        return jsonify({
+            'success': True,
+            'task_id': task_id,
+            'detached': True,
+            'message': 'Richiesta staccata: il task prosegue per gli altri richiedenti'
+        })
     
-    return jsonify(progress_data)
+    return jsonify({
+        'success': True,
+        'task_id': task_id,
+        'detached': False,
+        'message': 'Annullamento richiesto'
+    })
 
 @app.route('/api/download/<task_id>', methods=['GET'])
 def download_zip(task_id):
     """Endpoint per scaricare il ZIP delle clip"""
     
-    if task_id not in task_results:
+    result = lookup_task_result(task_id)
+    if result is None:
+        # Task non più in memoria: output ancora su disco registrati nello storico
+        history = JobHistory.query.filter(JobHistory.task_id == task_id, JobHistory.zip_path.isnot(None)).first()
+        if history:
+            result = {'success': True, 'zip_path': history.zip_path, 'zip_filename': os.path.basename(history.zip_path)}
+    if result is None:
         return jsonify({
             'success': False,
             'error': 'Risultati non trovati'
         }), 404
     
-    result = task_results[task_id]
-    
     if not result.get('success') or not result.get('zip_path'):
         return jsonify({
             'success': False,
@@ -721,23 +1365,96 @@ def download_zip(task_id):
             'error': 'File non trovato'
         }), 404
     
-    return send_file(
-        zip_path,
-        as_attachment=True,
-        download_name=result.get('zip_filename', 'clips.zip'),
-        mimetype='application/zip'
+    return send_download(zip_path, result.get('zip_filename', 'clips.zip'), 'application/zip')
+
+@app.route('/api/download/<task_id>/<filename>', methods=['GET'])
+def download_clip_file(task_id, filename):
+    """Endpoint per scaricare un singolo file di una clip già pronta"""
+    
+    for clip in lookup_task_clips(task_id).values():
+        if not clip or not clip.get('success'):
+            continue
+        files = list(clip.get('social_files', []))
+        if clip.get('subtitle_file'):
+            files.append(clip['subtitle_file'])
+        for clip_file in files:
+            if clip_file['filename'] == filename and os.path.exists(clip_file['file']):
+                return send_download(clip_file['file'], filename)
+    
+    for history in JobHistory.query.filter_by(task_id=task_id).all():
+        for entry in history.files or []:
+            if entry['filename'] == filename and os.path.exists(entry['path']):
+                return send_download(entry['path'], filename)
+    
+    return jsonify({
+        'success': False,
+        'error': 'File non trovato'
+    }), 404
+
+@app.route('/api/preview/<task_id>/<int:clip_index>/<filename>', methods=['GET'])
+def preview_file(task_id, clip_index, filename):
+    """Anteprima di una clip pronta: playlist HLS, segmenti e sprite (cacheabili)"""
+    
+    clip = lookup_task_clips(task_id).get(clip_index)
+    preview = clip.get('preview') if clip else None
+    extension = os.path.splitext(filename)[1]
+    if not preview or extension not in PREVIEW_MIMETYPES or not os.path.exists(os.path.join(preview['dir'], filename)):
+        return jsonify({
+            'success': False,
+            'error': 'Anteprima non trovata'
+        }), 404
+    
+    response = send_from_directory(
+        os.path.abspath(preview['dir']),
+        filename,
+        mimetype=PREVIEW_MIMETYPES[extension],
+        max_age=PREVIEW_CACHE_SECONDS
     )
+    response.headers['Cache-Control'] = f'public, max-age={PREVIEW_CACHE_SECONDS}, immutable'
+    return response
+
+def is_ready():
+    """Pronto quando database ed engine di estrazione (se usato da questo processo) sono caldi"""
+    return startup_state['database'] and (startup_state['extractor'] or bool(job_queue))
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
+    if extractor.is_ready():
+        ytdlp_engine = 'library' if extractor.ytdlp_engine else 'cli'
+    else:
+        ytdlp_engine = 'pending'
     return jsonify({
         'status': 'healthy',
+        'ready': is_ready(),
         'timestamp': datetime.now().isoformat(),
         'temp_dir': TEMP_DIR,
-        'openai_configured': bool(openai.api_key)
+        'ytdlp_engine': ytdlp_engine,
+        'openai_configured': bool(OPENAI_API_KEY),
+        'logging': log_stats(),
+        'webhooks': webhooks.snapshot(),
+        'lanes': None if job_queue else lane_scheduler.snapshot(),
+        'file_offload': FILE_OFFLOAD
     })
 
+@app.route('/api/health/live', methods=['GET'])
+def liveness_check():
+    """Liveness: il processo risponde (nessun controllo sulle dipendenze)"""
+    return jsonify({'status': 'alive'})
+
+@app.route('/api/health/ready', methods=['GET'])
+def readiness_check():
+    """Readiness: 503 finché database ed engine di estrazione non sono pronti"""
+    ready = is_ready()
+    return jsonify({
+        'status': 'ready' if ready else 'warming_up',
+        'database': startup_state['database'],
+        'extractor': startup_state['extractor'] or ('queue' if job_queue else False),
+        'uptime_seconds': round(time.time() - startup_state['started_at'], 1),
+        'warm_up_seconds': round(startup_state['ready_at'] - startup_state['started_at'], 1) if startup_state['ready_at'] else None,
+        'error': startup_state['error']
+    }), 200 if ready else 503
+
 @app.route('/', methods=['GET'])
 def index():
     """Root endpoint"""
@@ -745,14 +1462,26 @@ def index():
         'message': 'Timestamp Clip Extractor API',
         'version': '1.0.1',
         'features': {
-            'subtitles': bool(openai.api_key),
+            'subtitles': bool(OPENAI_API_KEY),
             'openai_whisper': True
         },
         'endpoints': [
             'POST /api/extract-clips',
+            'POST /api/estimate',
+            'POST /api/batch',
+            'GET /api/batch/<batch_id>',
+            'POST /api/batch/<batch_id>/cancel',
+            'GET /api/batch/<batch_id>/download',
+            'GET /api/history',
             'GET /api/progress/<task_id>',
+            'GET /api/clips/<task_id>',
+            'POST /api/cancel/<task_id>',
             'GET /api/download/<task_id>',
-            'GET /api/health'
+            'GET /api/download/<task_id>/<filename>',
+            'GET /api/preview/<task_id>/<clip_index>/<filename>',
+            'GET /api/health',
+            'GET /api/health/live',
+            'GET /api/health/ready'
         ]
     })
 
@@ -760,14 +1489,32 @@ def index():
 def test_auth():
     return jsonify({'message': 'Auth endpoint test', 'status': 'working'})
 
-# Inizializza database
-with app.app_context():
-    db.create_all()
-    print("✅ Database tabelle create")
+def warm_up():
+    """Inizializzazione pesante fuori dal percorso di avvio: tabelle, strumenti, ripresa task"""
+    try:
+        with app.app_context():
+            db.create_all()
+        startup_state['database'] = True
+        logger.info("✅ Database tabelle create")
+        
+        # In modalità coda l'estrazione (e la ripresa dei task) è compito dei worker
+        if not job_queue:
+            extractor.ensure_ready()
+            startup_state['extractor'] = True
+            resume_incomplete_tasks()
+        batch_store.cleanup(batch_package_path)
+        
+        startup_state['ready_at'] = time.time()
+        logger.info(f"✅ Warm-up completato in {startup_state['ready_at'] - startup_state['started_at']:.1f}s")
+    except Exception as e:
+        startup_state['error'] = str(e)
+        logger.error(f"❌ Errore warm-up: {e}")
+
+threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
 
 if __name__ == '__main__':
-    print("🚀 Avviando Timestamp Clip Extractor API...")
-    print(f"📁 Directory temporanea: {TEMP_DIR}")
-    print(f"📝 Sottotitoli OpenAI: {'✅ ATTIVI' if openai.api_key else '❌ DISATTIVI (API key mancante)'}")
+    logger.info("🚀 Avviando Timestamp Clip Extractor API...")
+    logger.info(f"📁 Directory temporanea: {TEMP_DIR}")
+    logger.info(f"📝 Sottotitoli OpenAI: {'✅ ATTIVI' if OPENAI_API_KEY else '❌ DISATTIVI (API key mancante)'}")
     
     app.run(debug=True, host='0.0.0.0', port=8000)
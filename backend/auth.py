@@ -1,12 +1,14 @@
 # auth.py - Endpoint di autenticazione
 from flask import Blueprint, request, jsonify
-from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
+from flask_jwt_extended import create_access_token, create_refresh_token, jwt_required, get_jwt_identity
 from models import db, User, UserSession, PasswordReset
 from datetime import datetime, timedelta
 import secrets
 import re
 import requests
 
+from jwt_keys import JWT_ACCESS_MINUTES
+
 # Blueprint per organizzare gli endpoint
 auth_bp = Blueprint('auth', __name__)
 
@@ -79,8 +81,9 @@ def register():
         db.session.add(user)
         db.session.commit()
         
-        # Crea token di accesso
+        # Crea token di accesso (breve durata) e di refresh
         access_token = create_access_token(identity=user.user_id)
+        refresh_token = create_refresh_token(identity=user.user_id)
         
         # Aggiorna ultimo login
         user.last_login = datetime.utcnow()
@@ -90,7 +93,9 @@ def register():
             'success': True,
             'message': 'Registrazione completata',
             'user': user.to_dict(),
-            'access_token': access_token
+            'access_token': access_token,
+            'refresh_token': refresh_token,
+            'expires_in': JWT_ACCESS_MINUTES * 60
         })
         
     except Exception as e:
@@ -130,8 +135,9 @@ def login():
                 'error': 'Account disattivato'
             }), 401
         
-        # Crea token di accesso
+        # Crea token di accesso (breve durata) e di refresh
         access_token = create_access_token(identity=user.user_id)
+        refresh_token = create_refresh_token(identity=user.user_id)
         
         # Aggiorna ultimo login
         user.last_login = datetime.utcnow()
@@ -141,7 +147,9 @@ def login():
             'success': True,
             'message': 'Login effettuato',
             'user': user.to_dict(),
-            'access_token': access_token
+            'access_token': access_token,
+            'refresh_token': refresh_token,
+            'expires_in': JWT_ACCESS_MINUTES * 60
         })
         
     except Exception as e:
@@ -218,14 +226,17 @@ def google_login():
         user.is_active = True
         db.session.commit()
         
-        # Crea token di accesso
+        # Crea token di accesso (breve durata) e di refresh
         access_token = create_access_token(identity=user.user_id)
+        refresh_token = create_refresh_token(identity=user.user_id)
         
         return jsonify({
             'success': True,
             'message': 'Login Google effettuato',
             'user': user.to_dict(),
-            'access_token': access_token
+            'access_token': access_token,
+            'refresh_token': refresh_token,
+            'expires_in': JWT_ACCESS_MINUTES * 60
         })
         
     except Exception as e:
@@ -260,6 +271,33 @@ def verify_token():
             'error': f'Errore verifica token: {str(e)}'
         }), 500
 
+@auth_bp.route('/refresh', methods=['POST'])
+@jwt_required(refresh=True)
+def refresh():
+    """Nuovo access token a partire dal refresh token"""
+    try:
+        user_id = get_jwt_identity()
+        user = User.query.filter_by(user_id=user_id).first()
+        
+        # Utenti disattivati non ottengono nuovi token
+        if not user or not user.is_active:
+            return jsonify({
+                'success': False,
+                'error': 'Token non valido'
+            }), 401
+        
+        return jsonify({
+            'success': True,
+            'access_token': create_access_token(identity=user.user_id),
+            'expires_in': JWT_ACCESS_MINUTES * 60
+        })
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'Errore rinnovo token: {str(e)}'
+        }), 500
+
 @auth_bp.route('/logout', methods=['POST'])
 @jwt_required()
 def logout():
@@ -1,5 +1,4 @@
 # auth_app.py - Microservizio dedicato per Autenticazione
-import os
 from flask import Flask, jsonify
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager
@@ -23,8 +22,6 @@ CORS(app, origins=[
 # Configurazione Database
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///auth_database.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY', 'maat-auth-secret-key-change-in-production')
-app.config['JWT_ACCESS_TOKEN_EXPIRES'] = False  # Token non scadono per semplicità
 
 # Inizializza estensioni
 from models import db
@@ -32,6 +29,10 @@ db.init_app(app)
 
 jwt = JWTManager(app)
 
+# Firma RS256 con chiavi a rotazione; il JWKS pubblicato permette al video service di verificare in locale
+from jwt_keys import configure_jwt, JWKS_PATH
+configure_jwt(app, jwt)
+
 # Importa e registra blueprint autenticazione
 from auth import auth_bp
 app.register_blueprint(auth_bp, url_prefix='/api/auth')
@@ -52,7 +53,8 @@ def auth_health():
             'timestamp': datetime.now().isoformat(),
             'database': 'connected',
             'users_count': user_count,
-            'jwt_configured': bool(app.config['JWT_SECRET_KEY']),
+            'jwt_configured': bool(app.extensions['maat_keyring'].active_kid),
+            'jwt_active_kid': app.extensions['maat_keyring'].active_kid,
             'port': 8001
         })
     except Exception as e:
@@ -77,6 +79,8 @@ def auth_info():
             'POST /api/auth/login', 
             'POST /api/auth/google-login',
             'GET /api/auth/verify-token',
+            'POST /api/auth/refresh',
+            f'GET {JWKS_PATH}',
             'POST /api/auth/logout',
             'POST /api/auth/request-password-reset',
             'POST /api/auth/reset-password',
@@ -88,28 +92,6 @@ def auth_info():
         'port': 8001
     })
 
-# Gestione errori JWT
-@jwt.expired_token_loader
-def expired_token_callback(jwt_header, jwt_payload):
-    return jsonify({
-        'success': False,
-        'error': 'Token scaduto'
-    }), 401
-
-@jwt.invalid_token_loader  
-def invalid_token_callback(error):
-    return jsonify({
-        'success': False,
-        'error': 'Token non valido'
-    }), 401
-
-@jwt.unauthorized_loader
-def missing_token_callback(error):
-    return jsonify({
-        'success': False,  
-        'error': 'Token mancante'
-    }), 401
-
 # Inizializza database al primo avvio
 def init_database():
     """Inizializza database se non esiste"""
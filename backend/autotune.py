@@ -0,0 +1,154 @@
+# autotune.py - Calibrazione degli encoder sull'host (preset/CRF per formato social)
+#
+# Uso:
+#   python autotune.py --realtime-target 2 --max-bitrate-kbps 4000 --min-ssim 0.95
+#
+# Per ogni formato prova i preset x264 dal più veloce al più lento e, per ciascuno,
+# i CRF dal migliore al peggiore, su un filmato sintetico generato localmente.
+# Viene scelta l'impostazione più veloce che rispetta il tetto di bitrate, la qualità
+# minima (SSIM) e il multiplo di tempo reale richiesto. Il risultato è scritto in
+# ENCODER_CALIBRATION_PATH e caricato dall'extractor all'avvio.
+import os
+import re
+import json
+import argparse
+import socket
+import tempfile
+import time
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from extractor import TimestampClipExtractor, SOCIAL_FORMAT_PROFILES, ENCODER_CALIBRATION_PATH
+from task_control import run_command
+
+# Dal più veloce al più lento (file più piccoli a parità di qualità)
+AUTOTUNE_PRESETS = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium']
+# Dalla qualità migliore alla peggiore
+AUTOTUNE_CRFS = [20, 23, 26, 28, 30]
+
+def generate_synthetic_source(path, duration):
+    """Filmato 720p di prova: pattern in movimento con rumore (poco comprimibile) e audio"""
+    result = run_command([
+        'ffmpeg',
+        '-f', 'lavfi', '-i', f'testsrc2=size=1280x720:rate=30:duration={duration}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+        '-vf', 'noise=alls=12:allf=t+u',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '16',
+        '-c:a', 'aac', '-b:a', '128k',
+        '-shortest', '-y', path
+    ], timeout=600)
+    if result.returncode != 0:
+        raise RuntimeError(f"Generazione filmato sintetico fallita: {result.stderr[-500:]}")
+
+def measure_ssim(encoded_file, source_file, profile):
+    """SSIM del formato encodato rispetto alla sorgente portata alla stessa geometria"""
+    width, height = profile['width'], profile['height']
+    reference = f'scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2:black'
+    result = run_command([
+        'ffmpeg', '-i', encoded_file, '-i', source_file,
+        '-lavfi', f'[1:v]{reference}[ref];[0:v][ref]ssim',
+        '-f', 'null', '-'
+    ], timeout=600)
+    match = re.search(r'All:([\d.]+)', result.stderr)
+    return float(match.group(1)) if match else None
+
+def benchmark(extractor, format_name, source_file, duration, encoder, work_dir):
+    """Encoda la sorgente con un preset/CRF e misura velocità, bitrate e qualità"""
+    profile = SOCIAL_FORMAT_PROFILES[format_name]
+    output_file = os.path.join(work_dir, f"{format_name}_{encoder['preset']}_{encoder['crf']}.mp4")
+    cmd = ['ffmpeg', '-i', source_file] + extractor.format_output_args(profile, output_file, encoder=encoder)
+    started = time.time()
+    result = run_command(cmd, timeout=duration * 60)
+    elapsed = time.time() - started
+    if result.returncode != 0 or not os.path.exists(output_file):
+        print(f"    ❌ {encoder['preset']}/crf{encoder['crf']}: encoding fallito")
+        return None
+    measurement = {
+        'preset': encoder['preset'],
+        'crf': encoder['crf'],
+        'speed': round(duration / elapsed, 2),
+        'bitrate_kbps': round(os.path.getsize(output_file) * 8 / duration / 1000),
+        'ssim': measure_ssim(output_file, source_file, profile)
+    }
+    os.remove(output_file)
+    print(f"    ⏱️ {encoder['preset']}/crf{encoder['crf']}: {measurement['speed']}x tempo reale, "
+          f"{measurement['bitrate_kbps']} kbps, SSIM {measurement['ssim']}")
+    return measurement
+
+def calibrate_profile(extractor, format_name, source_file, duration, targets, work_dir):
+    """Impostazione più veloce che rispetta i vincoli (None se nessuna li rispetta)"""
+    print(f"🎬 {SOCIAL_FORMAT_PROFILES[format_name]['label']}")
+    for preset in AUTOTUNE_PRESETS:
+        for crf in AUTOTUNE_CRFS:
+            measurement = benchmark(extractor, format_name, source_file, duration, {'preset': preset, 'crf': crf}, work_dir)
+            if measurement is None:
+                break
+            if measurement['speed'] < targets['realtime_target']:
+                # CRF più alti encodano più velocemente: si prova il successivo
+                if crf != AUTOTUNE_CRFS[-1]:
+                    continue
+                # Troppo lento anche al CRF più alto: i preset più lenti non possono rispettare il target
+                print(f"    ⚠️ Sotto {targets['realtime_target']}x tempo reale anche a crf{crf} - calibrazione interrotta")
+                return None
+            if measurement['ssim'] is not None and measurement['ssim'] < targets['min_ssim']:
+                # CRF più alti peggiorano ancora la qualità: prova il preset successivo
+                break
+            if measurement['bitrate_kbps'] <= targets['max_bitrate_kbps']:
+                return measurement
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibrazione encoder MAAT')
+    parser.add_argument('--output', default=ENCODER_CALIBRATION_PATH,
+                        help='File JSON della calibrazione (letto dall\'extractor all\'avvio)')
+    parser.add_argument('--duration', type=int, default=int(os.getenv('AUTOTUNE_DURATION', '20')),
+                        help='Durata in secondi del filmato sintetico')
+    parser.add_argument('--realtime-target', type=float, default=float(os.getenv('AUTOTUNE_REALTIME_TARGET', '2')),
+                        help='Velocità minima di encoding come multiplo del tempo reale')
+    parser.add_argument('--max-bitrate-kbps', type=int, default=int(os.getenv('AUTOTUNE_MAX_BITRATE_KBPS', '4000')),
+                        help='Tetto di bitrate (dimensione file) per formato')
+    parser.add_argument('--min-ssim', type=float, default=float(os.getenv('AUTOTUNE_MIN_SSIM', '0.95')),
+                        help='Qualità minima rispetto alla sorgente')
+    parser.add_argument('--formats', default=','.join(SOCIAL_FORMAT_PROFILES),
+                        help='Formati da calibrare (separati da virgola)')
+    args = parser.parse_args()
+
+    targets = {
+        'realtime_target': args.realtime_target,
+        'max_bitrate_kbps': args.max_bitrate_kbps,
+        'min_ssim': args.min_ssim
+    }
+    format_names = [name.strip() for name in args.formats.split(',') if name.strip() in SOCIAL_FORMAT_PROFILES]
+
+    with tempfile.TemporaryDirectory(prefix='autotune_') as work_dir:
+        extractor = TimestampClipExtractor(work_dir)
+        source_file = os.path.join(work_dir, 'synthetic.mp4')
+        print(f"🧪 Generazione filmato sintetico ({args.duration}s)...")
+        generate_synthetic_source(source_file, args.duration)
+
+        profiles = {}
+        for format_name in format_names:
+            measurement = calibrate_profile(extractor, format_name, source_file, args.duration, targets, work_dir)
+            if measurement:
+                profiles[format_name] = measurement
+                print(f"  ✅ {format_name}: {measurement['preset']}/crf{measurement['crf']}")
+            else:
+                print(f"  ⚠️ {format_name}: nessuna impostazione rispetta i vincoli - resta il default del profilo")
+
+    calibration = {
+        'created_at': datetime.now().isoformat(),
+        'host': socket.gethostname(),
+        'cpu_count': os.cpu_count(),
+        'targets': targets,
+        'profiles': profiles
+    }
+    tmp_path = f"{args.output}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(calibration, f, indent=2)
+    os.replace(tmp_path, args.output)
+    print(f"💾 Calibrazione salvata in {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+# batches.py - Batch di più video (URL + timestamp) sottomessi come un unico job
+#
+# Ogni video del batch diventa un task normale: stessa coda, stesse corsie, stessi
+# worker. Il batch conserva solo il manifest dei task figli, aggrega il progresso
+# per video e, a lavoro finito, unisce gli ZIP dei figli in un unico pacchetto con
+# una cartella per video. Le voci con lo stesso URL (e le stesse opzioni) vengono
+# fuse in un solo task: la sorgente (formato, URL diretto, indice keyframe) è
+# risolta una volta sola invece che una per voce. I video con molte clip sono poi
+# divisi in più task per intervalli di clip, così un video lungo occupa più slot
+# invece di uno solo; gli spezzoni condividono sorgente risolta e indice keyframe.
+import os
+import re
+import glob
+import json
+import time
+import shutil
+import zipfile
+import threading
+from datetime import datetime, timedelta
+
+from structured_log import get_logger
+
+logger = get_logger('batches')
+
+BATCH_MAX_VIDEOS = int(os.getenv('BATCH_MAX_VIDEOS', '50'))
+BATCH_CHUNK_CLIPS = int(os.getenv('BATCH_CHUNK_CLIPS', '4'))  # clip massime per task figlio (0 = un task per video)
+BATCH_PACKAGE_TIMEOUT = int(os.getenv('BATCH_PACKAGE_TIMEOUT', '3600'))  # oltre, un marker di costruzione è orfano
+
+# Campi del job che identificano il video; tutti gli altri devono coincidere per fondere due voci
+VIDEO_FIELDS = ('video_url', 'timestamps_input', 'timestamps')
+
+FINAL_STATUSES = ('completed', 'partial', 'failed', 'cancelled')
+
+def timestamps_separator(timestamps_input):
+    """Separatore per concatenare input dello stesso formato (marker per riga o range con virgola)"""
+    return '\n' if 'Stream Time Marker' in timestamps_input else ','
+
+def merge_batch_entries(jobs, normalize_url, parse_timestamps):
+    """Fonde le voci con stesso URL normalizzato, stesse opzioni e stesso formato timestamp.
+
+    Ritorna i job risultanti, ognuno con 'entry_indexes' (posizioni nella richiesta)."""
+    merged = {}
+    for entry_index, job in enumerate(jobs):
+        options = {key: value for key, value in job.items() if key not in VIDEO_FIELDS}
+        key = (
+            normalize_url(job['video_url']),
+            timestamps_separator(job['timestamps_input']),
+            json.dumps(options, sort_keys=True, default=str)
+        )
+        if key not in merged:
+            merged[key] = dict(job, entry_indexes=[entry_index])
+            continue
+        target = merged[key]
+        target['timestamps_input'] = key[1].join([target['timestamps_input'], job['timestamps_input']])
+        target['entry_indexes'].append(entry_index)
+
+    videos = list(merged.values())
+    for video in videos:
+        if len(video['entry_indexes']) > 1:
+            video['timestamps'] = parse_timestamps(video['timestamps_input'])
+    return videos
+
+def timestamps_to_input(timestamps, separator):
+    """Ricostruisce il testo dei timestamp (stesso formato dell'input) da una lista già parsata"""
+    if separator == '\n':
+        return '\n'.join(f"{t['original']} Stream Time Marker - {t['description']}" for t in timestamps)
+    return ','.join(t['original'] for t in timestamps)
+
+def split_video_job(video, chunk_clips=BATCH_CHUNK_CLIPS):
+    """Divide il job di un video in spezzoni da al massimo chunk_clips clip.
+
+    Ogni spezzone è un job completo con 'clip_offset' (indice della prima clip nel video)."""
+    timestamps = video['timestamps']
+    if chunk_clips <= 0 or len(timestamps) <= chunk_clips:
+        return [dict(video, clip_offset=0)]
+    separator = timestamps_separator(video['timestamps_input'])
+    return [
+        dict(
+            video,
+            timestamps=timestamps[offset:offset + chunk_clips],
+            timestamps_input=timestamps_to_input(timestamps[offset:offset + chunk_clips], separator),
+            clip_offset=offset
+        )
+        for offset in range(0, len(timestamps), chunk_clips)
+    ]
+
+def batch_progress(videos):
+    """Stato aggregato del batch dal progresso dei video (pesato sul numero di clip)"""
+    total_clips = sum(video['clip_count'] for video in videos) or 1
+    progress = sum(video.get('progress', 0) * video['clip_count'] for video in videos) / total_clips
+    statuses = [video.get('status') for video in videos]
+
+    if all(status in FINAL_STATUSES for status in statuses):
+        if 'completed' in statuses or 'partial' in statuses:
+            status = 'completed' if all(s == 'completed' for s in statuses) else 'partial'
+        else:
+            status = 'cancelled' if 'cancelled' in statuses else 'failed'
+        progress = 100
+    elif any(status in ('processing', 'cancelling') for status in statuses):
+        status = 'processing'
+    else:
+        status = 'starting'
+
+    etas = [video['eta_seconds'] for video in videos if video.get('eta_seconds') is not None and video.get('status') not in FINAL_STATUSES]
+    return {
+        'status': status,
+        'progress': int(progress),
+        'videos_total': len(videos),
+        'videos_done': sum(1 for s in statuses if s in FINAL_STATUSES),
+        # I video girano in parallelo sugli slot condivisi: conta il più lento
+        'eta_seconds': max(etas) if etas else None
+    }
+
+def video_folder_name(position, video_url):
+    """Cartella del video nel pacchetto combinato: "03_watch-v-abc123" """
+    slug = re.sub(r'[^A-Za-z0-9]+', '-', video_url.split('://', 1)[-1]).strip('-')
+    return f"{position + 1:02d}_{slug[-40:] or 'video'}"
+
+def build_batch_package(zip_path, videos, report):
+    """Unisce gli ZIP dei video in un unico pacchetto (una cartella per video).
+
+    videos: [{'folder', 'zip_paths'}] con uno ZIP per spezzone del video;
+    ritorna (zip_path, file copiati), (None, 0) se non c'è nulla da copiare
+    o (None, None) in caso di errore."""
+    tmp_path = f"{zip_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    files_added = 0
+    try:
+        # I file sono già compressi (mp4): copia dei dati senza ricompressione
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED) as package:
+            for video in videos:
+                written = set()
+                for part, source_path in enumerate(video['zip_paths']):
+                    if not source_path or not os.path.exists(source_path):
+                        continue
+                    with zipfile.ZipFile(source_path) as source:
+                        for info in source.infolist():
+                            is_report = info.filename == 'extraction_report.json'
+                            filename = info.filename
+                            # Un report per spezzone; nomi clip ripetuti tra spezzoni restano distinti
+                            if (is_report and len(video['zip_paths']) > 1) or filename in written:
+                                filename = f"part{part + 1:02d}_{filename}"
+                            written.add(filename)
+                            with source.open(info) as src, package.open(f"{video['folder']}/{filename}", 'w', force_zip64=True) as dst:
+                                shutil.copyfileobj(src, dst, 1024 * 1024)
+                            if not is_report:
+                                files_added += 1
+            if files_added:
+                package.writestr('batch_report.json', json.dumps(report, indent=2, default=str))
+        if not files_added:
+            os.remove(tmp_path)
+            return None, 0
+        os.replace(tmp_path, zip_path)
+        return zip_path, files_added
+    except (OSError, zipfile.BadZipFile) as e:
+        logger.error(f"❌ Errore creazione pacchetto batch: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None, None
+
+def package_state(zip_path):
+    """Stato del pacchetto combinato, condiviso tra processi tramite file marker:
+    'ready', 'empty' (nessun file da copiare), 'building' o None (da costruire)"""
+    if os.path.exists(zip_path):
+        return 'ready'
+    if os.path.exists(f"{zip_path}.empty"):
+        return 'empty'
+    try:
+        if time.time() - os.path.getmtime(f"{zip_path}.building") < BATCH_PACKAGE_TIMEOUT:
+            return 'building'
+    except OSError:
+        pass
+    return None
+
+def start_batch_package(zip_path, build):
+    """Avvia build() in un thread se nessun processo sta già costruendo il pacchetto.
+
+    Il marker creato in modo esclusivo fa sì che un solo worker faccia la copia;
+    build ritorna (zip_path, file copiati) come build_batch_package. Ritorna lo stato."""
+    state = package_state(zip_path)
+    if state is not None:
+        return state
+    marker = f"{zip_path}.building"
+    if os.path.exists(marker):
+        # Marker orfano (processo terminato durante la copia)
+        logger.warning(f"⚠️ Costruzione pacchetto orfana, riavvio: {os.path.basename(zip_path)}")
+        for path in glob.glob(f"{zip_path}.*"):
+            os.remove(path)
+    try:
+        fd = os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return 'building'
+    os.write(fd, str(os.getpid()).encode())
+    os.close(fd)
+
+    def run():
+        try:
+            built_path, files_added = build()
+            if built_path is None and files_added == 0:
+                open(f"{zip_path}.empty", 'w').close()
+        except Exception as e:
+            logger.error(f"❌ Errore costruzione pacchetto batch: {e}")
+        finally:
+            # In caso di errore il marker sparisce e il prossimo poll ritenta
+            if os.path.exists(marker):
+                os.remove(marker)
+
+    threading.Thread(target=run, name='batch-package', daemon=True).start()
+    return 'building'
+
+class BatchStore:
+    """Manifest dei batch (video -> task figlio) come JSON in una directory"""
+
+    def __init__(self, base_dir, retention_hours=24):
+        self.base_dir = base_dir
+        self.retention = timedelta(hours=retention_hours)
+        os.makedirs(base_dir, exist_ok=True)
+
+    def _path(self, batch_id):
+        return os.path.join(self.base_dir, f"{batch_id}.json")
+
+    def save(self, batch_id, manifest):
+        """Scrittura atomica (file temporaneo + rename)"""
+        manifest = dict(manifest, batch_id=batch_id)
+        manifest.setdefault('created_at', datetime.now().isoformat())
+        path = self._path(batch_id)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, path)
+
+    def load(self, batch_id):
+        try:
+            with open(self._path(batch_id), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def cleanup(self, package_path=None):
+        """Elimina i manifest oltre la retention (e il pacchetto combinato, se indicato)"""
+        cutoff = datetime.now() - self.retention
+        removed = 0
+        for filename in os.listdir(self.base_dir):
+            if not filename.endswith('.json'):
+                continue
+            batch_id = filename[:-len('.json')]
+            manifest = self.load(batch_id)
+            if manifest and datetime.fromisoformat(manifest['created_at']) >= cutoff:
+                continue
+            paths = [self._path(batch_id)]
+            if package_path:
+                # Pacchetto, marker di stato e file temporanei di copie interrotte
+                paths += [package_path(batch_id)] + glob.glob(f"{package_path(batch_id)}.*")
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            removed += 1
+        if removed:
+            logger.info(f"🧹 Rimossi {removed} batch scaduti")
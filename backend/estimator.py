@@ -0,0 +1,152 @@
+# estimator.py - Stima costi dei job e ETA da medie mobili dei tempi per fase
+#
+# Ogni clip completata aggiorna una media mobile esponenziale (EWMA) dei costi per
+# secondo di media di ogni fase: download, trascrizione ed encoding per profilo
+# (formato + preset). Da queste medie si stimano, prima di accettare un job, secondi
+# di download, CPU-secondi di encoding e byte prodotti; durante l'esecuzione l'ETA
+# parte dalla stima e converge sul ritmo osservato del task.
+import os
+import json
+import time
+import threading
+
+from structured_log import get_logger
+
+logger = get_logger('estimator')
+
+STAGE_STATS_PATH = os.getenv('STAGE_STATS_PATH', os.path.join(os.getenv('TEMP_DIR', 'temp_clips'), 'stage_stats.json'))
+STAGE_STATS_ALPHA = float(os.getenv('STAGE_STATS_ALPHA', '0.2'))  # peso dell'ultima misura
+STAGE_STATS_SAVE_INTERVAL = 30
+
+# Valori iniziali per secondo di media, usati finché una fase non ha misure.
+#   wall: secondi reali, cpu: CPU-secondi (somma dei core), bytes: byte prodotti
+DEFAULT_RATES = {
+    'download': {'wall': 0.3, 'bytes': 300_000},
+    'transcription': {'wall': 0.1},
+    'encode': {'wall': 0.5, 'cpu': 1.2, 'bytes': 190_000},
+    'stream': {'wall': 0.6}  # per formato: download ed encoding nello stesso passaggio
+}
+
+class StageStats:
+    """Medie mobili dei costi per fase, persistite su file JSON (scrittura atomica)"""
+
+    def __init__(self, path=STAGE_STATS_PATH, alpha=STAGE_STATS_ALPHA):
+        self.path = path
+        self.alpha = alpha
+        self.stages = {}
+        self._dirty = False
+        self._last_save = time.time()
+        self._mtime = 0
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            self._mtime = os.path.getmtime(self.path)
+            with open(self.path, encoding='utf-8') as f:
+                self.stages = json.load(f).get('stages', {})
+        except FileNotFoundError:
+            self.stages = {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Statistiche fasi non leggibili ({self.path}): {e}")
+            self.stages = {}
+
+    def refresh(self):
+        """Ricarica il file se aggiornato da un altro processo (es. worker in modalità coda)"""
+        try:
+            changed = os.path.getmtime(self.path) > self._mtime
+        except OSError:
+            return
+        with self._lock:
+            if changed and not self._dirty:
+                self.load()
+
+    def save(self, force=False):
+        """Salva se ci sono nuove misure (al massimo ogni STAGE_STATS_SAVE_INTERVAL secondi)"""
+        with self._lock:
+            if not self._dirty or (not force and time.time() - self._last_save < STAGE_STATS_SAVE_INTERVAL):
+                return
+            data = {'updated_at': time.time(), 'stages': self.stages}
+            self._dirty = False
+            self._last_save = time.time()
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp_path, self.path)
+            self._mtime = os.path.getmtime(self.path)
+        except OSError as e:
+            logger.warning(f"⚠️ Salvataggio statistiche fasi fallito: {e}")
+
+    def record(self, stage, media_seconds, **measures):
+        """Aggiorna la media della fase con una misura (wall=..., cpu=..., bytes=...)"""
+        if not media_seconds or media_seconds <= 0:
+            return
+        with self._lock:
+            entry = self.stages.setdefault(stage, {'samples': 0})
+            for name, value in measures.items():
+                if value is None:
+                    continue
+                rate = value / media_seconds
+                entry[name] = rate if name not in entry else entry[name] + self.alpha * (rate - entry[name])
+            entry['samples'] += 1
+            self._dirty = True
+        self.save()
+
+    def rate(self, stage, measure):
+        """Costo per secondo di media: media osservata o valore iniziale della famiglia di fasi"""
+        with self._lock:
+            value = self.stages.get(stage, {}).get(measure)
+        if value is not None:
+            return value
+        return DEFAULT_RATES.get(stage.split(':')[0], {}).get(measure, 0)
+
+    def samples(self, stage):
+        with self._lock:
+            return self.stages.get(stage, {}).get('samples', 0)
+
+    def estimate_clip(self, encode_stages, clip_duration, subtitles_enabled=False, streaming=False):
+        """Costi stimati di una clip; encode_stages: {formato: chiave fase encoding}"""
+        self.refresh()
+        encode = {}
+        for format_name, stage in encode_stages.items():
+            encode[format_name] = {
+                'encode_seconds': self.rate(stage, 'wall') * clip_duration,
+                'cpu_seconds': self.rate(stage, 'cpu') * clip_duration,
+                'output_bytes': self.rate(stage, 'bytes') * clip_duration
+            }
+        download_seconds = self.rate('download', 'wall') * clip_duration
+        transcription_seconds = self.rate('transcription', 'wall') * clip_duration if subtitles_enabled else 0
+        encode_seconds = sum(costs['encode_seconds'] for costs in encode.values())
+        if streaming:
+            wall_seconds = self.rate('stream', 'wall') * clip_duration * max(1, len(encode))
+        else:
+            wall_seconds = download_seconds + transcription_seconds + encode_seconds
+        return {
+            'download_seconds': download_seconds,
+            'transcription_seconds': transcription_seconds,
+            'encode_cpu_seconds': sum(costs['cpu_seconds'] for costs in encode.values()),
+            'output_bytes': sum(costs['output_bytes'] for costs in encode.values()),
+            'wall_seconds': wall_seconds,
+            'formats': encode
+        }
+
+class TaskEta:
+    """ETA di un task: parte dalla stima storica e pesa sempre più il ritmo osservato"""
+
+    def __init__(self, estimated_seconds):
+        self.estimated_seconds = estimated_seconds
+        self.started_at = time.time()
+
+    def remaining(self, fraction_done):
+        elapsed = time.time() - self.started_at
+        if fraction_done <= 0:
+            return max(0.0, self.estimated_seconds - elapsed)
+        if fraction_done >= 1:
+            return 0.0
+        observed_total = elapsed / fraction_done
+        # A metà task la stima storica non conta più
+        weight = min(1.0, fraction_done * 2)
+        total = (1 - weight) * max(self.estimated_seconds, elapsed) + weight * observed_total
+        return max(0.0, total - elapsed)
@@ -0,0 +1,1339 @@
+# extractor.py - Motore di estrazione clip (condiviso da app web e worker)
+import os
+import re
+import json
+import glob
+import math
+import shutil
+import hashlib
+import zipfile
+import subprocess
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from task_control import TaskCancelled, ProcessStalled, run_command, run_pipeline, ffmpeg_cpu_seconds
+from ytdlp_engine import YtDlpEngine
+from keyframes import KeyframeIndex, source_key
+from tracing import trace_span, current_tracer
+from structured_log import get_logger, log_context, truncate_output
+from estimator import StageStats, TaskEta
+
+logger = get_logger('extractor')
+
+# Configura OpenAI (il client viene importato al primo uso, non all'avvio)
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+
+def openai_client():
+    """Modulo openai configurato, importato alla prima trascrizione"""
+    import openai
+    openai.api_key = OPENAI_API_KEY
+    return openai
+
+# Motore download: 'library' (yt-dlp in-process) o 'cli' (un processo yt-dlp per clip)
+YTDLP_ENGINE = os.getenv('YTDLP_ENGINE', 'library')
+
+# Streaming: download piped direttamente nell'encoding (niente temp_base su disco)
+CLIP_STREAMING = os.getenv('CLIP_STREAMING', '1') == '1'
+
+# Seek guidato dall'indice keyframe (download dal keyframe precedente in stream copy)
+KEYFRAME_SEEK = os.getenv('KEYFRAME_SEEK', '1') == '1'
+
+# Timeout dei processi figli derivati dalla durata della clip
+CHILD_TIMEOUT_FACTOR = float(os.getenv('CHILD_TIMEOUT_FACTOR', '15'))  # secondi concessi per secondo di clip
+CHILD_MIN_TIMEOUT = int(os.getenv('CHILD_MIN_TIMEOUT', '120'))
+# Stallo: nessun frame/byte prodotto per N secondi -> kill e nuovo tentativo
+STALL_TIMEOUT = int(os.getenv('STALL_TIMEOUT', '60'))
+STALL_RETRIES = int(os.getenv('STALL_RETRIES', '1'))
+
+# Quota del progresso di una clip per fase: (inizio, ampiezza)
+CLIP_STAGE_SPANS = {
+    'download': (0.0, 0.5),
+    'encode': (0.5, 0.5),
+    'stream': (0.0, 1.0)
+}
+
+# Retry dei download: per clip, budget per task, backoff esponenziale con jitter
+CLIP_MAX_RETRIES = int(os.getenv('CLIP_MAX_RETRIES', '3'))
+TASK_RETRY_BUDGET = int(os.getenv('TASK_RETRY_BUDGET', '10'))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '2'))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '60'))
+
+# Segmento base in MP4 frammentato: un download interrotto resta leggibile fino all'ultimo frammento
+FRAGMENTED_MP4_ARGS = ['-movflags', '+frag_keyframe+empty_moov']
+
+class RetryBudget:
+    """Numero massimo di retry condiviso da tutte le clip di un task"""
+
+    def __init__(self, total=TASK_RETRY_BUDGET):
+        self.remaining = total
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+def backoff_delay(attempt):
+    """Backoff esponenziale con full jitter"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+def ytdlp_cut_args(start_time, duration, extra_output_args=(), input_seek=False):
+    """Argomenti CLI yt-dlp per far tagliare al downloader ffmpeg la finestra richiesta.
+
+    input_seek: -ss come opzione di input (la sorgente viene letta dal punto di seek,
+    da usare con start_time allineato a un keyframe), altrimenti come opzione di output."""
+    extra = ' '.join(extra_output_args)
+    if input_seek:
+        return [
+            '--external-downloader-args', f'ffmpeg_i:-ss {start_time}',
+            '--external-downloader-args', f'ffmpeg_o:-t {duration} {extra}'.strip()
+        ]
+    return ['--external-downloader-args', f'ffmpeg:-ss {start_time} -t {duration} {extra}'.strip()]
+
+# Sottotitoli: 'burn' (impressi nel video), 'soft' (traccia mov_text + .srt nello ZIP),
+# 'auto' (modalità consigliata dal profilo del formato). Default 'burn' per tutti i
+# formati: soft e auto solo su richiesta esplicita, i client esistenti vedono i sottotitoli
+SUBTITLE_MODES = ('auto', 'burn', 'soft')
+SUBTITLE_MODE = os.getenv('SUBTITLE_MODE', 'burn')
+
+# Anteprime: proxy HLS a bassa risoluzione + sprite di miniature, nello stesso passaggio di decodifica
+PREVIEW_ENABLED = os.getenv('PREVIEW_ENABLED', '0') == '1'
+PREVIEW_HEIGHT = int(os.getenv('PREVIEW_HEIGHT', '240'))
+PREVIEW_VIDEO_BITRATE = os.getenv('PREVIEW_VIDEO_BITRATE', '300k')
+PREVIEW_SEGMENT_SECONDS = int(os.getenv('PREVIEW_SEGMENT_SECONDS', '4'))
+PREVIEW_SPRITE_FRAMES = 20  # miniature per sprite (griglia 5 colonne)
+PREVIEW_SPRITE_COLUMNS = 5
+PREVIEW_THUMB_WIDTH = 160
+
+# Calibrazione encoder per host (generata da `python autotune.py`)
+ENCODER_CALIBRATION_PATH = os.getenv('ENCODER_CALIBRATION_PATH', 'encoder_calibration.json')
+
+def child_timeout(clip_duration, passes=1):
+    """Timeout di un processo figlio proporzionale alla durata della clip"""
+    return max(CHILD_MIN_TIMEOUT, clip_duration * CHILD_TIMEOUT_FACTOR * passes)
+
+def clip_version():
+    """Versione di una clip pubblicata: microsecondi, crescente anche tra processi e riavvii"""
+    return time.time_ns() // 1000
+
+def zip_entry_name(social_file):
+    """Nome nel pacchetto ZIP di un file social (prefisso formato)"""
+    return f"{social_file['format'].replace(' ', '_').replace('(', '').replace(')', '')}_{social_file['filename']}"
+
+class IncrementalZipPackage:
+    """ZIP del task costruito clip per clip mentre le successive sono in lavorazione.
+
+    Le aggiunte sono serializzate su un thread dedicato; alla chiusura resta da
+    scrivere solo il report JSON."""
+
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        self.files_added = 0
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # Il thread delle aggiunte non ha un tracer attivo: si usa quello del task
+        self.tracer = current_tracer()
+        # Pacchetto di un'esecuzione precedente (ripresa): le clip vengono riaggiunte
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+
+    def add_clip(self, clip, clip_index=None):
+        """Accoda l'aggiunta dei file di una clip riuscita"""
+        if clip and clip.get('success') and clip.get('social_files'):
+            self._executor.submit(self._append_traced, clip, clip_index)
+
+    def _append_traced(self, clip, clip_index):
+        if not self.tracer:
+            self._append(clip)
+            return
+        with self.tracer.span('zip_append', clip_index=clip_index) as span:
+            size_before = os.path.getsize(self.zip_path) if os.path.exists(self.zip_path) else 0
+            self._append(clip)
+            if os.path.exists(self.zip_path):
+                span.set(bytes=os.path.getsize(self.zip_path) - size_before)
+
+    def _append(self, clip):
+        entries = [(social_file['file'], zip_entry_name(social_file)) for social_file in clip['social_files']]
+        if clip.get('subtitle_file'):
+            entries.append((clip['subtitle_file']['file'], clip['subtitle_file']['filename']))
+        try:
+            with zipfile.ZipFile(self.zip_path, 'a') as zipf:
+                for path, zip_name in entries:
+                    if os.path.exists(path):
+                        zipf.write(path, zip_name)
+                        if not zip_name.endswith('.srt'):
+                            self.files_added += 1
+        except (OSError, zipfile.BadZipFile) as e:
+            logger.warning(f"⚠️ Errore aggiunta clip allo ZIP: {e}")
+
+    def finalize(self, report_data):
+        """Attende le aggiunte in corso e scrive il report; (None, 0) se lo ZIP è vuoto"""
+        self._executor.shutdown(wait=True)
+        if self.files_added == 0:
+            self.discard()
+            return None, 0
+        with zipfile.ZipFile(self.zip_path, 'a') as zipf:
+            zipf.writestr('extraction_report.json', json.dumps(report_data, indent=2))
+        return self.zip_path, self.files_added
+
+    def discard(self):
+        self._executor.shutdown(wait=True)
+        if os.path.exists(self.zip_path):
+            os.remove(self.zip_path)
+
+# Profili di encoding per formato social (l'ordine è quello di generazione)
+SOCIAL_FORMAT_PROFILES = {
+    # TikTok - 9:16 verticale
+    'tiktok': {
+        'label': 'TikTok (720p)',
+        'width': 720, 'height': 1280,
+        'font_size': 18, 'margin_v': 40,
+        'subtitle_mode': 'burn',  # modalità 'auto': nessun supporto a tracce sottotitoli nell'upload
+        'encoder': {'preset': 'ultrafast', 'crf': 28},
+        'audio_args': ['-c:a', 'copy']
+    },
+    # Instagram - 1:1 quadrato
+    'instagram': {
+        'label': 'Instagram (720p)',
+        'width': 720, 'height': 720,
+        'font_size': 16, 'margin_v': 30,
+        'subtitle_mode': 'burn',
+        'encoder': {'preset': 'ultrafast', 'crf': 28},
+        'audio_args': ['-c:a', 'copy']
+    },
+    # Facebook - 16:9 orizzontale
+    'facebook': {
+        'label': 'Facebook (720p)',
+        'width': 1280, 'height': 720,
+        'font_size': 14, 'margin_v': 50,
+        'subtitle_mode': 'soft',  # modalità 'auto': accetta l'upload del .srt
+        'encoder': {'preset': 'ultrafast', 'crf': 28},
+        'audio_args': ['-c:a', 'copy']
+    },
+    # YouTube - 16:9 HD
+    'youtube': {
+        'label': 'YouTube (720p)',
+        'width': 1280, 'height': 720,
+        'font_size': 16, 'margin_v': 60,
+        'subtitle_mode': 'soft',
+        'encoder': {'preset': 'ultrafast', 'crf': 28},
+        'audio_args': ['-c:a', 'aac', '-b:a', '128k']
+    }
+}
+
+def load_encoder_calibration(path=ENCODER_CALIBRATION_PATH):
+    """Preset/CRF calibrati per formato; {} se la calibrazione manca o non è valida"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            calibration = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"⚠️ Calibrazione encoder non leggibile ({path}): {e}")
+        return {}
+    encoders = {}
+    for format_name, settings in calibration.get('profiles', {}).items():
+        if format_name in SOCIAL_FORMAT_PROFILES and settings.get('preset') and settings.get('crf') is not None:
+            encoders[format_name] = {'preset': settings['preset'], 'crf': int(settings['crf'])}
+    return encoders
+
+class TimestampClipExtractor:
+    """Classe principale per estrazione clip"""
+    
+    def __init__(self, temp_dir, streaming_enabled=CLIP_STREAMING):
+        self.temp_dir = temp_dir
+        self.streaming_enabled = streaming_enabled
+        self.keyframe_index = KeyframeIndex(os.path.join(temp_dir, 'keyframes')) if KEYFRAME_SEEK else None
+        self._source_cache = {}  # video_url -> (timestamp, sorgente) per il percorso CLI
+        self._source_resolving = {}  # video_url -> lock della risoluzione in corso (single-flight)
+        self._source_lock = threading.Lock()
+        self.encoders = load_encoder_calibration()
+        # Medie dei tempi per fase: stime dei costi e ETA dei task
+        self.stage_stats = StageStats()
+        # Setup (verifica strumenti, import yt-dlp) differito: vedi ensure_ready
+        self.ytdlp_engine = None
+        self._ready = threading.Event()
+        self._setup_lock = threading.Lock()
+    
+    def is_ready(self):
+        return self._ready.is_set()
+    
+    def ensure_ready(self):
+        """Esegue il setup una sola volta, alla prima estrazione o dal warm-up in background"""
+        if self._ready.is_set():
+            return
+        with self._setup_lock:
+            if not self._ready.is_set():
+                self.setup_extractor()
+                self._ready.set()
+    
+    def warm_up(self):
+        """Avvia il setup in background senza bloccare il chiamante"""
+        thread = threading.Thread(target=self.ensure_ready, name='extractor-warm-up', daemon=True)
+        thread.start()
+        return thread
+    
+    def setup_extractor(self):
+        """Setup iniziale"""
+        logger.info("🔧 Setup Timestamp Clip Extractor...")
+        
+        # Verifica yt-dlp: preferisci la libreria in-process (estrattori caricati una volta)
+        self.ytdlp_engine = None
+        if YTDLP_ENGINE == 'library' and YtDlpEngine.is_available():
+            self.ytdlp_engine = YtDlpEngine()
+            logger.info(f"✅ yt-dlp {YtDlpEngine.version()} in-process")
+        else:
+            result = subprocess.run(['yt-dlp', '--version'], capture_output=True, text=True)
+            if result.returncode != 0:
+                logger.warning("⚠️ ATTENZIONE: yt-dlp non trovato - installarlo con requirements.txt")
+            else:
+                logger.info(f"✅ yt-dlp CLI {result.stdout.strip()}")
+        
+        if self.encoders:
+            settings = ', '.join(f"{name} {enc['preset']}/crf{enc['crf']}" for name, enc in self.encoders.items())
+            logger.info(f"✅ Calibrazione encoder: {settings}")
+        
+        # Verifica OpenAI API key
+        if not OPENAI_API_KEY:
+            logger.warning("⚠️ ATTENZIONE: OPENAI_API_KEY non configurata - sottotitoli disabilitati")
+        else:
+            logger.info("✅ OpenAI API key configurata")
+        
+        logger.info("✅ Setup completato!")
+
+    def generate_subtitles(self, video_file):
+        """Genera sottotitoli usando OpenAI Whisper API"""
+        if not OPENAI_API_KEY:
+            logger.warning("⚠️ API key OpenAI mancante - saltando sottotitoli")
+            return None
+        openai = openai_client()
+        
+        try:
+            logger.info(f"📝 Generando sottotitoli con OpenAI per {os.path.basename(video_file)}...")
+            
+            # Controlla dimensione file (limite OpenAI: 25MB)
+            file_size = os.path.getsize(video_file)
+            if file_size > 25 * 1024 * 1024:  # 25MB
+                logger.warning(f"⚠️ File troppo grande ({file_size/1024/1024:.1f}MB) - saltando sottotitoli")
+                return None
+            
+            # Chiamata API OpenAI Whisper
+            with open(video_file, 'rb') as audio_file:
+                response = openai.audio.transcriptions.create(
+                    model="whisper-1",
+                    file=audio_file,
+                    response_format="srt"
+                )
+            
+            # Salva file SRT
+            srt_file = video_file.replace('.mp4', '.srt')
+            with open(srt_file, 'w', encoding='utf-8') as f:
+                f.write(response)
+            
+            logger.info(f"✅ Sottotitoli salvati: {os.path.basename(srt_file)}")
+            return srt_file
+            
+        except openai.APIError as e:
+            logger.error(f"❌ Errore API OpenAI: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"❌ Errore generazione sottotitoli: {e}")
+            return None
+
+    def seconds_to_srt_time(self, seconds):
+        """Converte secondi in formato SRT (HH:MM:SS,mmm)"""
+        hours = int(seconds // 3600)
+        minutes = int((seconds % 3600) // 60)
+        secs = int(seconds % 60)
+        millis = int((seconds % 1) * 1000)
+        return f"{hours:02d}:{minutes:02d}:{secs:02d},{millis:03d}"
+    
+    def srt_time_to_seconds(self, srt_time):
+        """Converte formato SRT (HH:MM:SS,mmm) in secondi"""
+        hms, _, millis = srt_time.strip().partition(',')
+        hours, minutes, secs = map(int, hms.split(':'))
+        return hours * 3600 + minutes * 60 + secs + int(millis or 0) / 1000
+
+    def shift_srt(self, srt_file, offset):
+        """Anticipa i tempi di un SRT di `offset` secondi, scartando ciò che precede l'inizio"""
+        with open(srt_file, encoding='utf-8') as f:
+            blocks = re.split(r'\n\s*\n', f.read().strip())
+        
+        shifted = []
+        for block in blocks:
+            lines = block.splitlines()
+            timing_index = next((i for i, line in enumerate(lines) if '-->' in line), None)
+            if timing_index is None:
+                continue
+            start_str, end_str = lines[timing_index].split('-->')
+            start = self.srt_time_to_seconds(start_str) - offset
+            end = self.srt_time_to_seconds(end_str) - offset
+            if end <= 0:
+                continue
+            shifted.append('\n'.join(
+                [str(len(shifted) + 1), f"{self.seconds_to_srt_time(max(0, start))} --> {self.seconds_to_srt_time(end)}"]
+                + lines[timing_index + 1:]
+            ))
+        
+        with open(srt_file, 'w', encoding='utf-8') as f:
+            f.write('\n\n'.join(shifted) + '\n')
+
+    def parse_timestamp(self, timestamp_str):
+        """Converte timestamp in secondi"""
+        timestamp_str = timestamp_str.strip()
+        
+        if timestamp_str.isdigit():
+            return int(timestamp_str)
+        
+        parts = timestamp_str.split(':')
+        
+        if len(parts) == 2:  # MM:SS
+            minutes, seconds = map(int, parts)
+            return minutes * 60 + seconds
+        elif len(parts) == 3:  # HH:MM:SS
+            hours, minutes, seconds = map(int, parts)
+            return hours * 3600 + minutes * 60 + seconds
+        else:
+            raise ValueError(f"Formato timestamp non valido: {timestamp_str}")
+    
+    def parse_timestamps_input(self, timestamps_text):
+        """Estrae timestamp da testo formattato o formato semplice"""
+        logger.info("📋 Parsing timestamp...")
+        
+        # Controlla se è formato "Stream Time Marker"
+        if "Stream Time Marker" in timestamps_text:
+            pattern = r'(\d+:\d+:\d+)\s+Stream Time Marker\s*-?\s*(.*)'
+            matches = re.findall(pattern, timestamps_text, re.MULTILINE)
+            
+            if not matches:
+                logger.warning("⚠️ Nessun timestamp 'Stream Time Marker' trovato")
+                return []
+            
+            timestamps = []
+            for match in matches:
+                try:
+                    seconds = self.parse_timestamp(match[0])
+                    timestamps.append({
+                        'original': match[0],
+                        'seconds': seconds,
+                        'description': match[1].strip() if match[1].strip() else f"Evento al {match[0]}"
+                    })
+                except ValueError as e:
+                    logger.warning(f"⚠️ Errore timestamp {match[0]}: {e}")
+            
+            logger.info(f"✅ Trovati {len(timestamps)} timestamp validi")
+            return timestamps
+        
+        # Formato semplice: "0:01-0:03,0:05-0:07" 
+        else:
+            timestamps = []
+            ranges = timestamps_text.split(',')
+            
+            for i, range_str in enumerate(ranges):
+                range_str = range_str.strip()
+                if '-' in range_str:
+                    start_str, end_str = range_str.split('-', 1)
+                    try:
+                        start_seconds = self.parse_timestamp(start_str.strip())
+                        end_seconds = self.parse_timestamp(end_str.strip())
+                        # Usa il momento centrale del range
+                        timestamp_seconds = (start_seconds + end_seconds) // 2
+                        timestamps.append({
+                            'original': range_str,
+                            'seconds': timestamp_seconds,
+                            'description': f"Clip {i+1}"
+                        })
+                    except ValueError as e:
+                        logger.warning(f"⚠️ Errore range {range_str}: {e}")
+            
+            logger.info(f"✅ Trovati {len(timestamps)} timestamp validi")
+            return timestamps
+    
+    def cleanup_clip_files(self, url_hash, clip_index, timestamp_seconds):
+        """Rimuove tutti i file (base, parziali, srt, formati, anteprime) di una clip"""
+        timestamp_min = timestamp_seconds // 60
+        timestamp_sec = timestamp_seconds % 60
+        pattern = os.path.join(
+            self.temp_dir,
+            f"*_{url_hash}_{clip_index+1}_{timestamp_min:02d}m{timestamp_sec:02d}s*"
+        )
+        for path in glob.glob(pattern):
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def validate_clip_outputs(self, clip):
+        """Verifica che i file di una clip già completata esistano e siano video leggibili"""
+        if not clip or not clip.get('success') or not clip.get('social_files'):
+            return False
+        for social_file in clip['social_files']:
+            path = social_file['file']
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                return False
+            duration = self.probe_duration(path)
+            if not duration or duration <= 0:
+                return False
+        return True
+
+    def probe_duration(self, path):
+        """Durata in secondi di un file video (None se illeggibile)"""
+        probe = run_command([
+            'ffprobe', '-v', 'error',
+            '-show_entries', 'format=duration',
+            '-of', 'default=noprint_wrappers=1:nokey=1',
+            path
+        ], timeout=30)
+        try:
+            return float(probe.stdout.strip()) if probe.returncode == 0 else None
+        except ValueError:
+            return None
+
+    def clip_file_path(self, prefix, url_hash, clip_index, timestamp_seconds, ext='mp4'):
+        """Percorso di un file della clip (stesso schema nomi per base, srt e formati)"""
+        timestamp_min = timestamp_seconds // 60
+        timestamp_sec = timestamp_seconds % 60
+        return os.path.join(
+            self.temp_dir,
+            f"{prefix}_{url_hash}_{clip_index+1}_{timestamp_min:02d}m{timestamp_sec:02d}s.{ext}"
+        )
+
+    def subtitle_mode_for(self, format_name, subtitle_mode=None):
+        """Modalità sottotitoli effettiva di un formato ('burn' o 'soft').
+
+        subtitle_mode: modalità per tutti i formati o dict {formato: modalità};
+        assente usa SUBTITLE_MODE ('burn'), 'auto' quella consigliata dal profilo."""
+        if isinstance(subtitle_mode, dict):
+            subtitle_mode = subtitle_mode.get(format_name)
+        if subtitle_mode is None:
+            subtitle_mode = SUBTITLE_MODE
+        if subtitle_mode == 'auto':
+            return SOCIAL_FORMAT_PROFILES[format_name].get('subtitle_mode', 'burn')
+        return subtitle_mode
+
+    def encoder_for(self, format_name):
+        """Preset/CRF del formato: calibrazione dell'host o default del profilo"""
+        return self.encoders.get(format_name) or SOCIAL_FORMAT_PROFILES[format_name]['encoder']
+
+    def encode_stage(self, format_name):
+        """Chiave delle statistiche di encoding: formato + preset (la calibrazione cambia i costi)"""
+        return f"encode:{format_name}:{self.encoder_for(format_name)['preset']}"
+
+    def requested_formats(self, social_formats):
+        """Formati richiesti nell'ordine dei profili"""
+        if social_formats is None:
+            social_formats = {'youtube': True}  # Default
+        return [format_name for format_name in SOCIAL_FORMAT_PROFILES if social_formats.get(format_name, False)]
+
+    def estimate_job(self, clip_count, clip_duration, social_formats=None, subtitles_enabled=False):
+        """Stima (senza eseguire nulla) dei costi di un job dalle medie storiche per fase"""
+        formats = self.requested_formats(social_formats)
+        streaming = self.streaming_enabled and bool(formats) and not subtitles_enabled
+        encode_stages = {format_name: self.encode_stage(format_name) for format_name in formats}
+        per_clip = self.stage_stats.estimate_clip(encode_stages, clip_duration, subtitles_enabled, streaming)
+        stages = ['stream' if streaming else 'download'] + list(encode_stages.values())
+        if subtitles_enabled:
+            stages.append('transcription')
+        return {
+            'clips': clip_count,
+            'clip_duration': clip_duration,
+            'streaming': streaming,
+            'download_seconds': round(per_clip['download_seconds'] * clip_count, 1),
+            'transcription_seconds': round(per_clip['transcription_seconds'] * clip_count, 1),
+            'encode_cpu_seconds': round(per_clip['encode_cpu_seconds'] * clip_count, 1),
+            'output_bytes': int(per_clip['output_bytes'] * clip_count),
+            'wall_seconds': round(per_clip['wall_seconds'] * clip_count, 1),
+            'formats': {
+                format_name: {
+                    'encode_cpu_seconds': round(costs['cpu_seconds'] * clip_count, 1),
+                    'output_bytes': int(costs['output_bytes'] * clip_count)
+                }
+                for format_name, costs in per_clip['formats'].items()
+            },
+            # Misure alla base della stima (0 = valore iniziale, non ancora osservato)
+            'samples': {stage: self.stage_stats.samples(stage) for stage in stages}
+        }
+
+    def format_output_args(self, profile, output_file, srt_file=None, subtitle_mode='burn', encoder=None):
+        """Argomenti ffmpeg di output per un formato social.
+
+        In modalità 'soft' il file SRT deve essere il secondo input (indice 1)."""
+        encoder = encoder or profile['encoder']
+        width, height = profile['width'], profile['height']
+        video_filter = f'scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2:black'
+        subtitle_args = []
+        if srt_file and subtitle_mode == 'soft':
+            # Traccia sottotitoli selezionabile, nessun filtro di rendering
+            subtitle_args = ['-map', '0:v:0', '-map', '0:a?', '-map', '1:0', '-c:s', 'mov_text']
+        elif srt_file:
+            # Sottotitoli stilizzati
+            video_filter += f",subtitles={srt_file}:force_style='FontSize={profile['font_size']},BackColour=&H80000000,Bold=1,Alignment=2,MarginV={profile['margin_v']}'"
+        return subtitle_args + [
+            '-vf', video_filter,
+            '-c:v', 'libx264', '-preset', encoder['preset'], '-crf', str(encoder['crf'])
+        ] + profile['audio_args'] + ['-y', output_file]
+
+    def preview_sprite_layout(self, clip_duration):
+        """Intervallo tra miniature e righe della griglia dello sprite"""
+        interval = max(1, math.ceil(clip_duration / PREVIEW_SPRITE_FRAMES))
+        frames = math.ceil(clip_duration / interval)
+        return interval, math.ceil(frames / PREVIEW_SPRITE_COLUMNS)
+
+    def preview_output_args(self, preview_dir, clip_duration):
+        """Uscite aggiuntive ffmpeg per l'anteprima (input 0): playlist HLS e sprite"""
+        os.makedirs(preview_dir, exist_ok=True)
+        interval, rows = self.preview_sprite_layout(clip_duration)
+        return [
+            '-map', '0:v:0', '-map', '0:a?',
+            '-vf', f'scale=-2:{PREVIEW_HEIGHT}',
+            '-c:v', 'libx264', '-preset', 'veryfast', '-b:v', PREVIEW_VIDEO_BITRATE,
+            '-c:a', 'aac', '-b:a', '64k', '-ac', '1',
+            '-f', 'hls',
+            '-hls_time', str(PREVIEW_SEGMENT_SECONDS),
+            '-hls_playlist_type', 'vod',
+            '-hls_segment_filename', os.path.join(preview_dir, 'segment_%03d.ts'),
+            '-y', os.path.join(preview_dir, 'index.m3u8'),
+            '-map', '0:v:0',
+            '-vf', f'fps=1/{interval},scale={PREVIEW_THUMB_WIDTH}:-2,tile={PREVIEW_SPRITE_COLUMNS}x{rows}',
+            '-frames:v', '1', '-q:v', '5',
+            '-y', os.path.join(preview_dir, 'sprite.jpg')
+        ]
+
+    def collect_preview(self, preview_dir, clip_duration):
+        """Descrizione dell'anteprima generata (None se la playlist manca)"""
+        if not preview_dir or not os.path.exists(os.path.join(preview_dir, 'index.m3u8')):
+            return None
+        interval, rows = self.preview_sprite_layout(clip_duration)
+        has_sprite = os.path.exists(os.path.join(preview_dir, 'sprite.jpg'))
+        return {
+            'dir': preview_dir,
+            'playlist': 'index.m3u8',
+            'sprite': 'sprite.jpg' if has_sprite else None,
+            'sprite_interval': interval,
+            'sprite_columns': PREVIEW_SPRITE_COLUMNS,
+            'sprite_rows': rows
+        }
+
+    def collect_format_output(self, format_name, output_file):
+        """Voce di social_files per un formato generato (None se il file manca)"""
+        if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
+            return None
+        profile = SOCIAL_FORMAT_PROFILES[format_name]
+        size_mb = os.path.getsize(output_file) / (1024*1024)
+        logger.info(f"✅ {profile['label']}: {size_mb:.1f} MB")
+        return {
+            'format': profile['label'],
+            'file': output_file,
+            'filename': os.path.basename(output_file),
+            'size_mb': size_mb
+        }
+
+    def resolve_stream_source(self, video_url, ttl=600):
+        """URL diretto (e header) del formato selezionato, dalla libreria o da `yt-dlp -g`"""
+        if self.ytdlp_engine:
+            return self.ytdlp_engine.stream_source(video_url)
+        
+        cached = self._source_cache.get(video_url)
+        if cached and time.time() - cached[0] < ttl:
+            return cached[1]
+        # Single-flight per URL: un solo `yt-dlp -g` anche con più task sullo stesso video
+        with self._source_lock:
+            url_lock = self._source_resolving.setdefault(video_url, threading.Lock())
+        with url_lock:
+            cached = self._source_cache.get(video_url)
+            if cached and time.time() - cached[0] < ttl:
+                return cached[1]
+            try:
+                result = run_command(
+                    ['yt-dlp', '--no-check-certificates', '-f', 'best[height<=720]', '-g', video_url],
+                    timeout=120
+                )
+                urls = result.stdout.split()
+                # Più URL = video e audio separati: non probabili come singola sorgente
+                source = {'url': urls[0], 'headers': {}} if result.returncode == 0 and len(urls) == 1 else None
+                self._source_cache[video_url] = (time.time(), source)
+            finally:
+                with self._source_lock:
+                    self._source_resolving.pop(video_url, None)
+        return source
+
+    def plan_cut(self, video_url, start_time, clip_duration):
+        """Finestra di download e offset di trim per una clip"""
+        if self.keyframe_index:
+            return self.keyframe_index.plan_cut(source_key(video_url), start_time, clip_duration)
+        return {
+            'keyframe_aligned': False,
+            'fetch_start': start_time,
+            'fetch_duration': clip_duration,
+            'trim_offset': 0
+        }
+
+    def encode_from_file(self, base_output_file, formats, clip_duration, srt_file=None, control=None, progress_hook=None, trim_offset=0, subtitle_mode=None, preview_dir=None):
+        """Genera i formati social dal file base, un processo ffmpeg per formato"""
+        social_files = []
+        for format_index, (format_name, output_file) in enumerate(formats):
+            profile = SOCIAL_FORMAT_PROFILES[format_name]
+            format_subtitle_mode = self.subtitle_mode_for(format_name, subtitle_mode)
+            if not srt_file:
+                subtitle_msg = "senza sottotitoli"
+            elif format_subtitle_mode == 'soft':
+                subtitle_msg = "con traccia sottotitoli"
+            else:
+                subtitle_msg = "con sottotitoli"
+            logger.info(f"🎬 {profile['label']} {subtitle_msg}")
+            
+            def on_progress(progress, format_index=format_index, label=profile['label']):
+                if progress_hook:
+                    fraction = (format_index + min(progress['out_time'] / clip_duration, 1.0)) / len(formats)
+                    progress_hook('encode', fraction, f"encoding {label}")
+            
+            # Il file base parte dal keyframe precedente: scarta solo i frame prima dell'inizio clip
+            trim_args = ['-ss', str(trim_offset), '-t', str(clip_duration)] if trim_offset else []
+            cmd = ['ffmpeg'] + trim_args + ['-i', base_output_file]
+            if srt_file and format_subtitle_mode == 'soft':
+                cmd += ['-i', srt_file]
+            cmd += self.format_output_args(profile, output_file, srt_file, format_subtitle_mode, self.encoder_for(format_name))
+            if preview_dir and format_index == 0:
+                # Anteprima dalla stessa decodifica del primo formato
+                cmd += self.preview_output_args(preview_dir, clip_duration)
+            encode_started = time.time()
+            with trace_span('encode', format=format_name, subtitles=subtitle_msg) as span:
+                result = run_command(
+                    cmd, control,
+                    timeout=child_timeout(clip_duration),
+                    stall_timeout=STALL_TIMEOUT,
+                    stall_retries=STALL_RETRIES,
+                    on_progress=on_progress
+                )
+                span.set(exit_code=result.returncode)
+            if result.returncode == 0:
+                entry = self.collect_format_output(format_name, output_file)
+                if entry:
+                    social_files.append(entry)
+                    self.stage_stats.record(
+                        self.encode_stage(format_name), clip_duration,
+                        wall=time.time() - encode_started,
+                        cpu=ffmpeg_cpu_seconds(result.stderr),
+                        bytes=os.path.getsize(output_file)
+                    )
+        return social_files
+
+    def encode_streaming(self, video_url, start_time, clip_duration, formats, control=None, progress_hook=None, plan_cut=None, preview_dir=None):
+        """Scarica ed encoda tutti i formati in un solo passaggio, senza file base su disco.
+
+        plan_cut() fornisce la finestra di taglio, chiesta solo sul percorso yt-dlp in pipe.
+        Ritorna None se lo streaming non è possibile o fallisce (si ripiega sul file base)."""
+        output_args = []
+        for format_name, output_file in formats:
+            output_args += self.format_output_args(SOCIAL_FORMAT_PROFILES[format_name], output_file, encoder=self.encoder_for(format_name))
+        if preview_dir:
+            output_args += self.preview_output_args(preview_dir, clip_duration)
+
+        def on_progress(progress):
+            if progress_hook:
+                fraction = min(progress['out_time'] / clip_duration, 1.0)
+                progress_hook('stream', fraction, f"streaming {progress['total_size']/1024/1024:.1f} MB")
+        
+        # Un passaggio di download più uno di encoding per formato
+        timeout = child_timeout(clip_duration, passes=len(formats) + 1)
+        
+        source = None
+        if self.ytdlp_engine:
+            try:
+                source = self.ytdlp_engine.stream_source(video_url)
+            except Exception as e:
+                logger.warning(f"⚠️ Sorgente non risolta per lo streaming: {e}")
+                return None
+
+        if source:
+            # ffmpeg legge direttamente lo stream della sorgente
+            headers = ''.join(f"{name}: {value}\r\n" for name, value in source['headers'].items())
+            cmd = ['ffmpeg', '-ss', str(start_time), '-t', str(clip_duration)]
+            if headers:
+                cmd += ['-headers', headers]
+            cmd += ['-i', source['url']] + output_args
+            run = lambda: run_command(
+                cmd, control,
+                timeout=timeout,
+                stall_timeout=STALL_TIMEOUT,
+                stall_retries=STALL_RETRIES,
+                on_progress=on_progress
+            )
+        else:
+            # yt-dlp scrive il segmento su stdout (MPEG-TS), ffmpeg lo legge da pipe
+            if plan_cut:
+                cut = plan_cut()
+            else:
+                cut = {'keyframe_aligned': False, 'fetch_start': start_time, 'fetch_duration': clip_duration, 'trim_offset': 0}
+            producer = [
+                'yt-dlp',
+                '--no-check-certificates',
+                '-f', 'best[height<=720]',
+                '--external-downloader', 'ffmpeg'
+            ] + ytdlp_cut_args(cut['fetch_start'], cut['fetch_duration'], ['-f', 'mpegts'], cut['keyframe_aligned']) + [
+                '-o', '-',
+                video_url
+            ]
+            trim_args = ['-ss', str(cut['trim_offset']), '-t', str(clip_duration)] if cut['trim_offset'] else []
+            consumer = ['ffmpeg'] + trim_args + ['-i', 'pipe:0'] + output_args
+            run = lambda: run_pipeline(
+                producer, consumer, control,
+                timeout=timeout,
+                stall_timeout=STALL_TIMEOUT,
+                on_progress=on_progress
+            )
+        
+        started = time.time()
+        try:
+            result = run()
+        except ProcessStalled as e:
+            logger.warning(f"⚠️ Streaming in stallo: {e}")
+            return None
+
+        if result.returncode != 0:
+            logger.warning("⚠️ Streaming fallito", extra={'stderr': truncate_output(result.stderr)})
+            return None
+
+        # Un solo processo per tutti i formati: tempo per formato, byte per profilo
+        self.stage_stats.record('stream', clip_duration * len(formats), wall=time.time() - started)
+        social_files = []
+        for format_name, output_file in formats:
+            entry = self.collect_format_output(format_name, output_file)
+            if entry:
+                social_files.append(entry)
+                self.stage_stats.record(self.encode_stage(format_name), clip_duration, bytes=os.path.getsize(output_file))
+        return social_files
+
+    def download_base_clip(self, video_url, base_output_file, start_time, clip_duration, control=None, progress_hook=None, input_seek=False):
+        """Scarica il segmento della clip su file (percorso con file base)"""
+        timeout = child_timeout(clip_duration)
+        
+        if self.ytdlp_engine:
+            for attempt in range(STALL_RETRIES + 1):
+                try:
+                    with trace_span('ytdlp_download', engine='library', attempt=attempt) as span:
+                        result = self.ytdlp_engine.download_segment(
+                            video_url, base_output_file, start_time, clip_duration,
+                            control=control, progress_hook=progress_hook,
+                            timeout=timeout, stall_timeout=STALL_TIMEOUT,
+                            output_args=FRAGMENTED_MP4_ARGS, input_seek=input_seek
+                        )
+                        span.set(exit_code=result.returncode)
+                        return result
+                except ProcessStalled:
+                    if attempt >= STALL_RETRIES:
+                        raise
+                    logger.warning(f"🔁 Download in stallo - nuovo tentativo {attempt+1}/{STALL_RETRIES}")
+        
+        # Comando per scaricare clip base
+        cmd = [
+            'yt-dlp',
+            '--no-check-certificates',
+            '-f', 'best[height<=720]',  # Ottimizzato per trial
+            '--external-downloader', 'ffmpeg'
+        ] + ytdlp_cut_args(start_time, clip_duration, FRAGMENTED_MP4_ARGS, input_seek) + [
+            '-o', base_output_file,
+            video_url
+        ]
+        return run_command(
+            cmd, control,
+            timeout=timeout,
+            stall_timeout=STALL_TIMEOUT,
+            stall_retries=STALL_RETRIES,
+            # yt-dlp con ffmpeg esterno scrive su .part: la crescita del file è progresso
+            watch_files=[base_output_file + '.part', base_output_file]
+        )
+
+    def salvage_partial_download(self, base_output_file, piece_index):
+        """Dopo un download fallito conserva la parte leggibile come segmento da riprendere.
+
+        Ritorna (file_segmento, durata, byte_persi)."""
+        wasted_bytes = 0
+        for candidate in (base_output_file + '.part', base_output_file):
+            if not os.path.exists(candidate):
+                continue
+            size = os.path.getsize(candidate)
+            duration = self.probe_duration(candidate)
+            if duration and duration >= 1:
+                piece_file = f"{base_output_file}.piece{piece_index}.mp4"
+                os.replace(candidate, piece_file)
+                return piece_file, duration, wasted_bytes
+            wasted_bytes += size
+            os.remove(candidate)
+        return None, 0, wasted_bytes
+
+    def concat_pieces(self, pieces, output_file, control=None):
+        """Unisce i segmenti scaricati (stream copy, nessun re-encoding)"""
+        list_file = f"{output_file}.pieces.txt"
+        with open(list_file, 'w', encoding='utf-8') as f:
+            for piece in pieces:
+                f.write(f"file '{os.path.abspath(piece)}'\n")
+        try:
+            result = run_command(
+                ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', list_file, '-c', 'copy', '-y', output_file],
+                control, timeout=CHILD_MIN_TIMEOUT, stall_timeout=STALL_TIMEOUT
+            )
+        finally:
+            os.remove(list_file)
+            for piece in pieces:
+                if os.path.exists(piece) and piece != output_file:
+                    os.remove(piece)
+        return result
+
+    def fetch_base_clip(self, video_url, base_output_file, start_time, clip_duration, control=None, progress_hook=None, retry_budget=None, fetch_stats=None, input_seek=False):
+        """Scarica il file base con retry (backoff + jitter) e ripresa dei segmenti parziali.
+
+        Con input_seek la ripresa resta allineata: ogni frammento MP4 inizia su un keyframe."""
+        if fetch_stats is None:
+            fetch_stats = {}
+        fetch_stats.setdefault('retries', 0)
+        fetch_stats.setdefault('wasted_bytes', 0)
+        fetch_stats.setdefault('resumed_segments', 0)
+        
+        pieces = []
+        fetched = 0.0
+        attempt = 0
+        while True:
+            try:
+                result = self.download_base_clip(
+                    video_url, base_output_file,
+                    start_time + fetched, clip_duration - fetched,
+                    control, progress_hook, input_seek
+                )
+                error = None if result.returncode == 0 and os.path.exists(base_output_file) else result.stderr
+            except subprocess.TimeoutExpired as e:
+                result, error = None, e
+            
+            if error is None:
+                break
+            
+            # Conserva la parte già scaricata e riprendi da lì
+            piece, duration, wasted_bytes = self.salvage_partial_download(base_output_file, len(pieces))
+            fetch_stats['wasted_bytes'] += wasted_bytes
+            if piece:
+                pieces.append(piece)
+                fetched += duration
+                fetch_stats['resumed_segments'] += 1
+                # La parte salvata copre già (quasi) tutta la clip
+                if fetched >= clip_duration - 1:
+                    return self.concat_pieces(pieces, base_output_file, control)
+            
+            if attempt >= CLIP_MAX_RETRIES or (retry_budget and not retry_budget.take()):
+                for piece in pieces:
+                    fetch_stats['wasted_bytes'] += os.path.getsize(piece)
+                    os.remove(piece)
+                if isinstance(error, Exception):
+                    raise error
+                return result
+            
+            delay = backoff_delay(attempt)
+            attempt += 1
+            fetch_stats['retries'] = attempt
+            logger.warning(f"🔁 Download fallito - tentativo {attempt}/{CLIP_MAX_RETRIES} tra {delay:.1f}s (ripresa da {fetched:.1f}s)")
+            if control:
+                control.cancel_event.wait(delay)
+                control.check()
+            else:
+                time.sleep(delay)
+        
+        if pieces:
+            last_piece = f"{base_output_file}.piece{len(pieces)}.mp4"
+            os.replace(base_output_file, last_piece)
+            result = self.concat_pieces(pieces + [last_piece], base_output_file, control)
+        return result
+
+    def download_clip_from_timestamp(self, video_url, timestamp_seconds, clip_duration=60, url_hash="", clip_index=0, social_formats=None, subtitles_enabled=False, control=None, progress_hook=None, retry_budget=None, subtitle_mode=None, preview_enabled=PREVIEW_ENABLED, prime_keyframes=None):
+        """Scarica clip da timestamp specifico"""
+        
+        start_time = max(0, timestamp_seconds - clip_duration)
+        
+        # Lo streaming diretto dalla sorgente fa il seek con ffmpeg: l'indice keyframe
+        # serve (e viene preparato) solo per il file base o la pipe yt-dlp
+        cut = {'keyframe_aligned': False, 'fetch_start': start_time, 'fetch_duration': clip_duration, 'trim_offset': 0}
+        
+        def planned_cut():
+            nonlocal cut
+            if prime_keyframes:
+                prime_keyframes()
+            cut = self.plan_cut(video_url, start_time, clip_duration)
+            return cut
+        
+        # File base (originale) - usato solo se lo streaming non è applicabile
+        base_output_file = self.clip_file_path('temp_base', url_hash, clip_index, timestamp_seconds)
+        
+        # Formati social richiesti (nell'ordine dei profili)
+        formats = [
+            (format_name, self.clip_file_path(format_name, url_hash, clip_index, timestamp_seconds))
+            for format_name in self.requested_formats(social_formats)
+        ]
+        
+        # Directory dell'anteprima HLS (stesso schema nomi dei file della clip)
+        preview_dir = self.clip_file_path('preview', url_hash, clip_index, timestamp_seconds, 'hls') if preview_enabled and formats else None
+        
+        fetch_stats = {'retries': 0, 'wasted_bytes': 0, 'resumed_segments': 0}
+        
+        try:
+            srt_file = None
+            social_files = None
+            
+            # Streaming: download piped nell'encoding, nessun file base su disco.
+            # I sottotitoli richiedono un secondo passaggio (Whisper sul file), quindi file base.
+            if self.streaming_enabled and formats and not subtitles_enabled:
+                logger.info(f"⬇️ Scaricando ed encodando clip in streaming...")
+                with trace_span('stream_encode', formats=len(formats)) as span:
+                    social_files = self.encode_streaming(video_url, start_time, clip_duration, formats, control, progress_hook, planned_cut, preview_dir)
+                    span.set(fallback=social_files is None)
+                if social_files is None:
+                    logger.warning(f"↩️ Ripiego su download con file temporaneo")
+            
+            if social_files is None:
+                # Scarica clip base
+                logger.info(f"⬇️ Scaricando clip base...")
+                planned_cut()
+                fetch_started = time.time()
+                with trace_span('fetch_base', keyframe_aligned=cut['keyframe_aligned']) as span:
+                    result = self.fetch_base_clip(
+                        video_url, base_output_file, cut['fetch_start'], cut['fetch_duration'],
+                        control, progress_hook, retry_budget, fetch_stats, cut['keyframe_aligned']
+                    )
+                    span.set(exit_code=result.returncode, **fetch_stats)
+                    if os.path.exists(base_output_file):
+                        span.set(bytes=os.path.getsize(base_output_file))
+                
+                if result.returncode != 0 or not os.path.exists(base_output_file):
+                    logger.error("❌ Errore download clip base", extra={'stderr': truncate_output(result.stderr)})
+                    return {
+                        'success': False,
+                        'timestamp': timestamp_seconds,
+                        'error': truncate_output(result.stderr),
+                        **fetch_stats
+                    }
+                self.stage_stats.record('download', cut['fetch_duration'], wall=time.time() - fetch_started,
+                                        bytes=os.path.getsize(base_output_file))
+                
+                # Genera sottotitoli se richiesti
+                if subtitles_enabled:
+                    logger.info(f"📝 Generando sottotitoli...")
+                    transcription_started = time.time()
+                    with trace_span('transcription', bytes=os.path.getsize(base_output_file)) as span:
+                        srt_file = self.generate_subtitles(base_output_file)
+                        span.set(success=bool(srt_file))
+                    if srt_file:
+                        self.stage_stats.record('transcription', cut['fetch_duration'], wall=time.time() - transcription_started)
+                    if srt_file:
+                        # Il file base include il tratto dal keyframe all'inizio clip
+                        if cut['trim_offset']:
+                            self.shift_srt(srt_file, cut['trim_offset'])
+                        logger.info(f"✅ Sottotitoli generati")
+                    else:
+                        logger.warning(f"⚠️ Sottotitoli non disponibili")
+                
+                # Genera formati social
+                social_files = self.encode_from_file(
+                    base_output_file,
+                    formats,
+                    clip_duration,
+                    srt_file if srt_file and os.path.exists(srt_file) else None,
+                    control,
+                    progress_hook,
+                    cut['trim_offset'],
+                    subtitle_mode,
+                    preview_dir
+                )
+            
+            total_size = sum(social_file['size_mb'] for social_file in social_files)
+            
+            # Sottotitoli come traccia: il .srt resta come file a parte per il pacchetto
+            subtitle_file = None
+            if srt_file and os.path.exists(srt_file) and social_files and any(
+                self.subtitle_mode_for(format_name, subtitle_mode) == 'soft' for format_name, _ in formats
+            ):
+                sidecar_file = self.clip_file_path('subtitles', url_hash, clip_index, timestamp_seconds, 'srt')
+                os.replace(srt_file, sidecar_file)
+                subtitle_file = {
+                    'file': sidecar_file,
+                    'filename': os.path.basename(sidecar_file)
+                }
+            
+            # Rimuovi file temporanei
+            if os.path.exists(base_output_file):
+                os.remove(base_output_file)
+            if srt_file and os.path.exists(srt_file):
+                os.remove(srt_file)
+            
+            if social_files:
+                subtitle_status = " con sottotitoli" if srt_file else " senza sottotitoli"
+                logger.info(f"✅ Clip {clip_index+1}{subtitle_status} - Generati {len(social_files)} formati ({total_size:.1f} MB totali)")
+                return {
+                    'success': True,
+                    'social_files': social_files,
+                    'timestamp': timestamp_seconds,
+                    'start_time': start_time,
+                    'duration': clip_duration,
+                    'size_mb': total_size,
+                    'formats_count': len(social_files),
+                    'has_subtitles': bool(srt_file),
+                    'subtitle_file': subtitle_file,
+                    'preview': self.collect_preview(preview_dir, clip_duration),
+                    'keyframe_aligned': cut['keyframe_aligned'],
+                    **fetch_stats
+                }
+            else:
+                logger.error(f"❌ Nessun formato generato per clip {clip_index+1}")
+                return {
+                    'success': False,
+                    'timestamp': timestamp_seconds,
+                    'error': 'Nessun formato social selezionato o errori nella conversione',
+                    **fetch_stats
+                }
+                
+        except TaskCancelled:
+            if control and control.cleanup != 'none':
+                logger.warning(f"🛑 Clip {clip_index+1} annullata - pulizia file temporanei")
+                self.cleanup_clip_files(url_hash, clip_index, timestamp_seconds)
+            raise
+        except ProcessStalled as e:
+            logger.warning(f"⏰ Stallo clip {clip_index+1}: {e}")
+            return {
+                'success': False,
+                'timestamp': timestamp_seconds,
+                'error': str(e),
+                **fetch_stats
+            }
+        except subprocess.TimeoutExpired:
+            logger.warning(f"⏰ Timeout clip {clip_index+1}")
+            return {
+                'success': False,
+                'timestamp': timestamp_seconds,
+                'error': 'Timeout',
+                **fetch_stats
+            }
+        except Exception as e:
+            logger.error(f"❌ Errore generico clip {clip_index+1}: {str(e)}")
+            return {
+                'success': False,
+                'timestamp': timestamp_seconds,
+                'error': str(e),
+                **fetch_stats
+            }
+
+    def zip_package_path(self, task_id):
+        return os.path.join(self.temp_dir, f"timestamp_clips_{task_id}.zip")
+
+    def build_report(self, clips, tracer=None):
+        """Report JSON incluso nel pacchetto (con il waterfall degli span, se tracciato)"""
+        report = {
+            'extraction_date': datetime.now().isoformat(),
+            'total_clips': len(clips),
+            'successful_clips': sum(len(clip.get('social_files', [])) for clip in clips if clip.get('success')),
+            'clips': clips
+        }
+        if tracer:
+            report['trace'] = {
+                'trace_id': tracer.trace_id,
+                'waterfall': tracer.waterfall()
+            }
+        return report
+
+    def create_zip_package(self, clips, task_id):
+        """Crea ZIP con tutte le clip riuscite"""
+        package = IncrementalZipPackage(self.zip_package_path(task_id))
+        for clip in clips:
+            package.add_clip(clip)
+        return package.finalize(self.build_report(clips))
+    
+    def extract_clips(self, video_url, timestamps_input, clip_duration, task_id, social_formats=None, subtitles_enabled=False, progress_callback=None, control=None, completed_clips=None, clip_callback=None, subtitle_mode=None, preview_enabled=PREVIEW_ENABLED):
+        """Funzione principale per estrazione clip"""
+        
+        started_at = time.time()
+        clips = []
+        package = None
+        try:
+            # Setup degli strumenti se il warm-up non è ancora terminato
+            with trace_span('extractor_setup'):
+                self.ensure_ready()
+            
+            # Parse timestamps
+            if progress_callback:
+                progress_callback(10, "Parsing timestamp...")
+            
+            with trace_span('parse_timestamps'):
+                timestamps_data = self.parse_timestamps_input(timestamps_input)
+            
+            if not timestamps_data:
+                return {
+                    'success': False,
+                    'error': 'Nessun timestamp valido trovato'
+                }
+            
+            # ETA: stima storica del job, corretta dal ritmo osservato man mano che procede
+            eta = TaskEta(self.estimate_job(len(timestamps_data), clip_duration, social_formats, subtitles_enabled)['wall_seconds'])
+            if progress_callback:
+                report_progress = progress_callback
+                # Le clip occupano il 20-80% del progresso: il resto è quasi istantaneo
+                progress_callback = lambda progress, message: report_progress(
+                    progress, message, round(eta.remaining(min(max((progress - 20) / 60, 0), 1)))
+                )
+            
+            # Hash per nomi file
+            url_hash = hashlib.md5(video_url.encode()).hexdigest()[:6]
+            
+            # Download clips
+            total_clips = len(timestamps_data)
+            retry_budget = RetryBudget()
+            
+            # Pacchetto ZIP aggiornato a ogni clip completata
+            package = IncrementalZipPackage(self.zip_package_path(task_id))
+            
+            # Indice keyframe: un solo probe della sorgente per tutti i punti di taglio,
+            # alla prima clip che taglia davvero sul keyframe (vedi download_clip_from_timestamp)
+            prime_keyframes = None
+            if self.keyframe_index:
+                primed = []
+                
+                def prime_keyframes():
+                    if primed:
+                        return
+                    primed.append(True)
+                    try:
+                        start_times = [max(0, t['seconds'] - clip_duration) for t in timestamps_data]
+                        with trace_span('keyframe_index', cut_points=len(start_times)):
+                            self.keyframe_index.prime(source_key(video_url), self.resolve_stream_source(video_url), start_times)
+                    except Exception as e:
+                        logger.warning(f"⚠️ Indice keyframe non disponibile: {e}")
+            
+            for i, timestamp_data in enumerate(timestamps_data):
+                # Salta le clip rimanenti se il task è stato annullato
+                if control:
+                    control.check()
+                
+                if progress_callback:
+                    progress = 20 + (i / total_clips) * 60  # 20-80%
+                    subtitle_msg = " con sottotitoli" if subtitles_enabled else ""
+                    progress_callback(int(progress), f"Scaricando clip {i+1}/{total_clips}{subtitle_msg}...")
+                
+                # Ripresa: salta le clip già completate con output validi
+                previous_clip = completed_clips.get(i) if completed_clips else None
+                if previous_clip and self.validate_clip_outputs(previous_clip):
+                    logger.info(f"♻️ Clip {i+1} già completata - salto")
+                    previous_clip.setdefault('version', clip_version())
+                    clips.append(previous_clip)
+                    package.add_clip(previous_clip, i)
+                    if clip_callback:
+                        clip_callback(i, previous_clip)
+                    continue
+                
+                # Progresso interno alla clip (byte scaricati, tempo encodato), max 1 aggiornamento/s
+                last_update = [0.0]
+                def clip_progress(stage, fraction, detail, i=i, last_update=last_update):
+                    now = time.time()
+                    if not progress_callback or (now - last_update[0] < 1.0 and fraction < 1.0):
+                        return
+                    last_update[0] = now
+                    stage_start, stage_span = CLIP_STAGE_SPANS[stage]
+                    progress = 20 + ((i + stage_start + fraction * stage_span) / total_clips) * 60
+                    progress_callback(int(progress), f"Clip {i+1}/{total_clips} - {detail}")
+                
+                with log_context(clip_index=i), trace_span('clip', clip_index=i, timestamp=timestamp_data['seconds']) as span:
+                    clip = self.download_clip_from_timestamp(
+                        video_url, 
+                        timestamp_data['seconds'], 
+                        clip_duration, 
+                        url_hash, 
+                        i,
+                        social_formats,
+                        subtitles_enabled,
+                        control,
+                        clip_progress,
+                        retry_budget,
+                        subtitle_mode,
+                        preview_enabled,
+                        prime_keyframes
+                    )
+                    span.set(success=bool(clip and clip.get('success')), size_mb=round(clip.get('size_mb', 0), 2) if clip else 0)
+                
+                # Aggiungi descrizione e versione di pubblicazione (per le risposte delta di /api/progress)
+                if clip:
+                    clip['description'] = timestamp_data['description']
+                    clip['version'] = clip_version()
+                
+                # Pubblica subito la clip (risultati parziali) e accodala nello ZIP
+                package.add_clip(clip, i)
+                if clip_callback:
+                    clip_callback(i, clip)
+                
+                clips.append(clip)
+            
+            # Chiudi ZIP: le clip sono già dentro, resta il report
+            if control:
+                control.check()
+            if progress_callback:
+                progress_callback(85, "Finalizzando pacchetto ZIP...")
+            
+            tracer = current_tracer()
+            with trace_span('zip_finalize'):
+                zip_path, successful_count = package.finalize(self.build_report(clips, tracer))
+            
+            if progress_callback:
+                progress_callback(100, "Completato!")
+            self.stage_stats.save(force=True)
+            
+            # Calcola statistiche
+            successful_clips = [c for c in clips if c.get('success')]
+            total_size_mb = 0
+            total_files = 0
+            clips_with_subtitles = 0
+            
+            for clip in successful_clips:
+                if clip.get('social_files'):
+                    total_size_mb += clip.get('size_mb', 0)
+                    total_files += len(clip.get('social_files', []))
+                    if clip.get('has_subtitles'):
+                        clips_with_subtitles += 1
+            
+            return {
+                'success': True,
+                'clips': clips,
+                'successful_clips': len(successful_clips),
+                'total_files': total_files,
+                'total_clips': total_clips,
+                'total_size_mb': total_size_mb,
+                'clips_with_subtitles': clips_with_subtitles,
+                'subtitles_enabled': subtitles_enabled,
+                'subtitle_mode': subtitle_mode or SUBTITLE_MODE,
+                'trace_id': tracer.trace_id if tracer else None,
+                'processing_time': round(time.time() - started_at, 1),
+                'zip_path': zip_path,
+                'zip_filename': os.path.basename(zip_path) if zip_path else None,
+                'download_url': f'/api/download/{task_id}' if zip_path else None
+            }
+            
+        except TaskCancelled:
+            # Nessun pacchetto verrà creato: rimuovi i file delle clip già completate
+            if package:
+                package.discard()
+            if control and control.cleanup != 'all':
+                raise
+            for clip in clips:
+                files = [social_file['file'] for social_file in clip.get('social_files', [])]
+                if clip.get('subtitle_file'):
+                    files.append(clip['subtitle_file']['file'])
+                for path in files:
+                    if os.path.exists(path):
+                        os.remove(path)
+                if clip.get('preview'):
+                    shutil.rmtree(clip['preview']['dir'], ignore_errors=True)
+            raise
+        except Exception as e:
+            if package:
+                package.discard()
+            return {
+                'success': False,
+                'error': str(e)
+            }
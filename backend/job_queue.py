@@ -0,0 +1,341 @@
+# job_queue.py - Coda durevole dei job su SQLite (lease + heartbeat) per worker separati
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from task_store import detach_subscriber
+
+# Stati dei job in coda
+ACTIVE_STATUSES = ('queued', 'running')
+
+# Errore dei job falliti per troppe lease scadute (worker morti durante l'esecuzione)
+EXHAUSTED_ERROR = 'Troppi tentativi (worker persi)'
+
+# Poll del client registrato al massimo ogni N secondi (evita una scrittura per poll)
+POLL_TOUCH_INTERVAL = 10
+
+# Colonne lette dai poll di progresso: niente spec/clips/result, costo indipendente dalla dimensione del job
+POLL_COLUMNS = 'task_id, status, progress, message, updated_at, eta_seconds, error, clips_version, last_poll_at'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    task_id TEXT PRIMARY KEY,
+    job_key TEXT,
+    spec TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    priority INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    worker_id TEXT,
+    lease_expires_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    progress INTEGER NOT NULL DEFAULT 0,
+    message TEXT,
+    clips TEXT NOT NULL DEFAULT '{}',
+    result TEXT,
+    error TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    last_poll_at REAL,
+    eta_seconds REAL,
+    clips_version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs (status, priority, created_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_job_key ON jobs (job_key, status);
+"""
+
+class JobQueue:
+    """Coda job su file SQLite condivisibile da più processi e host"""
+
+    def __init__(self, db_path, max_attempts=3):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+            # Code create da versioni precedenti: aggiunge le colonne mancanti
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            if 'eta_seconds' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN eta_seconds REAL')
+            if 'clips_version' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN clips_version INTEGER NOT NULL DEFAULT 0')
+
+    def _connect(self):
+        # Journal classico (non WAL): WAL non funziona su storage condiviso tra host
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA busy_timeout = 30000')
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        conn = self._connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _row_to_job(self, row):
+        if row is None:
+            return None
+        job = dict(row)
+        job['spec'] = json.loads(job['spec'])
+        job['clips'] = {int(index): clip for index, clip in json.loads(job['clips']).items()}
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        job['cancel_requested'] = bool(job['cancel_requested'])
+        return job
+
+    def enqueue(self, task_id, spec, job_key=None, priority=0):
+        """Accoda un nuovo job"""
+        now = time.time()
+        # ETA iniziale = stima del job: i poll non devono leggere la spec
+        eta_seconds = (spec.get('estimate') or {}).get('wall_seconds')
+        with self._connection() as conn:
+            conn.execute(
+                'INSERT INTO jobs (task_id, job_key, spec, status, priority, created_at, updated_at, message, last_poll_at, eta_seconds) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (task_id, job_key, json.dumps(spec), 'queued', priority, now, now, 'In coda...', now, eta_seconds)
+            )
+
+    def get(self, task_id):
+        with self._connection() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE task_id = ?', (task_id,)).fetchone()
+        return self._row_to_job(row)
+
+    def poll_state(self, task_id):
+        """Stato leggero del job per i poll (registra il poll, al massimo ogni POLL_TOUCH_INTERVAL)"""
+        with self._connection() as conn:
+            row = conn.execute(f'SELECT {POLL_COLUMNS} FROM jobs WHERE task_id = ?', (task_id,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if not row['last_poll_at'] or now - row['last_poll_at'] > POLL_TOUCH_INTERVAL:
+                conn.execute('UPDATE jobs SET last_poll_at = ? WHERE task_id = ?', (now, task_id))
+        return dict(row)
+
+    def find_active(self, job_key):
+        """Task attivo (in coda o in esecuzione) con la stessa spec"""
+        with self._connection() as conn:
+            row = conn.execute(
+                'SELECT task_id FROM jobs WHERE job_key = ? AND status IN (?, ?) AND cancel_requested = 0 '
+                'ORDER BY created_at DESC LIMIT 1',
+                (job_key,) + ACTIVE_STATUSES
+            ).fetchone()
+        return row['task_id'] if row else None
+
+    def fail_exhausted(self):
+        """Job di worker morti oltre il limite di tentativi: falliti definitivamente.
+
+        Ritorna i task_id appena falliti, per notificarli come gli altri stati finali."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            task_ids = [row['task_id'] for row in conn.execute(
+                "SELECT task_id FROM jobs WHERE status = 'running' AND lease_expires_at < ? AND attempts >= ?",
+                (now, self.max_attempts)
+            )]
+            conn.executemany(
+                "UPDATE jobs SET status = 'failed', error = ?, message = ?, lease_expires_at = NULL, updated_at = ? WHERE task_id = ?",
+                [(EXHAUSTED_ERROR, f'Errore: {EXHAUSTED_ERROR}', now, task_id) for task_id in task_ids]
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        return task_ids
+
+    def claim(self, worker_id, lease_seconds, min_priority=None):
+        """Prende in carico il prossimo job (nuovo o con lease scaduta) in modo atomico.
+
+        Con min_priority vengono considerati solo i job di priorità almeno pari
+        (slot riservati ai job interattivi)."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            # I job oltre il limite di tentativi restano a fail_exhausted (che li notifica)
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE cancel_requested = 0 AND "
+                "(status = 'queued' OR (status = 'running' AND lease_expires_at < ? AND attempts < ?)) AND priority >= ? "
+                "ORDER BY priority DESC, created_at ASC LIMIT 1",
+                (now, self.max_attempts, min_priority if min_priority is not None else -2**31)
+            ).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker_id = ?, lease_expires_at = ?, "
+                "attempts = attempts + 1, updated_at = ? WHERE task_id = ?",
+                (worker_id, now + lease_seconds, now, row['task_id'])
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        return self.get(row['task_id'])
+
+    def heartbeat(self, task_id, worker_id, lease_seconds):
+        """Rinnova la lease; ritorna il job o None se la lease è stata persa"""
+        now = time.time()
+        with self._connection() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires_at = ?, updated_at = ? "
+                "WHERE task_id = ? AND worker_id = ? AND status = 'running'",
+                (now + lease_seconds, now, task_id, worker_id)
+            )
+            if cursor.rowcount == 0:
+                return None
+        return self.get(task_id)
+
+    def update_progress(self, task_id, worker_id, progress, message, eta_seconds=None):
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET progress = ?, message = ?, eta_seconds = COALESCE(?, eta_seconds), updated_at = ? "
+                "WHERE task_id = ? AND worker_id = ? AND status = 'running'",
+                (progress, message, eta_seconds, time.time(), task_id, worker_id)
+            )
+
+    def mark_clip(self, task_id, worker_id, clip_index, clip):
+        """Registra il risultato di una clip (usato per riprendere dopo una lease scaduta)"""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT clips FROM jobs WHERE task_id = ? AND worker_id = ?',
+                (task_id, worker_id)
+            ).fetchone()
+            if row is not None:
+                clips = json.loads(row['clips'])
+                clips[str(clip_index)] = clip
+                conn.execute(
+                    'UPDATE jobs SET clips = ?, clips_version = MAX(clips_version, ?), updated_at = ? WHERE task_id = ?',
+                    (json.dumps(clips), (clip or {}).get('version', 0), time.time(), task_id)
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def finish(self, task_id, worker_id, status, result=None, error=None, message=None):
+        """Stato finale del job (completed / failed / cancelled)"""
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, message = COALESCE(?, message), "
+                "progress = CASE WHEN ? = 'completed' THEN 100 ELSE progress END, "
+                "lease_expires_at = NULL, updated_at = ? WHERE task_id = ? AND worker_id = ?",
+                (status, json.dumps(result) if result is not None else None, error, message,
+                 status, time.time(), task_id, worker_id)
+            )
+
+    def release(self, task_id, worker_id):
+        """Rimette in coda un job (es. shutdown del worker), conservando le clip completate"""
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', worker_id = NULL, lease_expires_at = NULL, "
+                "message = 'Rimesso in coda...', updated_at = ? "
+                "WHERE task_id = ? AND worker_id = ? AND status = 'running'",
+                (time.time(), task_id, worker_id)
+            )
+
+    def add_callback(self, task_id, callback_url):
+        """Aggiunge un callback URL alla spec di un job (es. richiesta deduplicata)"""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT spec FROM jobs WHERE task_id = ?', (task_id,)).fetchone()
+            if row is not None:
+                spec = json.loads(row['spec'])
+                callback_urls = spec.setdefault('callback_urls', [])
+                if callback_url not in callback_urls:
+                    callback_urls.append(callback_url)
+                    conn.execute('UPDATE jobs SET spec = ? WHERE task_id = ?', (json.dumps(spec), task_id))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def _update_spec(self, task_id, update):
+        """Modifica la spec di un job in una transazione; ritorna il valore di update(spec)"""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT spec FROM jobs WHERE task_id = ?', (task_id,)).fetchone()
+            outcome = None
+            if row is not None:
+                spec = json.loads(row['spec'])
+                outcome = update(spec)
+                conn.execute('UPDATE jobs SET spec = ? WHERE task_id = ?', (json.dumps(spec), task_id))
+            conn.execute('COMMIT')
+            return outcome
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def add_subscriber(self, task_id, subscriber_id):
+        """Registra un richiedente agganciato al job (richiesta deduplicata)"""
+        self._update_spec(task_id, lambda spec: spec.setdefault('subscribers', []).append(subscriber_id))
+
+    def remove_subscriber(self, task_id, subscriber_id):
+        """Stacca un richiedente; ritorna quanti ne restano (None se non autorizzato)"""
+        return self._update_spec(task_id, lambda spec: detach_subscriber(spec.setdefault('subscribers', []), subscriber_id))
+
+    def request_cancel(self, task_id):
+        """Richiede l'annullamento; i job ancora in coda vengono annullati subito"""
+        now = time.time()
+        with self._connection() as conn:
+            queued = conn.execute(
+                "UPDATE jobs SET status = 'cancelled', cancel_requested = 1, "
+                "message = 'Annullato: Annullato dall''utente', updated_at = ? "
+                "WHERE task_id = ? AND status = 'queued'",
+                (now, task_id)
+            ).rowcount
+            running = conn.execute(
+                "UPDATE jobs SET cancel_requested = 1, message = 'Annullamento in corso...', updated_at = ? "
+                "WHERE task_id = ? AND status = 'running'",
+                (now, task_id)
+            ).rowcount
+        return queued + running > 0
+
+    def progress_data(self, job):
+        """Converte un job (completo o da poll_state) nel formato di /api/progress"""
+        status = {'queued': 'starting', 'running': 'processing'}.get(job['status'], job['status'])
+        data = {
+            'progress': job['progress'],
+            'message': job['message'],
+            'status': status,
+            'updated_at': datetime.fromtimestamp(job['updated_at']).isoformat()
+        }
+        if job['status'] in ACTIVE_STATUSES:
+            data['eta_seconds'] = job['eta_seconds']
+            # Job accodati da versioni precedenti: ETA solo nella stima della spec
+            if data['eta_seconds'] is None and job.get('spec'):
+                data['eta_seconds'] = (job['spec'].get('estimate') or {}).get('wall_seconds')
+        if job['error']:
+            data['error'] = job['error']
+        return data
+
+    def backlog_seconds(self):
+        """Secondi di lavoro stimati per i job attivi (ETA se in esecuzione, stima se in coda)"""
+        with self._connection() as conn:
+            rows = conn.execute(
+                'SELECT spec, eta_seconds FROM jobs WHERE status IN (?, ?) AND cancel_requested = 0',
+                ACTIVE_STATUSES
+            ).fetchall()
+        total = 0.0
+        for row in rows:
+            if row['eta_seconds'] is not None:
+                total += row['eta_seconds']
+            else:
+                total += json.loads(row['spec']).get('estimate', {}).get('wall_seconds') or 0
+        return total
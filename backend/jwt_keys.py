@@ -0,0 +1,283 @@
+# jwt_keys.py - Token JWT firmati RS256: chiavi con rotazione, JWKS pubblicato e verifica locale
+#
+# Il servizio di autenticazione (auth_app.py, o app.py in deployment unico) firma i
+# token con la chiave privata attiva e pubblica le chiavi pubbliche su
+# /api/auth/.well-known/jwks.json. Il video service in deployment separato
+# (JWT_JWKS_URL impostato) scarica il JWKS, lo tiene in cache e verifica i token in
+# locale: nessuna query al database né chiamata di rete per richiesta.
+#
+# Rotazione: `python jwt_keys.py rotate`, oppure automatica quando la chiave attiva
+# supera JWT_KEY_ROTATION_DAYS (controllata all'avvio e a ogni ricarica periodica
+# del keyring, anche nei processi di lunga durata). Le chiavi precedenti restano
+# pubblicate finché possono esistere refresh token firmati con esse.
+#
+# Le chiavi private non sono cifrate: la directory sta fuori dal sorgente
+# (default ~/.maat/jwt_keys) ed è leggibile solo dal processo (0700/0600).
+import os
+import json
+import time
+import uuid
+import fcntl
+import threading
+from datetime import timedelta
+
+import jwt
+import requests
+from jwt.algorithms import RSAAlgorithm
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from flask import jsonify
+
+from structured_log import get_logger
+
+logger = get_logger('jwt_keys')
+
+JWT_KEYS_DIR = os.getenv('JWT_KEYS_DIR', os.path.join(os.path.expanduser('~'), '.maat', 'jwt_keys'))
+JWT_JWKS_URL = os.getenv('JWT_JWKS_URL', '')  # impostato solo sul video service separato
+JWT_ISSUER = os.getenv('JWT_ISSUER', 'maat-auth')
+JWT_ACCESS_MINUTES = int(os.getenv('JWT_ACCESS_MINUTES', '15'))
+JWT_REFRESH_DAYS = int(os.getenv('JWT_REFRESH_DAYS', '30'))
+JWT_KEY_ROTATION_DAYS = int(os.getenv('JWT_KEY_ROTATION_DAYS', '30'))  # 0 = solo rotazione manuale
+JWKS_CACHE_SECONDS = int(os.getenv('JWKS_CACHE_SECONDS', '300'))
+JWKS_MIN_REFRESH_SECONDS = 30  # kid sconosciuti: al massimo un download ogni 30s
+KEYRING_RELOAD_SECONDS = 60
+JWKS_PATH = '/api/auth/.well-known/jwks.json'
+
+class KeyRing:
+    """Chiavi RSA del servizio che firma i token (una PEM per kid nella directory)"""
+
+    def __init__(self, keys_dir=JWT_KEYS_DIR):
+        self.keys_dir = keys_dir
+        self.private_keys = {}
+        self.created_at = {}
+        self.active_kid = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Carica le chiavi; la più recente è quella attiva"""
+        os.makedirs(self.keys_dir, mode=0o700, exist_ok=True)
+        private_keys, created_at = {}, {}
+        for filename in os.listdir(self.keys_dir):
+            if not filename.endswith('.pem'):
+                continue
+            kid = filename[:-len('.pem')]
+            path = os.path.join(self.keys_dir, filename)
+            try:
+                with open(path, 'rb') as f:
+                    private_keys[kid] = serialization.load_pem_private_key(f.read(), password=None)
+                created_at[kid] = os.path.getmtime(path)
+            except (OSError, ValueError) as e:
+                logger.warning(f"⚠️ Chiave JWT {filename} non leggibile: {e}")
+        with self._lock:
+            self.private_keys, self.created_at = private_keys, created_at
+            self.active_kid = max(created_at, key=created_at.get) if created_at else None
+            self._loaded_at = time.time()
+
+    def rotation_due(self):
+        """True se manca una chiave attiva o se è più vecchia di JWT_KEY_ROTATION_DAYS"""
+        if not self.active_kid:
+            return True
+        age_days = (time.time() - self.created_at[self.active_kid]) / 86400
+        return bool(JWT_KEY_ROTATION_DAYS) and age_days > JWT_KEY_ROTATION_DAYS
+
+    def ensure_keys(self):
+        """Carica le chiavi, creandone una se non ce ne sono o se l'attiva è da ruotare"""
+        os.makedirs(self.keys_dir, mode=0o700, exist_ok=True)
+        # Più worker gunicorn all'avvio: uno solo crea la chiave, gli altri la caricano
+        with open(os.path.join(self.keys_dir, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self.load()
+                if self.rotation_due():
+                    self.rotate()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def rotate(self):
+        """Nuova chiave attiva; rimuove quelle più vecchie della vita massima di un refresh token"""
+        kid = f"{time.strftime('%Y%m%d')}-{uuid.uuid4().hex[:8]}"
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        pem = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        )
+        os.makedirs(self.keys_dir, mode=0o700, exist_ok=True)
+        path = os.path.join(self.keys_dir, f"{kid}.pem")
+        fd = os.open(f"{path}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pem)
+        os.replace(f"{path}.tmp", path)
+        logger.info(f"🔑 Nuova chiave JWT attiva: {kid}")
+
+        self.load()
+        self.retire_expired()
+        return kid
+
+    def retire_expired(self):
+        """Rimuove le chiavi che non firmano più da oltre la vita massima di un refresh token"""
+        kids = sorted(self.created_at, key=self.created_at.get)
+        cutoff = time.time() - JWT_REFRESH_DAYS * 86400
+        for old_kid, next_kid in zip(kids, kids[1:]):
+            # Ha smesso di firmare quando è stata creata la chiave successiva
+            if self.created_at[next_kid] < cutoff:
+                try:
+                    os.remove(os.path.join(self.keys_dir, f"{old_kid}.pem"))
+                    logger.info(f"🗑️ Chiave JWT ritirata: {old_kid}")
+                except OSError:
+                    pass
+        self.load()
+
+    def _maybe_reload(self, kid=None):
+        # Altri processi (worker gunicorn, rotazione da CLI) possono aver aggiunto chiavi
+        since_load = time.time() - self._loaded_at
+        if since_load > KEYRING_RELOAD_SECONDS or (kid and kid not in self.private_keys and since_load > 5):
+            self.load()
+            # Processo in vita da più di JWT_KEY_ROTATION_DAYS: rotazione senza riavvio
+            # (sotto lock, un solo processo crea la nuova chiave)
+            if self.rotation_due():
+                self.ensure_keys()
+
+    def signing_key(self):
+        """(kid, chiave privata) per firmare"""
+        self._maybe_reload()
+        with self._lock:
+            if not self.active_kid:
+                raise RuntimeError('Nessuna chiave JWT disponibile')
+            return self.active_kid, self.private_keys[self.active_kid]
+
+    def public_key(self, kid):
+        self._maybe_reload(kid)
+        with self._lock:
+            key = self.private_keys.get(kid)
+        return key.public_key() if key else None
+
+    def jwks(self):
+        """Chiavi pubbliche in formato JWKS"""
+        self._maybe_reload()
+        with self._lock:
+            keys = dict(self.private_keys)
+        entries = []
+        for kid, key in sorted(keys.items()):
+            entry = json.loads(RSAAlgorithm.to_jwk(key.public_key()))
+            entry.update({'kid': kid, 'use': 'sig', 'alg': 'RS256'})
+            entries.append(entry)
+        return {'keys': entries}
+
+class JwksCache:
+    """JWKS del servizio di autenticazione in cache, per verificare i token in locale"""
+
+    def __init__(self, url=JWT_JWKS_URL, ttl=JWKS_CACHE_SECONDS):
+        self.url = url
+        self.ttl = ttl
+        self.keys = {}
+        self._fetched_at = 0
+        self._attempted_at = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Scarica il JWKS; in caso di errore restano valide le chiavi già note"""
+        self._attempted_at = time.time()
+        try:
+            response = requests.get(self.url, timeout=5)
+            response.raise_for_status()
+            keys = {entry['kid']: RSAAlgorithm.from_jwk(json.dumps(entry)) for entry in response.json().get('keys', [])}
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logger.warning(f"⚠️ JWKS non aggiornato da {self.url}: {e}")
+            return
+        with self._lock:
+            self.keys = keys
+            self._fetched_at = time.time()
+
+    def public_key(self, kid):
+        stale = time.time() - self._fetched_at > self.ttl
+        unknown = kid not in self.keys
+        # kid sconosciuto = probabile rotazione: nuovo download, ma al massimo uno ogni 30s
+        # (anche con il servizio di autenticazione irraggiungibile)
+        if (stale or unknown) and time.time() - self._attempted_at > JWKS_MIN_REFRESH_SECONDS:
+            self.refresh()
+        with self._lock:
+            return self.keys.get(kid)
+
+def configure_jwt(app, jwt_manager):
+    """Configura firma/verifica RS256 per l'app; ritorna 'issuer' o 'verifier'.
+
+    issuer: firma con le chiavi locali e pubblica il JWKS (servizio di autenticazione).
+    verifier: solo verifica, con le chiavi scaricate da JWT_JWKS_URL."""
+    app.config['JWT_ALGORITHM'] = 'RS256'
+    app.config['JWT_DECODE_ALGORITHMS'] = ['RS256']
+    app.config['JWT_ENCODE_ISSUER'] = JWT_ISSUER
+    app.config['JWT_DECODE_ISSUER'] = JWT_ISSUER
+    app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(minutes=JWT_ACCESS_MINUTES)
+    app.config['JWT_REFRESH_TOKEN_EXPIRES'] = timedelta(days=JWT_REFRESH_DAYS)
+
+    role = 'verifier' if JWT_JWKS_URL else 'issuer'
+    if role == 'issuer':
+        keyring = KeyRing()
+        keyring.ensure_keys()
+        public_key = keyring.public_key
+
+        @jwt_manager.encode_key_loader
+        def encode_key(identity):
+            return keyring.signing_key()[1]
+
+        @jwt_manager.additional_headers_loader
+        def token_headers(identity):
+            return {'kid': keyring.signing_key()[0]}
+
+        @app.route(JWKS_PATH, methods=['GET'])
+        def jwks():
+            """Chiavi pubbliche per la verifica dei token (cacheabili)"""
+            response = jsonify(keyring.jwks())
+            response.headers['Cache-Control'] = f'public, max-age={JWKS_CACHE_SECONDS}'
+            return response
+
+        app.extensions['maat_keyring'] = keyring
+    else:
+        public_key = JwksCache().public_key
+
+    @jwt_manager.decode_key_loader
+    def decode_key(jwt_header, jwt_payload):
+        key = public_key(jwt_header.get('kid'))
+        if key is None:
+            raise jwt.DecodeError('Chiave di firma sconosciuta')
+        return key
+
+    @jwt_manager.expired_token_loader
+    def expired_token_callback(jwt_header, jwt_payload):
+        return jsonify({
+            'success': False,
+            'error': 'Token scaduto'
+        }), 401
+
+    @jwt_manager.invalid_token_loader
+    def invalid_token_callback(error):
+        return jsonify({
+            'success': False,
+            'error': 'Token non valido'
+        }), 401
+
+    @jwt_manager.unauthorized_loader
+    def missing_token_callback(error):
+        return jsonify({
+            'success': False,
+            'error': 'Token mancante'
+        }), 401
+
+    logger.info(f"🔐 JWT RS256 ({role}), access {JWT_ACCESS_MINUTES} min, refresh {JWT_REFRESH_DAYS} giorni")
+    return role
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Gestione chiavi JWT del servizio di autenticazione')
+    parser.add_argument('command', choices=['rotate', 'list'])
+    parser.add_argument('--keys-dir', default=JWT_KEYS_DIR)
+    args = parser.parse_args()
+    keyring = KeyRing(args.keys_dir)
+    keyring.load()
+    if args.command == 'rotate':
+        keyring.rotate()
+    for kid in sorted(keyring.created_at, key=keyring.created_at.get):
+        marker = '*' if kid == keyring.active_kid else ' '
+        print(f"{marker} {kid}  creata {time.strftime('%Y-%m-%d %H:%M', time.localtime(keyring.created_at[kid]))}")
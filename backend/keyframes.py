@@ -0,0 +1,147 @@
+# keyframes.py - Indice dei keyframe per sorgente, per tagli con seek preciso
+import os
+import json
+import bisect
+import hashlib
+import threading
+from urllib.parse import urlsplit, urlunsplit
+from task_control import run_command
+from structured_log import get_logger, truncate_output
+
+logger = get_logger('keyframes')
+
+def source_key(video_url):
+    """Chiave della sorgente nell'indice persistente: SHA-256 completo dell'URL normalizzato.
+
+    Non l'hash corto dei nomi file: una collisione taglierebbe la clip sui keyframe di
+    un'altra sorgente, e l'indice sopravvive ai riavvii."""
+    parts = urlsplit(video_url.strip())
+    normalized = urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ''))
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+def merge_ranges(ranges):
+    """Unisce le finestre sovrapposte (ordinate per inizio)"""
+    merged = []
+    for low, high in sorted(ranges):
+        if merged and low <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], high)
+        else:
+            merged.append([low, high])
+    return merged
+
+class KeyframeIndex:
+    """Keyframe noti per sorgente (source_key), probati per finestre e persistiti su disco.
+
+    Per ogni punto di taglio serve solo il keyframe precedente: invece di leggere
+    l'intera sorgente, ffprobe legge i pacchetti (senza decodificare) nelle finestre
+    [t - lookbehind, t] di tutte le clip, in una sola esecuzione per sorgente."""
+
+    def __init__(self, cache_dir, lookbehind=20):
+        self.cache_dir = cache_dir
+        self.lookbehind = lookbehind
+        self._cache = {}  # source_key -> {'keyframes': [...], 'ranges': [[lo, hi], ...]}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, source_key):
+        return os.path.join(self.cache_dir, f"{source_key}.json")
+
+    def _get(self, source_key):
+        with self._lock:
+            if source_key not in self._cache:
+                try:
+                    with open(self._path(source_key), encoding='utf-8') as f:
+                        data = json.load(f)
+                    data['ranges'] = merge_ranges(data['ranges'])
+                    self._cache[source_key] = data
+                except (OSError, ValueError):
+                    self._cache[source_key] = {'keyframes': [], 'ranges': []}
+            return self._cache[source_key]
+
+    def _merge(self, source_key, keyframes, ranges):
+        data = self._get(source_key)
+        with self._lock:
+            data['keyframes'] = sorted(set(data['keyframes']) | set(keyframes))
+            data['ranges'] = merge_ranges(data['ranges'] + ranges)
+            tmp_path = f"{self._path(source_key)}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self._path(source_key))
+
+    def lookup(self, source_key, time_point):
+        """Keyframe più vicino che precede time_point, se la finestra è già stata probata"""
+        data = self._get(source_key)
+        keyframes = data['keyframes']
+        position = bisect.bisect_right(keyframes, time_point + 1e-3)
+        if position == 0:
+            return None
+        keyframe = keyframes[position - 1]
+        # Valido solo se nessun keyframe intermedio può essere sfuggito: le finestre
+        # sono unite e ordinate, basta quella che inizia per ultima prima del keyframe
+        ranges = data['ranges']
+        position = bisect.bisect_right(ranges, [keyframe, float('inf')])
+        if position and ranges[position - 1][1] >= time_point:
+            return keyframe
+        return None
+
+    def prime(self, source_key, source, time_points):
+        """Proba in un solo passaggio le finestre dei punti di taglio non ancora coperti"""
+        missing = [t for t in time_points if self.lookup(source_key, t) is None]
+        if not missing or not source:
+            return
+        ranges = [[max(0, t - self.lookbehind), t + 0.1] for t in sorted(set(missing))]
+
+        base_cmd = ['ffprobe', '-v', 'error']
+        headers = ''.join(f"{name}: {value}\r\n" for name, value in source.get('headers', {}).items())
+        if headers:
+            base_cmd += ['-headers', headers]
+
+        # ffprobe lavora su timestamp assoluti, ffmpeg -ss su tempi relativi a start_time
+        probe = run_command(base_cmd + ['-show_entries', 'format=start_time', '-of', 'json', source['url']], timeout=60)
+        try:
+            stream_start = float(json.loads(probe.stdout)['format'].get('start_time') or 0)
+        except (ValueError, KeyError):
+            logger.warning(f"⚠️ Probe sorgente fallito: {truncate_output(probe.stderr)}")
+            return
+
+        intervals = ','.join(f"{low + stream_start:.3f}%{high + stream_start:.3f}" for low, high in ranges)
+        result = run_command(base_cmd + [
+            '-select_streams', 'v:0',
+            '-read_intervals', intervals,
+            '-show_entries', 'packet=pts_time,flags',
+            '-of', 'json',
+            source['url']
+        ], timeout=120)
+        if result.returncode != 0:
+            logger.warning(f"⚠️ Probe keyframe fallito: {truncate_output(result.stderr)}")
+            return
+
+        keyframes = []
+        try:
+            packets = json.loads(result.stdout).get('packets', [])
+        except ValueError:
+            packets = []
+        for packet in packets:
+            if 'K' in packet.get('flags', '') and packet.get('pts_time') is not None:
+                keyframes.append(round(float(packet['pts_time']) - stream_start, 3))
+        self._merge(source_key, keyframes, ranges)
+        logger.info(f"🔑 Indice keyframe: {len(keyframes)} keyframe in {len(ranges)} finestre")
+
+    def plan_cut(self, source_key, start_time, duration):
+        """Finestra da scaricare: dal keyframe precedente (stream copy esatto) e
+        offset da scartare in decodifica. Senza keyframe noto: seek classico."""
+        keyframe = self.lookup(source_key, start_time)
+        if keyframe is None:
+            return {
+                'keyframe_aligned': False,
+                'fetch_start': start_time,
+                'fetch_duration': duration,
+                'trim_offset': 0
+            }
+        trim_offset = round(start_time - keyframe, 3)
+        return {
+            'keyframe_aligned': True,
+            'fetch_start': keyframe,
+            'fetch_duration': trim_offset + duration,
+            'trim_offset': trim_offset
+        }
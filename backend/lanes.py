@@ -0,0 +1,105 @@
+# lanes.py - Corsie di priorità: job interattivi (poche clip) e job bulk (export lunghi)
+#
+# I job piccoli non devono attendere dietro un export da 100 marker: una parte degli
+# slot di esecuzione è riservata alla corsia interattiva, i job bulk usano solo la
+# capacità restante e i loro processi ffmpeg/yt-dlp girano con niceness più alta.
+import os
+import time
+import threading
+
+from structured_log import get_logger
+
+logger = get_logger('lanes')
+
+PRIORITY_CLASSES = ('interactive', 'bulk')
+
+# Job interattivo se entro entrambe le soglie (salvo priorità esplicita nella richiesta)
+INTERACTIVE_MAX_CLIPS = int(os.getenv('INTERACTIVE_MAX_CLIPS', '3'))
+INTERACTIVE_MAX_MEDIA_SECONDS = int(os.getenv('INTERACTIVE_MAX_MEDIA_SECONDS', '300'))
+
+# Niceness dei processi figli per corsia (valori negativi richiedono privilegi)
+LANE_NICE = {
+    'interactive': int(os.getenv('INTERACTIVE_NICE', '0')),
+    'bulk': int(os.getenv('BULK_NICE', '10'))
+}
+
+# Priorità nella coda SQLite (claim ordinato per priorità decrescente)
+LANE_QUEUE_PRIORITY = {
+    'interactive': 10,
+    'bulk': 0
+}
+
+def classify_job(clip_count, clip_duration, requested=None):
+    """Corsia del job: quella richiesta esplicitamente o dedotta dalla dimensione"""
+    if requested in PRIORITY_CLASSES:
+        return requested
+    if clip_count <= INTERACTIVE_MAX_CLIPS and clip_count * clip_duration <= INTERACTIVE_MAX_MEDIA_SECONDS:
+        return 'interactive'
+    return 'bulk'
+
+class LaneScheduler:
+    """Slot di esecuzione condivisi con una quota riservata alla corsia interattiva.
+
+    - interattivi: partono se c'è uno slot libero qualsiasi
+    - bulk: al massimo total_slots - reserved_interactive in esecuzione, e mai
+      davanti a un interattivo in attesa"""
+
+    def __init__(self, total_slots, reserved_interactive=1):
+        self.total_slots = max(1, total_slots)
+        self.reserved_interactive = min(max(0, reserved_interactive), self.total_slots - 1)
+        self.running = {lane: 0 for lane in PRIORITY_CLASSES}
+        self.waiting = {lane: 0 for lane in PRIORITY_CLASSES}
+        self.wait_seconds = {lane: 0.0 for lane in PRIORITY_CLASSES}
+        self.started = {lane: 0 for lane in PRIORITY_CLASSES}
+        self._condition = threading.Condition()
+
+    def _can_start(self, lane):
+        total_running = sum(self.running.values())
+        if total_running >= self.total_slots:
+            return False
+        if lane == 'interactive':
+            return True
+        return self.waiting['interactive'] == 0 and self.running['bulk'] < self.total_slots - self.reserved_interactive
+
+    def acquire(self, lane, control=None, on_wait=None):
+        """Attende uno slot per la corsia (TaskCancelled se il task viene annullato in attesa)"""
+        started = time.time()
+        with self._condition:
+            self.waiting[lane] += 1
+            try:
+                notified = False
+                while not self._can_start(lane):
+                    if not notified and on_wait:
+                        on_wait()
+                        notified = True
+                    self._condition.wait(timeout=1)
+                    if control:
+                        control.check()
+            finally:
+                self.waiting[lane] -= 1
+            self.running[lane] += 1
+            self.started[lane] += 1
+            self.wait_seconds[lane] += time.time() - started
+        if time.time() - started > 1:
+            logger.info(f"🚦 Slot {lane} ottenuto dopo {time.time() - started:.1f}s di attesa")
+
+    def release(self, lane):
+        with self._condition:
+            self.running[lane] -= 1
+            self._condition.notify_all()
+
+    def snapshot(self):
+        with self._condition:
+            return {
+                'total_slots': self.total_slots,
+                'reserved_interactive': self.reserved_interactive,
+                'lanes': {
+                    lane: {
+                        'running': self.running[lane],
+                        'waiting': self.waiting[lane],
+                        'started': self.started[lane],
+                        'avg_wait_seconds': round(self.wait_seconds[lane] / self.started[lane], 2) if self.started[lane] else 0
+                    }
+                    for lane in PRIORITY_CLASSES
+                }
+            }
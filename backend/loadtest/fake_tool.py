@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# fake_tool.py - Sostituto locale di yt-dlp / ffmpeg / ffprobe per il load test
+#
+# Il comportamento dipende dal nome con cui viene invocato (symlink creati da run.py).
+# Latenza, dimensione output e tasso di errore sono regolabili da variabili ambiente:
+#   FAKE_YTDLP_LATENCY, FAKE_FFMPEG_LATENCY (secondi), FAKE_OUTPUT_MB, FAKE_FAILURE_RATE (0-1)
+import os
+import sys
+import json
+import random
+import threading
+import time
+
+YTDLP_LATENCY = float(os.getenv('FAKE_YTDLP_LATENCY', '1'))
+FFMPEG_LATENCY = float(os.getenv('FAKE_FFMPEG_LATENCY', '2'))
+OUTPUT_MB = float(os.getenv('FAKE_OUTPUT_MB', '2'))
+FAILURE_RATE = float(os.getenv('FAKE_FAILURE_RATE', '0'))
+STEPS = 10
+
+def option_value(args, name, default=None):
+    """Valore dell'ultima occorrenza di un'opzione (es. -t 60)"""
+    value = default
+    for index, arg in enumerate(args[:-1]):
+        if arg == name:
+            value = args[index + 1]
+    return value
+
+def maybe_fail(tool):
+    if random.random() < FAILURE_RATE:
+        sys.stderr.write(f"{tool}: errore simulato\n")
+        sys.exit(1)
+
+def write_gradually(path, total_bytes, latency):
+    """Scrive il file a blocchi distribuiti sulla latenza (la crescita conta come progresso)"""
+    chunk = b'\0' * max(1, int(total_bytes / STEPS))
+    with open(path, 'wb') as f:
+        for _ in range(STEPS):
+            time.sleep(latency / STEPS)
+            f.write(chunk)
+            f.flush()
+
+def fake_ytdlp(args):
+    if '--version' in args:
+        print('2023.10.13 (fake)')
+        return
+    maybe_fail('yt-dlp')
+    if '-g' in args:
+        time.sleep(YTDLP_LATENCY / 4)
+        print('http://127.0.0.1:9/fake-stream.mp4')
+        return
+    output = option_value(args, '-o')
+    total_bytes = int(OUTPUT_MB * 1024 * 1024)
+    if output == '-':
+        chunk = b'\0' * max(1, int(total_bytes / STEPS))
+        for _ in range(STEPS):
+            time.sleep(YTDLP_LATENCY / STEPS)
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+        return
+    # Come yt-dlp con downloader ffmpeg: scrive su .part e rinomina alla fine
+    write_gradually(output + '.part', total_bytes, YTDLP_LATENCY)
+    os.replace(output + '.part', output)
+
+def ffmpeg_outputs(args):
+    """File di output: argomento dopo ogni -y, oppure l'ultimo argomento"""
+    outputs = [args[index + 1] for index, arg in enumerate(args[:-1]) if arg == '-y']
+    if not outputs and args and args[-1] not in ('-', 'pipe:1'):
+        outputs.append(args[-1])
+    return outputs
+
+def fake_ffmpeg(args):
+    maybe_fail('ffmpeg')
+    duration = float(option_value(args, '-t', '60'))
+    outputs = ffmpeg_outputs(args)
+    progress = '-progress' in args
+    total_bytes = int(OUTPUT_MB * 1024 * 1024)
+
+    # Input da pipe (yt-dlp -o - | ffmpeg -i pipe:0): consuma lo stream del producer
+    if 'pipe:0' in args:
+        threading.Thread(target=lambda: sys.stdin.buffer.read(), daemon=True).start()
+
+    for step in range(1, STEPS + 1):
+        time.sleep(FFMPEG_LATENCY / STEPS)
+        if progress:
+            sys.stdout.write(
+                f"frame={step * 30}\nout_time_us={int(duration * step / STEPS * 1_000_000)}\n"
+                f"total_size={int(total_bytes * step / STEPS)}\nspeed=1x\n"
+                f"progress={'end' if step == STEPS else 'continue'}\n"
+            )
+            sys.stdout.flush()
+
+    for output in outputs:
+        directory = os.path.dirname(output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if output.endswith('.m3u8'):
+            segment = os.path.join(directory, 'segment_000.ts')
+            with open(segment, 'wb') as f:
+                f.write(b'\0' * 1024)
+            with open(output, 'w') as f:
+                f.write(f"#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:{int(duration)}\n"
+                        f"#EXT-X-PLAYLIST-TYPE:VOD\n#EXTINF:{duration:.3f},\nsegment_000.ts\n#EXT-X-ENDLIST\n")
+        elif output.endswith('.jpg'):
+            with open(output, 'wb') as f:
+                f.write(b'\xff\xd8\xff\xd9')
+        else:
+            with open(output, 'wb') as f:
+                f.write(b'\0' * total_bytes)
+    if '-lavfi' in args:
+        sys.stderr.write('SSIM Y:0.98 U:0.99 V:0.99 All:0.985000 (18.2)\n')
+
+def fake_ffprobe(args):
+    maybe_fail('ffprobe')
+    entries = option_value(args, '-show_entries', '')
+    if entries.startswith('packet'):
+        # Keyframe ogni 2 secondi nelle finestre richieste
+        packets = []
+        for interval in option_value(args, '-read_intervals', '').split(','):
+            if '%' not in interval:
+                continue
+            low, high = (float(value) for value in interval.split('%'))
+            t = low - (low % 2)
+            while t <= high:
+                packets.append({'pts_time': f'{t:.6f}', 'flags': 'K__'})
+                t += 2
+        print(json.dumps({'packets': packets}))
+    elif 'start_time' in entries:
+        print(json.dumps({'format': {'start_time': '0.000000'}}))
+    else:
+        print('60.000000')
+
+def main():
+    tool = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+    if tool == 'yt-dlp':
+        fake_ytdlp(args)
+    elif tool == 'ffmpeg':
+        fake_ffmpeg(args)
+    elif tool == 'ffprobe':
+        fake_ffprobe(args)
+    else:
+        sys.stderr.write(f"fake_tool: strumento sconosciuto {tool}\n")
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main()
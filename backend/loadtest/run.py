@@ -0,0 +1,318 @@
+# run.py - Load test HTTP dell'API con yt-dlp/ffmpeg/Whisper simulati
+#
+# Uso (dalla cartella backend):
+#   python loadtest/run.py --users 20 --iterations 3 --ffmpeg-latency 2 --output-mb 5
+#   python loadtest/run.py --base-url http://staging:8000 --users 5   # server già avviato
+#
+# Senza --base-url avvia l'app in una directory temporanea con PATH puntato ai finti
+# yt-dlp/ffmpeg/ffprobe (fake_tool.py) e OPENAI_BASE_URL sullo stub di trascrizione.
+# Ogni utente virtuale: registrazione, login, verifica token, poi per ogni iterazione
+# estrazione -> polling progresso -> download ZIP. Report: percentili di latenza per
+# endpoint, throughput e tassi di errore.
+# Con --webhooks i job passano un callback_url e l'utente attende il webhook firmato
+# (ricevitore locale) invece di interrogare /api/progress.
+import os
+import sys
+import json
+import math
+import shutil
+import socket
+import argparse
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+from stub_transcription import start_stub_server
+from webhook_receiver import start_webhook_receiver
+
+LOADTEST_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(LOADTEST_DIR)
+FAKE_TOOLS = ('yt-dlp', 'ffmpeg', 'ffprobe')
+FINAL_STATUSES = ('completed', 'failed', 'cancelled')
+WEBHOOK_SECRET = 'loadtest-webhook-secret'
+
+class Metrics:
+    """Latenze ed esiti per endpoint, condivisi dagli utenti virtuali"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.status_codes = defaultdict(lambda: defaultdict(int))
+        self.jobs = defaultdict(int)
+        self.job_durations = []
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, latency, status_code=None, error=False):
+        with self._lock:
+            self.latencies[endpoint].append(latency)
+            self.status_codes[endpoint][status_code or 'exception'] += 1
+            if error:
+                self.errors[endpoint] += 1
+
+    def record_job(self, status, duration):
+        with self._lock:
+            self.jobs[status] += 1
+            if status == 'completed':
+                self.job_durations.append(duration)
+
+def percentile(values, p):
+    """Percentile nearest-rank"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+def timed_request(session, metrics, endpoint, method, url, **kwargs):
+    """Esegue una richiesta registrandone latenza ed esito; None se fallisce la connessione"""
+    started = time.perf_counter()
+    try:
+        response = session.request(method, url, timeout=60, **kwargs)
+        if kwargs.get('stream'):
+            for _ in response.iter_content(chunk_size=1024 * 1024):
+                pass
+    except requests.RequestException:
+        metrics.record(endpoint, time.perf_counter() - started, error=True)
+        return None
+    metrics.record(endpoint, time.perf_counter() - started, response.status_code, response.status_code >= 400)
+    return response
+
+def build_timestamps(count, clip_duration):
+    """Timestamp in formato Stream Time Marker distanziati di una clip"""
+    lines = []
+    for index in range(count):
+        seconds = (index + 1) * clip_duration + 30
+        lines.append(f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d} Stream Time Marker - Evento {index + 1}")
+    return '\n'.join(lines)
+
+def virtual_user(user_index, args, metrics, inbox=None):
+    """Scenario di un utente: autenticazione e N estrazioni complete"""
+    session = requests.Session()
+    base_url = args.base_url
+    email = f"loadtest-{uuid.uuid4().hex[:10]}@example.com"
+    credentials = {'email': email, 'username': email.split('@')[0], 'password': 'LoadTest1234'}
+
+    timed_request(session, metrics, 'POST /api/auth/register', 'POST', f"{base_url}/api/auth/register", json=credentials)
+    response = timed_request(session, metrics, 'POST /api/auth/login', 'POST', f"{base_url}/api/auth/login",
+                             json={'email': email, 'password': credentials['password']})
+    token = response.json().get('access_token') if response is not None and response.ok else None
+    if token:
+        timed_request(session, metrics, 'GET /api/auth/verify-token', 'GET', f"{base_url}/api/auth/verify-token",
+                      headers={'Authorization': f"Bearer {token}"})
+
+    for iteration in range(args.iterations):
+        # URL diversi per utente/iterazione: niente deduplicazione single-flight (salvo --same-video)
+        video_id = 'loadtest' if args.same_video else f"user{user_index}-it{iteration}"
+        payload = {
+            'video_url': f"https://www.youtube.com/watch?v={video_id}",
+            'timestamps_input': build_timestamps(args.clips, args.clip_duration),
+            'clip_duration': args.clip_duration,
+            'social_formats': {name: True for name in args.formats.split(',')},
+            'subtitles_enabled': args.subtitles
+        }
+        if inbox:
+            payload['callback_url'] = args.callback_url
+        started = time.time()
+        response = timed_request(session, metrics, 'POST /api/extract-clips', 'POST', f"{base_url}/api/extract-clips", json=payload)
+        if response is None or not response.ok:
+            metrics.record_job('rejected', time.time() - started)
+            continue
+        task_id = response.json()['task_id']
+
+        status = None
+        if inbox:
+            delivered = inbox.wait(task_id, args.job_timeout)
+            status = delivered['status'] if delivered else 'timeout'
+        while status is None and time.time() - started < args.job_timeout:
+            time.sleep(args.poll_interval)
+            response = timed_request(session, metrics, 'GET /api/progress/<task_id>', 'GET', f"{base_url}/api/progress/{task_id}")
+            if response is None or not response.ok:
+                continue
+            status = response.json().get('status')
+            if status not in FINAL_STATUSES:
+                status = None
+        status = status or 'timeout'
+        metrics.record_job(status, time.time() - started)
+
+        if status == 'completed':
+            timed_request(session, metrics, 'GET /api/download/<task_id>', 'GET', f"{base_url}/api/download/{task_id}", stream=True)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_app(args, work_dir, stub_port):
+    """Avvia l'app in work_dir con gli strumenti finti nel PATH"""
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+    for tool in FAKE_TOOLS:
+        os.symlink(os.path.join(LOADTEST_DIR, 'fake_tool.py'), os.path.join(bin_dir, tool))
+
+    port = args.port or free_port()
+    env = dict(os.environ)
+    env.update({
+        'PATH': f"{bin_dir}{os.pathsep}{env.get('PATH', '')}",
+        'PYTHONPATH': BACKEND_DIR,
+        'YTDLP_ENGINE': 'cli',
+        'OPENAI_API_KEY': 'loadtest-stub-key',
+        'OPENAI_BASE_URL': f"http://127.0.0.1:{stub_port}/v1",
+        'DATABASE_URL': f"sqlite:///{os.path.join(work_dir, 'loadtest.db')}",
+        'RETRY_BASE_DELAY': '0.1',
+        'FAKE_YTDLP_LATENCY': str(args.ytdlp_latency),
+        'FAKE_FFMPEG_LATENCY': str(args.ffmpeg_latency),
+        'FAKE_OUTPUT_MB': str(args.output_mb),
+        'FAKE_FAILURE_RATE': str(args.failure_rate),
+        'WEBHOOK_SECRET': WEBHOOK_SECRET,
+        # Il ricevitore locale è su loopback, altrimenti bloccato dal controllo SSRF
+        'WEBHOOK_ALLOWED_HOSTS': '127.0.0.1',
+        'WEBHOOK_BACKOFF_BASE': '1.5'
+    })
+    if shutil.which('gunicorn'):
+        cmd = ['gunicorn', 'app:app', '--bind', f"127.0.0.1:{port}"] + args.gunicorn_args.split()
+    else:
+        cmd = [sys.executable, '-c', f"from app import app; app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    log_file = open(os.path.join(work_dir, 'app.log'), 'w')
+    process = subprocess.Popen(cmd, cwd=work_dir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App terminata all'avvio (log: {log_file.name})")
+        try:
+            if requests.get(f"{base_url}/api/health", timeout=2).ok:
+                return process, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"App non pronta entro 60s (log: {log_file.name})")
+
+def build_report(metrics, elapsed, args, inbox=None):
+    endpoints = {}
+    total_requests = 0
+    total_errors = 0
+    for endpoint, latencies in sorted(metrics.latencies.items()):
+        total_requests += len(latencies)
+        total_errors += metrics.errors[endpoint]
+        endpoints[endpoint] = {
+            'requests': len(latencies),
+            'errors': metrics.errors[endpoint],
+            'error_rate': round(metrics.errors[endpoint] / len(latencies), 4),
+            'throughput_rps': round(len(latencies) / elapsed, 2),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+            'p90_ms': round(percentile(latencies, 90) * 1000, 1),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+            'max_ms': round(max(latencies) * 1000, 1),
+            'status_codes': {str(code): count for code, count in metrics.status_codes[endpoint].items()}
+        }
+    total_jobs = sum(metrics.jobs.values())
+    return {
+        'config': vars(args),
+        'elapsed_seconds': round(elapsed, 2),
+        'total_requests': total_requests,
+        'throughput_rps': round(total_requests / elapsed, 2),
+        'error_rate': round(total_errors / total_requests, 4) if total_requests else 0,
+        'endpoints': endpoints,
+        'jobs': {
+            'total': total_jobs,
+            'by_status': dict(metrics.jobs),
+            'failure_rate': round(1 - metrics.jobs['completed'] / total_jobs, 4) if total_jobs else 0,
+            'throughput_per_min': round(metrics.jobs['completed'] / elapsed * 60, 2),
+            'p50_seconds': percentile(metrics.job_durations, 50),
+            'p95_seconds': percentile(metrics.job_durations, 95)
+        },
+        'webhooks': {
+            'tasks_notified': len(inbox.deliveries),
+            'duplicates': sum(len(deliveries) - 1 for deliveries in inbox.deliveries.values()),
+            'retried': sum(1 for deliveries in inbox.deliveries.values() if deliveries[0]['attempt'] > 1),
+            'rejected_by_receiver': inbox.rejected,
+            'invalid_signatures': inbox.invalid_signatures
+        } if inbox else None
+    }
+
+def print_report(report):
+    print(f"\n📊 {report['total_requests']} richieste in {report['elapsed_seconds']}s "
+          f"({report['throughput_rps']} req/s, errori {report['error_rate']:.2%})")
+    print(f"{'endpoint':<34}{'req':>6}{'err%':>8}{'rps':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for endpoint, stats in report['endpoints'].items():
+        print(f"{endpoint:<34}{stats['requests']:>6}{stats['error_rate']:>8.2%}{stats['throughput_rps']:>8}"
+              f"{stats['p50_ms']:>8}ms{stats['p95_ms']:>7}ms{stats['p99_ms']:>7}ms{stats['max_ms']:>7}ms")
+    jobs = report['jobs']
+    print(f"\n🎬 Job: {jobs['total']} totali {jobs['by_status']} - fallimenti {jobs['failure_rate']:.2%}, "
+          f"{jobs['throughput_per_min']} job/min, durata p50 {jobs['p50_seconds']}s p95 {jobs['p95_seconds']}s")
+    if report['webhooks']:
+        hooks = report['webhooks']
+        print(f"📬 Webhook: {hooks['tasks_notified']} task notificati, {hooks['retried']} dopo retry, "
+              f"{hooks['duplicates']} duplicati, {hooks['invalid_signatures']} firme non valide")
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test HTTP dell\'API MAAT')
+    parser.add_argument('--base-url', help='Server già avviato (default: avvia l\'app con strumenti finti)')
+    parser.add_argument('--port', type=int, default=0, help='Porta dell\'app avviata localmente')
+    parser.add_argument('--gunicorn-args', default='--workers 1 --threads 8', help='Argomenti extra per gunicorn')
+    parser.add_argument('--users', type=int, default=10, help='Utenti virtuali concorrenti')
+    parser.add_argument('--iterations', type=int, default=2, help='Estrazioni per utente')
+    parser.add_argument('--clips', type=int, default=3, help='Clip per estrazione')
+    parser.add_argument('--clip-duration', type=int, default=30)
+    parser.add_argument('--formats', default='tiktok,youtube', help='Formati social (separati da virgola)')
+    parser.add_argument('--subtitles', action='store_true', help='Richiedi sottotitoli (stub di trascrizione)')
+    parser.add_argument('--same-video', action='store_true', help='Stesso video per tutti (misura la deduplicazione)')
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--job-timeout', type=float, default=600)
+    parser.add_argument('--ytdlp-latency', type=float, default=1.0, help='Secondi per download simulato')
+    parser.add_argument('--ffmpeg-latency', type=float, default=2.0, help='Secondi per encoding simulato')
+    parser.add_argument('--output-mb', type=float, default=2.0, help='Dimensione dei file simulati')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Probabilità di errore degli strumenti finti')
+    parser.add_argument('--transcription-latency', type=float, default=1.0, help='Secondi per trascrizione simulata')
+    parser.add_argument('--webhooks', action='store_true', help='Attendi i webhook di fine task invece del polling')
+    parser.add_argument('--webhook-failure-rate', type=float, default=0.0, help='Quota di consegne rifiutate (503) dal ricevitore')
+    parser.add_argument('--json-out', help='Salva il report JSON in questo file')
+    args = parser.parse_args()
+
+    work_dir = None
+    app_process = None
+    stub_server = None
+    webhook_server = inbox = None
+    try:
+        if args.webhooks:
+            # Con --base-url il server remoto deve avere lo stesso WEBHOOK_SECRET e raggiungere questo host
+            webhook_server, inbox, args.callback_url = start_webhook_receiver(WEBHOOK_SECRET, failure_rate=args.webhook_failure_rate)
+        if not args.base_url:
+            work_dir = tempfile.mkdtemp(prefix='maat_loadtest_')
+            stub_server, stub_port = start_stub_server(latency=args.transcription_latency)
+            app_process, args.base_url = start_app(args, work_dir, stub_port)
+            print(f"🚀 App di test su {args.base_url} (directory {work_dir})")
+
+        print(f"🔥 {args.users} utenti x {args.iterations} estrazioni da {args.clips} clip...")
+        metrics = Metrics()
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=args.users) as executor:
+            for future in [executor.submit(virtual_user, index, args, metrics, inbox) for index in range(args.users)]:
+                future.result()
+        report = build_report(metrics, time.time() - started, args, inbox)
+        print_report(report)
+
+        if args.json_out:
+            with open(args.json_out, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            print(f"💾 Report salvato in {args.json_out}")
+    finally:
+        if app_process:
+            app_process.terminate()
+            app_process.wait(timeout=10)
+        if stub_server:
+            stub_server.shutdown()
+        if webhook_server:
+            webhook_server.shutdown()
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# stub_transcription.py - Server locale che imita l'API di trascrizione OpenAI (Whisper)
+#
+# Risponde a POST /v1/audio/transcriptions con un SRT fisso dopo una latenza
+# configurabile. L'app lo usa impostando OPENAI_BASE_URL=http://127.0.0.1:<porta>/v1.
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STUB_SRT = """1
+00:00:00,000 --> 00:00:04,000
+Sottotitolo di prova
+
+2
+00:00:04,000 --> 00:00:08,000
+Generato dal server stub
+"""
+
+class TranscriptionHandler(BaseHTTPRequestHandler):
+    latency = 1.0
+
+    def do_POST(self):
+        # Consuma l'upload multipart senza interpretarlo
+        length = int(self.headers.get('Content-Length') or 0)
+        remaining = length
+        while remaining > 0:
+            remaining -= len(self.rfile.read(min(remaining, 1024 * 1024)))
+
+        if not self.path.rstrip('/').endswith('/audio/transcriptions'):
+            self.send_error(404)
+            return
+        time.sleep(self.latency)
+        body = STUB_SRT.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub_server(port=0, latency=1.0):
+    """Avvia il server in un thread; ritorna (server, porta effettiva)"""
+    handler = type('ConfiguredTranscriptionHandler', (TranscriptionHandler,), {'latency': latency})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Stub locale della trascrizione OpenAI')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=1.0)
+    args = parser.parse_args()
+    server, port = start_stub_server(args.port, args.latency)
+    print(f"🎙️ Stub trascrizione su http://127.0.0.1:{port}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,74 @@
+# webhook_receiver.py - Ricevitore locale dei webhook di fine task (verifica firma)
+#
+# Registra ogni POST ricevuto per task_id e controlla la firma HMAC con lo stesso
+# secret passato all'app (WEBHOOK_SECRET). Con failure_rate > 0 risponde 503 a una
+# parte delle consegne per esercitare retry e backoff del dispatcher.
+import hmac
+import json
+import random
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class WebhookInbox:
+    """Consegne ricevute per task_id, con attesa della prima consegna valida"""
+
+    def __init__(self, secret):
+        self.secret = secret
+        self.deliveries = {}
+        self.invalid_signatures = 0
+        self.rejected = 0
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def verify(self, body, timestamp, signature):
+        message = f"{timestamp}.".encode('utf-8') + body
+        expected = 'sha256=' + hmac.new(self.secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature or '')
+
+    def _event(self, task_id):
+        with self._lock:
+            return self._events.setdefault(task_id, threading.Event())
+
+    def record(self, payload, attempt):
+        task_id = payload.get('task_id')
+        with self._lock:
+            self.deliveries.setdefault(task_id, []).append({'payload': payload, 'attempt': attempt})
+        self._event(task_id).set()
+
+    def wait(self, task_id, timeout):
+        """Payload della prima consegna per il task, o None allo scadere del timeout"""
+        if not self._event(task_id).wait(timeout):
+            return None
+        with self._lock:
+            return self.deliveries[task_id][0]['payload']
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    inbox = None
+    failure_rate = 0.0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not self.inbox.verify(body, self.headers.get('X-Maat-Timestamp', ''), self.headers.get('X-Maat-Signature')):
+            self.inbox.invalid_signatures += 1
+            self.send_error(401)
+            return
+        if random.random() < self.failure_rate:
+            self.inbox.rejected += 1
+            self.send_error(503)
+            return
+        self.inbox.record(json.loads(body), int(self.headers.get('X-Maat-Attempt') or 1))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def start_webhook_receiver(secret, port=0, failure_rate=0.0):
+    """Avvia il ricevitore in un thread; ritorna (server, inbox, URL di callback)"""
+    inbox = WebhookInbox(secret)
+    handler = type('ConfiguredWebhookHandler', (WebhookHandler,), {'inbox': inbox, 'failure_rate': failure_rate})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, inbox, f"http://127.0.0.1:{server.server_address[1]}/webhook"
@@ -67,3 +67,59 @@ class PasswordReset(db.Model):
     is_used = db.Column(db.Boolean, default=False)
     
     user = db.relationship('User', backref=db.backref('password_resets', lazy=True))
+
+class JobHistory(db.Model):
+    """Storico dei job di estrazione di un utente: spec, statistiche e posizione degli output.
+
+    Le clip non vengono salvate per intero: solo nomi e percorsi dei file prodotti,
+    sufficienti per riscaricarli finché restano su disco."""
+    
+    __tablename__ = 'job_history'
+    __table_args__ = (
+        # Paginazione a cursore: WHERE user_id = ? ORDER BY created_at DESC, id DESC
+        db.Index('ix_job_history_user_created', 'user_id', 'created_at', 'id'),
+        db.UniqueConstraint('user_id', 'task_id', name='uq_job_history_user_task'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    # Niente foreign key: nel deploy separato la tabella user vive nel database del
+    # servizio di auth, l'API conosce l'utente solo dal token (indicizzato da ix_job_history_user_created)
+    user_id = db.Column(db.String(36), nullable=False)
+    task_id = db.Column(db.String(36), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False, default='starting')
+    video_url = db.Column(db.String(2048), nullable=False)
+    spec = db.Column(db.JSON, nullable=False)  # durata, formati, sottotitoli, priorità, timestamp
+    clip_count = db.Column(db.Integer, default=0)
+    successful_clips = db.Column(db.Integer, nullable=True)
+    total_files = db.Column(db.Integer, nullable=True)
+    total_size_mb = db.Column(db.Float, nullable=True)
+    zip_path = db.Column(db.String(1024), nullable=True)
+    files = db.Column(db.JSON, nullable=True)  # [{'format', 'filename', 'path'}]
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    def to_dict(self):
+        """Vista per il client (URL di download, senza percorsi locali)"""
+        return {
+            'task_id': self.task_id,
+            'status': self.status,
+            'video_url': self.video_url,
+            'spec': self.spec,
+            'clip_count': self.clip_count,
+            'successful_clips': self.successful_clips,
+            'total_files': self.total_files,
+            'total_size_mb': round(self.total_size_mb, 2) if self.total_size_mb is not None else None,
+            'download_url': f"/api/download/{self.task_id}" if self.zip_path else None,
+            'files': [
+                {
+                    'format': entry['format'],
+                    'filename': entry['filename'],
+                    'download_url': f"/api/download/{self.task_id}/{entry['filename']}"
+                }
+                for entry in self.files or []
+            ],
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
@@ -0,0 +1,146 @@
+# structured_log.py - Logging strutturato non bloccante (coda + thread di scrittura)
+#
+# I thread di estrazione accodano i record senza attendere l'I/O: un QueueListener
+# li scrive su stdout (JSON per riga o testo). Se la coda è piena il record viene
+# scartato e contato, mai atteso. Livello e formato da LOG_LEVEL / LOG_FORMAT.
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')  # 'json' o 'text'
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_STDERR_LIMIT = int(os.getenv('LOG_STDERR_LIMIT', '1000'))
+
+# Attributi standard di LogRecord: tutto il resto sono campi strutturati (extra/contesto)
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+_local = threading.local()
+_configure_lock = threading.Lock()
+_listener = None
+_handler = None
+
+def truncate_output(text, limit=LOG_STDERR_LIMIT):
+    """Coda di un output di sottoprocesso (le ultime righe sono quelle con l'errore)"""
+    if not text or len(text) <= limit:
+        return text
+    return f"…[{len(text) - limit} caratteri omessi] {text[-limit:]}"
+
+@contextmanager
+def log_context(**fields):
+    """Campi aggiunti a tutti i log del thread corrente (es. task_id, clip_index)"""
+    previous = getattr(_local, 'fields', {})
+    _local.fields = {**previous, **fields}
+    try:
+        yield
+    finally:
+        _local.fields = previous
+
+class _ContextFilter(logging.Filter):
+    """Copia il contesto del thread nel record (nel thread che emette il log)"""
+
+    def filter(self, record):
+        for key, value in getattr(_local, 'fields', {}).items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler che non blocca mai: a coda piena scarta e conta il record"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.emitted = 0
+        self.dropped = 0
+        self.emit_seconds = 0.0
+        self.max_depth = 0
+
+    def emit(self, record):
+        started = time.perf_counter()
+        try:
+            self.queue.put_nowait(self.prepare(record))
+            self.emitted += 1
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        self.emit_seconds += time.perf_counter() - started
+
+class JsonFormatter(logging.Formatter):
+    """Una riga JSON per record, con i campi di contesto"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Formato leggibile: livello, messaggio e campi di contesto in coda"""
+
+    def format(self, record):
+        fields = ' '.join(f"{key}={value}" for key, value in vars(record).items() if key not in _RECORD_FIELDS)
+        line = f"{self.formatTime(record, '%H:%M:%S')} {record.levelname:<7} {record.getMessage()}"
+        return f"{line} [{fields}]" if fields else line
+
+def queued_handler(output, queue_size=LOG_QUEUE_SIZE):
+    """Handler non bloccante davanti a `output`: un thread dedicato fa la scrittura.
+
+    Ritorna (handler da aggiungere al logger, listener già avviato)."""
+    log_queue = queue.Queue(maxsize=queue_size)
+    handler = _NonBlockingQueueHandler(log_queue)
+    listener = QueueListener(log_queue, output, respect_handler_level=False)
+    listener.start()
+    # Svuota la coda all'uscita del processo
+    atexit.register(listener.stop)
+    return handler, listener
+
+def configure_logging():
+    """Configura una sola volta la coda e il thread di scrittura per i logger 'maat.*'"""
+    global _listener, _handler
+    with _configure_lock:
+        if _handler is not None:
+            return
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else TextFormatter())
+        _handler, _listener = queued_handler(output)
+        _handler.addFilter(_ContextFilter())
+
+        root = logging.getLogger('maat')
+        root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+        root.propagate = False
+        root.addHandler(_handler)
+
+def get_logger(name):
+    """Logger del modulo `name` (figlio di 'maat')"""
+    configure_logging()
+    return logging.getLogger(f"maat.{name}")
+
+def log_stats():
+    """Contatori del logger: emessi, scartati, tempo speso dai thread che loggano"""
+    if _handler is None:
+        return {}
+    return {
+        'emitted': _handler.emitted,
+        'dropped': _handler.dropped,
+        'queue_depth': _handler.queue.qsize(),
+        'max_queue_depth': _handler.max_depth,
+        'emit_avg_us': round(_handler.emit_seconds / _handler.emitted * 1_000_000, 1) if _handler.emitted else 0
+    }
@@ -0,0 +1,353 @@
+# task_control.py - Controllo task: cancellazione e processi figli
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+from tracing import trace_span
+from structured_log import get_logger
+
+logger = get_logger('task_control')
+
+class TaskCancelled(Exception):
+    """Sollevata quando un task viene annullato"""
+    pass
+
+def kill_process_tree(process, grace_period=3):
+    """Termina il gruppo di processi (yt-dlp + ffmpeg figli): SIGTERM, poi SIGKILL"""
+    if process.poll() is not None:
+        return
+    try:
+        pgid = os.getpgid(process.pid)
+        os.killpg(pgid, signal.SIGTERM)
+        try:
+            process.wait(timeout=grace_period)
+        except subprocess.TimeoutExpired:
+            os.killpg(pgid, signal.SIGKILL)
+            process.wait()
+    except ProcessLookupError:
+        pass
+
+def set_process_group_nice(pid, nice):
+    """Niceness del gruppo di processi avviato con start_new_session (pgid = pid)"""
+    try:
+        os.setpriority(os.PRIO_PGRP, pid, nice)
+    except (OSError, AttributeError) as e:
+        # Niceness negative senza privilegi, processo già terminato o piattaforma non POSIX
+        logger.debug(f"Niceness {nice} non applicata al processo {pid}: {e}")
+
+def set_process_nice(pid, nice):
+    """Niceness di un singolo processo non avviato da noi (es. ffmpeg figlio di yt-dlp)"""
+    try:
+        os.setpriority(os.PRIO_PROCESS, pid, nice)
+    except (OSError, AttributeError) as e:
+        logger.debug(f"Niceness {nice} non applicata al processo {pid}: {e}")
+
+class ProcessStalled(subprocess.TimeoutExpired):
+    """Sollevata quando un processo figlio non fa progressi per stall_timeout secondi"""
+
+    def __str__(self):
+        return f"Processo in stallo (nessun progresso per {self.timeout}s)"
+
+def with_ffmpeg_progress(cmd):
+    """Aggiunge a un comando ffmpeg il progresso leggibile (-progress pipe:1) e il tempo CPU (-benchmark)"""
+    if os.path.basename(cmd[0]) != 'ffmpeg' or '-progress' in cmd or 'pipe:1' in cmd:
+        return cmd, False
+    return [cmd[0], '-progress', 'pipe:1', '-nostats', '-benchmark'] + list(cmd[1:]), True
+
+def ffmpeg_cpu_seconds(stderr):
+    """CPU-secondi (user + system) dalla riga "bench: utime=...s stime=...s" di -benchmark"""
+    match = re.search(r'bench: utime=([\d.]+)s stime=([\d.]+)s', stderr or '')
+    return float(match.group(1)) + float(match.group(2)) if match else None
+
+def _parse_ffmpeg_time(value):
+    """out_time_us/out_time_ms di ffmpeg (entrambi in microsecondi) -> secondi"""
+    try:
+        return int(value) / 1_000_000
+    except (TypeError, ValueError):
+        return None
+
+class _ProcessMonitor:
+    """Legge stdout/stderr dei processi, interpreta il progresso ffmpeg e traccia l'attività"""
+
+    def __init__(self, on_progress=None, watch_files=None):
+        self.on_progress = on_progress
+        self.watch_files = watch_files or []
+        self.last_activity = time.time()
+        self.out_time = 0.0
+        self.total_size = 0
+        self.watched_size = 0
+        self.stdout_chunks = []
+        self.stderr_chunks = []
+        self._threads = []
+
+    def activity(self):
+        self.last_activity = time.time()
+
+    def _read_progress(self, stream):
+        block = {}
+        for line in stream:
+            key, _, value = line.strip().partition('=')
+            block[key] = value
+            if key != 'progress':
+                continue
+            # Fine di un blocco di progresso ffmpeg
+            out_time = _parse_ffmpeg_time(block.get('out_time_us') or block.get('out_time_ms'))
+            total_size = int(block['total_size']) if block.get('total_size', '').isdigit() else 0
+            if (out_time and out_time > self.out_time) or total_size > self.total_size:
+                self.activity()
+            self.out_time = max(self.out_time, out_time or 0)
+            self.total_size = max(self.total_size, total_size)
+            if self.on_progress:
+                self.on_progress({
+                    'out_time': self.out_time,
+                    'total_size': self.total_size,
+                    'frame': int(block['frame']) if block.get('frame', '').isdigit() else None,
+                    'speed': block.get('speed'),
+                    'done': value == 'end'
+                })
+            block = {}
+
+    def _read_text(self, stream, chunks, count_activity):
+        for chunk in stream:
+            if isinstance(chunk, bytes):
+                chunk = chunk.decode(errors='replace')
+            chunks.append(chunk)
+            if count_activity:
+                self.activity()
+
+    def attach(self, process, progress_stdout=False, capture_stdout=True, count_stderr_activity=True):
+        """Avvia i thread di lettura per un processo"""
+        readers = [(self._read_text, (process.stderr, self.stderr_chunks, count_stderr_activity))]
+        if progress_stdout:
+            readers.append((self._read_progress, (process.stdout,)))
+        elif capture_stdout and process.stdout:
+            readers.append((self._read_text, (process.stdout, self.stdout_chunks, False)))
+        for target, args in readers:
+            thread = threading.Thread(target=target, args=args, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def check_watch_files(self):
+        """I file in crescita (es. .part di yt-dlp) contano come attività"""
+        size = 0
+        for path in self.watch_files:
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        if size > self.watched_size:
+            self.watched_size = size
+            self.activity()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join(timeout=5)
+
+def _wait_monitored(processes, monitor, cmd, timeout=None, stall_timeout=None):
+    """Attende la fine dei processi applicando timeout complessivo e rilevamento stallo"""
+    started = time.time()
+    try:
+        while any(process.poll() is None for process in processes):
+            try:
+                processes[-1].wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                pass
+            monitor.check_watch_files()
+            now = time.time()
+            if timeout and now - started > timeout:
+                for process in processes:
+                    kill_process_tree(process)
+                raise subprocess.TimeoutExpired(cmd, timeout)
+            if stall_timeout and now - monitor.last_activity > stall_timeout:
+                for process in processes:
+                    kill_process_tree(process)
+                raise ProcessStalled(cmd, stall_timeout)
+    finally:
+        monitor.join()
+
+def _run_once(cmd, control, timeout, stall_timeout, on_progress, watch_files):
+    with trace_span('subprocess', command=os.path.basename(cmd[0])) as span:
+        result = _run_traced(cmd, control, timeout, stall_timeout, on_progress, watch_files, span)
+        span.set(exit_code=result.returncode)
+        return result
+
+def _run_traced(cmd, control, timeout, stall_timeout, on_progress, watch_files, span):
+    if control:
+        control.check()
+
+    cmd, progress_stdout = with_ffmpeg_progress(cmd)
+    process = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        start_new_session=True
+    )
+    if control:
+        control.register(process)
+
+    monitor = _ProcessMonitor(on_progress, watch_files)
+    # Con -progress ffmpeg è silenzioso su stderr: l'attività viene dal progresso
+    monitor.attach(process, progress_stdout=progress_stdout, count_stderr_activity=not progress_stdout)
+    try:
+        _wait_monitored([process], monitor, cmd, timeout, stall_timeout)
+    finally:
+        if control:
+            control.unregister(process)
+        span.set(bytes=max(monitor.total_size, monitor.watched_size), media_seconds=round(monitor.out_time, 2),
+                 cpu_seconds=ffmpeg_cpu_seconds(''.join(monitor.stderr_chunks)))
+
+    # Processo ucciso da una cancellazione: non è un errore del comando
+    if control:
+        control.check()
+
+    return subprocess.CompletedProcess(cmd, process.returncode, ''.join(monitor.stdout_chunks), ''.join(monitor.stderr_chunks))
+
+def run_command(cmd, control=None, timeout=None, stall_timeout=None, on_progress=None, watch_files=None, stall_retries=0):
+    """Esegue un comando in un nuovo gruppo di processi, terminabile dal TaskControl.
+
+    I comandi ffmpeg vengono eseguiti con -progress: on_progress riceve out_time/total_size
+    in tempo reale. Se non c'è progresso per stall_timeout secondi il processo viene
+    terminato e rilanciato fino a stall_retries volte, poi si solleva ProcessStalled."""
+    for attempt in range(stall_retries + 1):
+        try:
+            return _run_once(cmd, control, timeout, stall_timeout, on_progress, watch_files)
+        except ProcessStalled:
+            if attempt >= stall_retries:
+                raise
+            logger.warning(f"🔁 Processo in stallo ({os.path.basename(cmd[0])}) - nuovo tentativo {attempt+1}/{stall_retries}")
+
+def run_pipeline(producer_cmd, consumer_cmd, control=None, timeout=None, stall_timeout=None, on_progress=None):
+    """Esegue producer | consumer (es. yt-dlp -o - | ffmpeg -i pipe:0) senza file intermedi"""
+    command = f"{os.path.basename(producer_cmd[0])} | {os.path.basename(consumer_cmd[0])}"
+    with trace_span('subprocess', command=command) as span:
+        result = _run_pipeline_traced(producer_cmd, consumer_cmd, control, timeout, stall_timeout, on_progress, span)
+        span.set(exit_code=result.returncode)
+        return result
+
+def _run_pipeline_traced(producer_cmd, consumer_cmd, control, timeout, stall_timeout, on_progress, span):
+    if control:
+        control.check()
+
+    consumer_cmd, progress_stdout = with_ffmpeg_progress(consumer_cmd)
+    producer = subprocess.Popen(
+        producer_cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True
+    )
+    consumer = subprocess.Popen(
+        consumer_cmd,
+        stdin=producer.stdout,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        start_new_session=True
+    )
+    # Solo il consumer legge lo stdout del producer (SIGPIPE se il consumer termina)
+    producer.stdout.close()
+    if control:
+        control.register(producer)
+        control.register(consumer)
+
+    monitor = _ProcessMonitor(on_progress)
+    monitor.attach(producer, capture_stdout=False)
+    monitor.attach(consumer, progress_stdout=progress_stdout, count_stderr_activity=not progress_stdout)
+    try:
+        _wait_monitored([producer, consumer], monitor, consumer_cmd, timeout, stall_timeout)
+    finally:
+        if control:
+            control.unregister(producer)
+            control.unregister(consumer)
+        span.set(bytes=monitor.total_size, media_seconds=round(monitor.out_time, 2))
+
+    if control:
+        control.check()
+
+    returncode = consumer.returncode or producer.returncode
+    return subprocess.CompletedProcess(consumer_cmd, returncode, ''.join(monitor.stdout_chunks), ''.join(monitor.stderr_chunks))
+
+# Pulizia file alla cancellazione:
+#   'all'     -> clip in corso e clip già completate (annullamento utente)
+#   'partial' -> solo la clip in corso (il task verrà ripreso altrove)
+#   'none'    -> nessuna (lease persa: un altro worker possiede già i file)
+CLEANUP_MODES = ('all', 'partial', 'none')
+
+class TaskControl:
+    """Stato di controllo di un task: cancellazione, processi attivi, ultimo poll"""
+
+    def __init__(self, task_id, nice=0):
+        self.task_id = task_id
+        # Niceness dei processi figli (corsia di priorità del task)
+        self.nice = nice
+        self.cancel_event = threading.Event()
+        self.cancel_reason = None
+        self.cleanup = 'all'
+        self.last_poll = time.time()
+        # Client notificato via webhook: non interroga /api/progress, mai considerato abbandonato
+        self.has_callbacks = False
+        self._processes = set()
+        self._cancel_callbacks = []
+        self._lock = threading.Lock()
+
+    def touch(self):
+        """Registra un poll del client"""
+        self.last_poll = time.time()
+
+    def idle_seconds(self):
+        """Secondi dall'ultimo poll"""
+        return time.time() - self.last_poll
+
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+    def check(self):
+        """Solleva TaskCancelled se il task è stato annullato"""
+        if self.cancel_event.is_set():
+            raise TaskCancelled(self.cancel_reason or 'Task annullato')
+
+    def register(self, process):
+        if self.nice:
+            set_process_group_nice(process.pid, self.nice)
+        with self._lock:
+            self._processes.add(process)
+            cancelled = self.cancel_event.is_set()
+        # Cancellazione arrivata mentre il processo partiva
+        if cancelled:
+            kill_process_tree(process)
+
+    def unregister(self, process):
+        with self._lock:
+            self._processes.discard(process)
+
+    def add_cancel_callback(self, callback):
+        """Registra una funzione da chiamare alla cancellazione (lavoro non basato su Popen)"""
+        with self._lock:
+            self._cancel_callbacks.append(callback)
+            cancelled = self.cancel_event.is_set()
+        if cancelled:
+            callback()
+
+    def remove_cancel_callback(self, callback):
+        with self._lock:
+            if callback in self._cancel_callbacks:
+                self._cancel_callbacks.remove(callback)
+
+    def cancel(self, reason='Task annullato', cleanup='all'):
+        """Annulla il task e termina subito tutti i processi figli attivi"""
+        with self._lock:
+            if self.cancel_event.is_set():
+                return False
+            self.cancel_reason = reason
+            self.cleanup = cleanup
+            self.cancel_event.set()
+            processes = list(self._processes)
+            callbacks = list(self._cancel_callbacks)
+
+        for process in processes:
+            kill_process_tree(process)
+        for callback in callbacks:
+            callback()
+        return True
@@ -0,0 +1,167 @@
+# task_store.py - Persistenza su disco dei piani dei task (ripresa dopo crash/restart)
+import os
+import json
+import fcntl
+import threading
+from datetime import datetime, timedelta
+
+# Stati per cui il task va ripreso al riavvio
+INCOMPLETE_STATUSES = ('starting', 'processing')
+
+def detach_subscriber(subscribers, subscriber_id):
+    """Rimuove un richiedente dalla lista; ritorna quanti ne restano o None se non autorizzato.
+
+    Senza subscriber_id si può staccare solo l'unico richiedente (client precedenti)"""
+    if subscriber_id is None:
+        if len(subscribers) > 1:
+            return None
+        subscribers.clear()
+    elif subscriber_id in subscribers:
+        subscribers.remove(subscriber_id)
+    else:
+        return None
+    return len(subscribers)
+
+class TaskStore:
+    """Salva piano e stato per-clip di ogni task come JSON in una directory"""
+
+    def __init__(self, base_dir, retention_hours=24):
+        self.base_dir = base_dir
+        self.retention = timedelta(hours=retention_hours)
+        self._lock = threading.Lock()
+        os.makedirs(base_dir, exist_ok=True)
+
+    def _plan_path(self, task_id):
+        return os.path.join(self.base_dir, f"{task_id}.json")
+
+    def _lock_path(self, task_id):
+        return os.path.join(self.base_dir, f"{task_id}.lock")
+
+    def _write(self, task_id, plan):
+        """Scrittura atomica (file temporaneo + rename)"""
+        path = self._plan_path(task_id)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(plan, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def load(self, task_id):
+        try:
+            with open(self._plan_path(task_id), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_plan(self, task_id, plan):
+        """Salva il piano iniziale del task"""
+        plan = dict(plan)
+        plan.setdefault('task_id', task_id)
+        plan.setdefault('status', 'starting')
+        plan.setdefault('created_at', datetime.now().isoformat())
+        plan.setdefault('clips', {})
+        with self._lock:
+            self._write(task_id, plan)
+
+    def mark_clip(self, task_id, clip_index, clip):
+        """Registra il risultato di una clip completata"""
+        with self._lock:
+            plan = self.load(task_id)
+            if plan is None:
+                return
+            plan['status'] = 'processing'
+            plan['clips'][str(clip_index)] = clip
+            self._write(task_id, plan)
+
+    def add_callback(self, task_id, callback_url):
+        """Aggiunge un callback URL al piano (es. richiesta deduplicata)"""
+        with self._lock:
+            plan = self.load(task_id)
+            if plan is None:
+                return
+            callback_urls = plan.setdefault('callback_urls', [])
+            if callback_url not in callback_urls:
+                callback_urls.append(callback_url)
+                self._write(task_id, plan)
+
+    def add_subscriber(self, task_id, subscriber_id):
+        """Registra un richiedente agganciato al task (richiesta deduplicata)"""
+        with self._lock:
+            plan = self.load(task_id)
+            if plan is None:
+                return
+            plan.setdefault('subscribers', []).append(subscriber_id)
+            self._write(task_id, plan)
+
+    def remove_subscriber(self, task_id, subscriber_id):
+        """Stacca un richiedente; ritorna quanti ne restano (None se non autorizzato)"""
+        with self._lock:
+            plan = self.load(task_id)
+            if plan is None:
+                return 0
+            remaining = detach_subscriber(plan.setdefault('subscribers', []), subscriber_id)
+            if remaining is not None:
+                self._write(task_id, plan)
+            return remaining
+
+    def finish(self, task_id, status, result=None, error=None):
+        """Registra lo stato finale del task"""
+        with self._lock:
+            plan = self.load(task_id)
+            if plan is None:
+                return
+            plan['status'] = status
+            plan['finished_at'] = datetime.now().isoformat()
+            if result is not None:
+                plan['result'] = result
+            if error:
+                plan['error'] = error
+            self._write(task_id, plan)
+
+    def completed_clips(self, plan):
+        """Risultati per-clip del piano con indici interi"""
+        return {int(index): clip for index, clip in plan.get('clips', {}).items()}
+
+    def acquire(self, task_id):
+        """Lock esclusivo del task per processo; rilasciato dal SO se il processo muore"""
+        fd = os.open(self._lock_path(task_id), os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return None
+        return fd
+
+    def release(self, task_id, fd):
+        if fd is None:
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def load_all(self):
+        """Carica tutti i piani, eliminando quelli oltre la retention"""
+        plans = []
+        cutoff = datetime.now() - self.retention
+        for filename in os.listdir(self.base_dir):
+            if not filename.endswith('.json'):
+                continue
+            task_id = filename[:-len('.json')]
+            plan = self.load(task_id)
+            if plan is None:
+                continue
+            created_at = datetime.fromisoformat(plan.get('created_at', datetime.now().isoformat()))
+            if created_at < cutoff and plan.get('status') not in INCOMPLETE_STATUSES:
+                self.delete(task_id)
+                continue
+            plans.append(plan)
+        return plans
+
+    def delete(self, task_id):
+        for path in (self._plan_path(task_id), self._lock_path(task_id)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
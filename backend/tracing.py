@@ -0,0 +1,171 @@
+# tracing.py - Span per task (fasi e sottoprocessi) con export su file JSONL a rotazione
+#
+# Gli span conclusi passano dalla stessa coda non bloccante dei log strutturati:
+# la scrittura (e la rotazione) del file avviene nel thread del listener, non in
+# quello di estrazione che chiude lo span.
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+from structured_log import queued_handler
+
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', '1') == '1'
+TRACE_FILE = os.getenv('TRACE_FILE', os.path.join(os.getenv('TEMP_DIR', 'temp_clips'), 'traces.jsonl'))
+TRACE_MAX_BYTES = int(os.getenv('TRACE_MAX_BYTES', str(10 * 1024 * 1024)))
+TRACE_BACKUPS = int(os.getenv('TRACE_BACKUPS', '5'))
+WATERFALL_WIDTH = 40
+
+_sink = None
+_sink_lock = threading.Lock()
+_local = threading.local()
+
+def trace_sink():
+    """Logger dedicato: una riga JSON per span, file ruotato a TRACE_MAX_BYTES (scritto in coda)"""
+    global _sink
+    with _sink_lock:
+        if _sink is None:
+            os.makedirs(os.path.dirname(TRACE_FILE) or '.', exist_ok=True)
+            handler = RotatingFileHandler(TRACE_FILE, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUPS, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            sink = logging.getLogger('maat.trace')
+            sink.setLevel(logging.INFO)
+            sink.propagate = False
+            sink.addHandler(queued_handler(handler)[0])
+            _sink = sink
+        return _sink
+
+class Span:
+    """Intervallo di lavoro con attributi (clip, formato, byte, exit code...)"""
+
+    def __init__(self, tracer, name, parent_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.start = time.time()
+        self.end = None
+        self.status = 'ok'
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        return {
+            'trace_id': self.tracer.trace_id,
+            'task_id': self.tracer.task_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration_ms': round(((self.end or time.time()) - self.start) * 1000, 1),
+            'status': self.status,
+            'error': self.error,
+            'attributes': self.attributes
+        }
+
+class _NoopSpan:
+    """Span nullo quando nessun tracer è attivo nel thread"""
+    span_id = None
+
+    def set(self, **attributes):
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+class Tracer:
+    """Span di un task; il tracer attivo è per-thread (vedi activate)"""
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.trace_id = uuid.uuid4().hex
+        self.spans = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def activate(self):
+        """Rende il tracer quello corrente del thread (usato da trace_span)"""
+        previous = (getattr(_local, 'tracer', None), getattr(_local, 'stack', None))
+        _local.tracer, _local.stack = self, []
+        try:
+            yield self
+        finally:
+            _local.tracer, _local.stack = previous
+
+    @contextmanager
+    def span(self, name, parent_id=None, **attributes):
+        """Apre uno span figlio dello span corrente del thread (o di parent_id)"""
+        if not TRACING_ENABLED:
+            yield NOOP_SPAN
+            return
+        stack = getattr(_local, 'stack', None) if getattr(_local, 'tracer', None) is self else None
+        if parent_id is None and stack:
+            parent_id = stack[-1].span_id
+        span = Span(self, name, parent_id, attributes)
+        if stack is not None:
+            stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.status = 'cancelled' if type(e).__name__ == 'TaskCancelled' else 'error'
+            span.error = f"{type(e).__name__}: {e}"[:300]
+            raise
+        finally:
+            span.end = time.time()
+            if stack is not None:
+                stack.pop()
+            with self._lock:
+                self.spans.append(span)
+            try:
+                trace_sink().info(json.dumps(span.to_dict(), default=str))
+            except OSError:
+                pass
+
+    def waterfall(self):
+        """Span conclusi ordinati per inizio, con offset e profondità rispetto al primo"""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        if not spans:
+            return []
+        origin = spans[0].start
+        total = max(span.end for span in spans) - origin or 1
+        depths = {}
+        by_id = {span.span_id: span for span in spans}
+        rows = []
+        for span in spans:
+            parent = by_id.get(span.parent_id)
+            depths[span.span_id] = depths.get(parent.span_id, -1) + 1 if parent else 0
+            offset = span.start - origin
+            duration = span.end - span.start
+            # Barra testuale: posizione e durata in proporzione al task
+            bar_start = int(offset / total * WATERFALL_WIDTH)
+            bar_length = max(1, int(duration / total * WATERFALL_WIDTH))
+            rows.append({
+                'name': span.name,
+                'depth': depths[span.span_id],
+                'offset_ms': round(offset * 1000, 1),
+                'duration_ms': round(duration * 1000, 1),
+                'status': span.status,
+                'attributes': span.attributes,
+                'bar': ' ' * bar_start + '█' * bar_length
+            })
+        return rows
+
+def current_tracer():
+    return getattr(_local, 'tracer', None)
+
+@contextmanager
+def trace_span(name, **attributes):
+    """Span sul tracer corrente del thread; nessun effetto se il tracing è spento"""
+    tracer = current_tracer()
+    if tracer is None:
+        yield NOOP_SPAN
+        return
+    with tracer.span(name, **attributes) as span:
+        yield span
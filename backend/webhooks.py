@@ -0,0 +1,294 @@
+# webhooks.py - Notifiche di fine task verso callback URL (firmate HMAC, con retry)
+#
+# Il chiamante di /api/extract-clips può indicare `callback_url`: a fine task il
+# servizio invia un POST JSON (completato / fallito / annullato) invece di
+# costringerlo a interrogare /api/progress. Le consegne passano da un pool fisso
+# di thread con coda limitata; gli errori temporanei sono ritentati con backoff.
+#
+# Firma: header X-Maat-Signature = "sha256=" + HMAC-SHA256(WEBHOOK_SECRET,
+# "<X-Maat-Timestamp>.<body>"). Il ricevente ricalcola l'HMAC sul body grezzo e
+# scarta timestamp troppo vecchi (protezione da replay).
+#
+# SSRF: /api/extract-clips non richiede autenticazione, quindi l'host del callback
+# viene risolto e rifiutato se punta a indirizzi privati, loopback, link-local
+# (metadata cloud 169.254.169.254) o riservati; il controllo si ripete prima di
+# ogni tentativo (DNS rebinding). WEBHOOK_ALLOWED_HOSTS elenca le eccezioni
+# (es. "127.0.0.1" per il ricevitore del load test).
+import os
+import hmac
+import json
+import time
+import uuid
+import heapq
+import random
+import socket
+import hashlib
+import ipaddress
+import threading
+from urllib.parse import urlsplit
+
+import requests
+
+from structured_log import get_logger
+
+logger = get_logger('webhooks')
+
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '2'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '500'))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', '6'))
+WEBHOOK_TIMEOUT = float(os.getenv('WEBHOOK_TIMEOUT', '10'))
+WEBHOOK_BACKOFF_BASE = float(os.getenv('WEBHOOK_BACKOFF_BASE', '2'))
+WEBHOOK_BACKOFF_MAX = float(os.getenv('WEBHOOK_BACKOFF_MAX', '300'))
+# URL pubblico del servizio per i link di download nel payload (es. https://api.example.com)
+PUBLIC_BASE_URL = os.getenv('PUBLIC_BASE_URL', '')
+# Host raggiungibili anche se risolvono a indirizzi non pubblici (separati da virgola)
+WEBHOOK_ALLOWED_HOSTS = {host.strip().lower() for host in os.getenv('WEBHOOK_ALLOWED_HOSTS', '').split(',') if host.strip()}
+
+# Stato finale del task -> evento notificato
+WEBHOOK_EVENTS = {
+    'completed': 'task.completed',
+    'failed': 'task.failed',
+    'cancelled': 'task.cancelled'
+}
+
+# Risposte 4xx che vale comunque la pena ritentare
+RETRYABLE_STATUS = (408, 425, 429)
+
+def is_public_address(address):
+    """True se l'IP è instradabile pubblicamente (no privati, loopback, link-local, riservati)"""
+    ip = ipaddress.ip_address(address.split('%', 1)[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return not (ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_reserved
+                or ip.is_multicast or ip.is_unspecified)
+
+def unsafe_destination(callback_url):
+    """Motivo per cui l'host del callback non va contattato, altrimenti None"""
+    host = (urlsplit(callback_url).hostname or '').lower()
+    if not host:
+        return 'host mancante'
+    if host in WEBHOOK_ALLOWED_HOSTS:
+        return None
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError) as e:
+        return f'host non risolvibile ({e})'
+    # Tutti gli indirizzi devono essere pubblici: la connessione può usarne uno qualsiasi
+    blocked = sorted(address for address in addresses if not is_public_address(address))
+    if blocked:
+        return f'host {host} risolve a un indirizzo non pubblico ({blocked[0]})'
+    return None
+
+def validate_callback_url(callback_url):
+    """Messaggio di errore se l'URL non è utilizzabile, altrimenti None"""
+    if not isinstance(callback_url, str) or not callback_url.strip():
+        return 'callback_url deve essere una stringa'
+    parts = urlsplit(callback_url.strip())
+    if parts.scheme not in ('http', 'https') or not parts.netloc:
+        return 'callback_url deve essere un URL http(s) assoluto'
+    if not WEBHOOK_SECRET:
+        return 'Webhook non configurati sul server (WEBHOOK_SECRET mancante)'
+    unsafe = unsafe_destination(callback_url.strip())
+    if unsafe:
+        return f'callback_url non consentito: {unsafe}'
+    return None
+
+def sign_payload(body, timestamp, secret=None):
+    """Firma HMAC-SHA256 di "<timestamp>.<body>" (body in bytes)"""
+    key = (secret or WEBHOOK_SECRET).encode('utf-8')
+    message = f"{timestamp}.".encode('utf-8') + body
+    return 'sha256=' + hmac.new(key, message, hashlib.sha256).hexdigest()
+
+def build_task_payload(task_id, status, result=None, error=None, base_url=None):
+    """Payload di fine task: riepilogo e URL di download assoluti"""
+    base_url = (base_url or PUBLIC_BASE_URL).rstrip('/')
+    payload = {
+        'event': WEBHOOK_EVENTS.get(status, f"task.{status}"),
+        'task_id': task_id,
+        'status': status,
+        'finished_at': time.time(),
+        'error': error
+    }
+    if result:
+        clips = []
+        for clip_index, clip in enumerate(result.get('clips', [])):
+            files = [social_file['filename'] for social_file in clip.get('social_files', [])]
+            if clip.get('subtitle_file'):
+                files.append(clip['subtitle_file']['filename'])
+            clips.append({
+                'index': clip_index,
+                'success': bool(clip.get('success')),
+                'timestamp': clip.get('timestamp'),
+                'description': clip.get('description'),
+                'error': clip.get('error'),
+                'download_urls': [f"{base_url}/api/download/{task_id}/{filename}" for filename in files]
+            })
+        payload['summary'] = {
+            'total_clips': result.get('total_clips', len(clips)),
+            'successful_clips': result.get('successful_clips', sum(1 for clip in clips if clip['success'])),
+            'processing_time': result.get('processing_time')
+        }
+        payload['download_url'] = f"{base_url}/api/download/{task_id}" if result.get('zip_path') else None
+        payload['clips'] = clips
+    return payload
+
+class WebhookDispatcher:
+    """Pool limitato di thread che consegna i webhook con retry e backoff esponenziale"""
+
+    def __init__(self, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE, max_attempts=WEBHOOK_MAX_ATTEMPTS,
+                 timeout=WEBHOOK_TIMEOUT, secret=None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.secret = secret or WEBHOOK_SECRET
+        # Heap (prossimo tentativo, seq, consegna): i retry attendono senza occupare un thread
+        self._pending = []
+        self._seq = 0
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._threads = []
+        self._session = requests.Session()
+        self.stats = {'queued': 0, 'delivered': 0, 'failed': 0, 'retries': 0, 'rejected': 0}
+
+    def start(self):
+        with self._condition:
+            if self._threads:
+                return
+            self._threads = [
+                threading.Thread(target=self._loop, name=f"webhook-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+        for thread in self._threads:
+            thread.start()
+
+    def deliver(self, url, payload):
+        """Accoda una consegna; False se la coda è piena (il webhook viene perso)"""
+        self.start()
+        delivery = {
+            'id': str(uuid.uuid4()),
+            'url': url,
+            'event': payload.get('event', ''),
+            'task_id': payload.get('task_id'),
+            'body': json.dumps(payload, default=str).encode('utf-8'),
+            'attempt': 0
+        }
+        with self._condition:
+            if len(self._pending) + self._in_flight >= self.queue_size:
+                self.stats['rejected'] += 1
+                logger.error(f"❌ Coda webhook piena: scarto {delivery['event']} per {url}", extra={'task_id': delivery['task_id']})
+                return False
+            self._push(delivery, time.time())
+            self.stats['queued'] += 1
+        return True
+
+    def _push(self, delivery, due):
+        """Inserisce nello heap (chiamare con il lock)"""
+        self._seq += 1
+        heapq.heappush(self._pending, (due, self._seq, delivery))
+        self._condition.notify()
+
+    def _next(self):
+        """Attende la prossima consegna scaduta"""
+        with self._condition:
+            while True:
+                if self._pending:
+                    wait = self._pending[0][0] - time.time()
+                    if wait <= 0:
+                        delivery = heapq.heappop(self._pending)[2]
+                        self._in_flight += 1
+                        return delivery
+                    self._condition.wait(wait)
+                else:
+                    self._condition.wait()
+
+    def _loop(self):
+        while True:
+            delivery = self._next()
+            try:
+                retry_delay = self._attempt(delivery)
+            except Exception as e:
+                logger.error(f"❌ Errore inatteso nella consegna webhook: {e}")
+                retry_delay = None
+            with self._condition:
+                self._in_flight -= 1
+                if retry_delay is not None:
+                    self.stats['retries'] += 1
+                    self._push(delivery, time.time() + retry_delay)
+
+    def backoff(self, attempt, retry_after=None):
+        """Attesa prima del tentativo successivo: esponenziale con jitter (o Retry-After)"""
+        if retry_after is not None:
+            return min(retry_after, WEBHOOK_BACKOFF_MAX)
+        delay = min(WEBHOOK_BACKOFF_BASE ** attempt, WEBHOOK_BACKOFF_MAX)
+        return delay * random.uniform(0.5, 1.0)
+
+    def _attempt(self, delivery):
+        """Un tentativo di consegna; ritorna il ritardo del retry o None se concluso"""
+        delivery['attempt'] += 1
+        timestamp = str(int(time.time()))
+        headers = {
+            'Content-Type': 'application/json',
+            'User-Agent': 'maat-webhooks/1.0',
+            'X-Maat-Event': delivery['event'],
+            'X-Maat-Delivery': delivery['id'],
+            'X-Maat-Attempt': str(delivery['attempt']),
+            'X-Maat-Timestamp': timestamp,
+            'X-Maat-Signature': sign_payload(delivery['body'], timestamp, self.secret)
+        }
+        retry_after = None
+        # Il DNS può essere cambiato dopo la validazione (rebinding): nuovo controllo prima dell'invio
+        unsafe = unsafe_destination(delivery['url'])
+        if unsafe:
+            self.stats['failed'] += 1
+            logger.error(f"❌ Webhook verso {delivery['url']} bloccato: {unsafe}", extra={'task_id': delivery['task_id']})
+            return None
+        try:
+            response = self._session.post(delivery['url'], data=delivery['body'], headers=headers,
+                                          timeout=self.timeout, allow_redirects=False)
+            status = response.status_code
+            reason = f"HTTP {status}"
+            if 200 <= status < 300:
+                self.stats['delivered'] += 1
+                logger.info(f"📬 Webhook {delivery['event']} consegnato a {delivery['url']} (tentativo {delivery['attempt']})",
+                            extra={'task_id': delivery['task_id']})
+                return None
+            retryable = status >= 500 or status in RETRYABLE_STATUS
+            if response.headers.get('Retry-After', '').isdigit():
+                retry_after = int(response.headers['Retry-After'])
+        except requests.RequestException as e:
+            reason = f"{type(e).__name__}: {e}"
+            retryable = True
+
+        if retryable and delivery['attempt'] < self.max_attempts:
+            delay = self.backoff(delivery['attempt'], retry_after)
+            logger.warning(f"⚠️ Webhook verso {delivery['url']} fallito ({reason}) - nuovo tentativo tra {delay:.0f}s",
+                           extra={'task_id': delivery['task_id']})
+            return delay
+        self.stats['failed'] += 1
+        logger.error(f"❌ Webhook verso {delivery['url']} abbandonato dopo {delivery['attempt']} tentativi ({reason})",
+                     extra={'task_id': delivery['task_id']})
+        return None
+
+    def notify_task(self, callback_urls, task_id, status, result=None, error=None, base_url=None):
+        """Invia l'evento di fine task a tutti i callback registrati"""
+        if not callback_urls or status not in WEBHOOK_EVENTS:
+            return
+        payload = build_task_payload(task_id, status, result, error, base_url)
+        for url in dict.fromkeys(callback_urls):
+            self.deliver(url, payload)
+
+    def drain(self, timeout):
+        """Attende (al massimo timeout secondi) che le consegne in corso terminino"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self._condition:
+                if not self._pending and not self._in_flight:
+                    return True
+            time.sleep(0.2)
+        return False
+
+    def snapshot(self):
+        with self._condition:
+            return dict(self.stats, pending=len(self._pending), in_flight=self._in_flight)
@@ -0,0 +1,230 @@
+# worker.py - Worker di estrazione standalone (scalabile su più processi/host)
+#
+# Uso:
+#   python worker.py --queue /shared/jobs.db --temp-dir /shared/temp_clips --concurrency 2
+#
+# L'app web in modalità EXTRACTION_MODE=queue si limita ad accodare i job e a
+# servire lo stato; N worker (anche su host diversi) consumano la stessa coda.
+# Coda e directory temporanea devono stare su uno storage condiviso. Anche i worker
+# leggono EXTRACTION_MODE: in modalità 'thread' (default) l'estrazione avviene nel
+# processo web e il worker (es. processo `worker` del Procfile) esce subito.
+import os
+import sys
+import argparse
+import signal
+import socket
+import threading
+import time
+import uuid
+from dotenv import load_dotenv
+
+# Carica variabili ambiente (prima di importare l'extractor, che legge OPENAI_API_KEY)
+load_dotenv()
+
+from extractor import TimestampClipExtractor
+from job_queue import JobQueue, EXHAUSTED_ERROR
+from task_control import TaskControl, TaskCancelled
+from tracing import Tracer, trace_span
+from structured_log import get_logger, log_context
+from webhooks import WebhookDispatcher
+from lanes import LANE_NICE, LANE_QUEUE_PRIORITY
+
+logger = get_logger('worker')
+
+class ExtractionWorker:
+    """Preleva job dalla coda, mantiene la lease con heartbeat ed esegue l'estrazione"""
+
+    def __init__(self, queue, extractor, worker_id, lease_seconds=60, poll_interval=2, abandon_timeout=0, webhooks=None):
+        self.queue = queue
+        self.extractor = extractor
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.abandon_timeout = abandon_timeout
+        self.webhooks = webhooks
+        self.stop_event = threading.Event()
+        self.active_controls = {}
+        self._lock = threading.Lock()
+
+    def run(self, concurrency=1, interactive_slots=0):
+        """Avvia N slot di esecuzione (i primi riservati ai job interattivi) e attende l'arresto"""
+        interactive_slots = min(interactive_slots, concurrency - 1) if concurrency > 1 else 0
+        logger.info(f"🚀 Worker {self.worker_id} avviato ({concurrency} slot, {interactive_slots} riservati agli interattivi, lease {self.lease_seconds}s)")
+        threads = [
+            threading.Thread(
+                target=self._loop,
+                args=(LANE_QUEUE_PRIORITY['interactive'] if i < interactive_slots else None,),
+                name=f"slot-{i}",
+                daemon=True
+            )
+            for i in range(concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=1)
+        if self.webhooks and not self.webhooks.drain(timeout=10):
+            logger.warning("⚠️ Webhook ancora in coda all'arresto del worker")
+        logger.info(f"👋 Worker {self.worker_id} arrestato")
+
+    def stop(self):
+        """Arresto: smette di prelevare job e rimette in coda quelli in corso"""
+        logger.warning("🛑 Arresto worker: rimetto in coda i job in corso...")
+        self.stop_event.set()
+        with self._lock:
+            controls = list(self.active_controls.values())
+        for control in controls:
+            control.cancel('Worker in arresto', cleanup='partial')
+
+    def _loop(self, min_priority=None):
+        while not self.stop_event.is_set():
+            try:
+                for task_id in self.queue.fail_exhausted():
+                    logger.error(f"❌ Job {task_id} fallito: {EXHAUSTED_ERROR}")
+                    self.notify(task_id, 'failed', error=EXHAUSTED_ERROR)
+                job = self.queue.claim(self.worker_id, self.lease_seconds, min_priority)
+            except Exception as e:
+                logger.error(f"❌ Errore lettura coda: {e}")
+                job = None
+            if not job:
+                self.stop_event.wait(self.poll_interval)
+                continue
+            self.process_job(job)
+
+    def _heartbeat(self, task_id, control, done_event):
+        """Rinnova la lease e propaga annullamenti/abbandono al TaskControl"""
+        interval = max(1, self.lease_seconds / 3)
+        while not done_event.wait(interval):
+            try:
+                job = self.queue.heartbeat(task_id, self.worker_id, self.lease_seconds)
+            except Exception as e:
+                logger.warning(f"⚠️ Heartbeat fallito per {task_id}: {e}")
+                continue
+            if job is None:
+                logger.warning(f"⚠️ Lease persa per {task_id} - interrompo")
+                control.cancel('Lease persa', cleanup='none')
+                return
+            if job['cancel_requested']:
+                control.cancel('Annullato dall\'utente')
+                return
+            # Job con webhook: il client attende la notifica senza interrogare il progresso
+            if job['spec'].get('callback_urls'):
+                continue
+            if self.abandon_timeout and job['last_poll_at'] and time.time() - job['last_poll_at'] > self.abandon_timeout:
+                control.cancel('Task abbandonato (nessun poll)')
+                return
+
+    def process_job(self, job):
+        """Esegue un job prelevato dalla coda"""
+        task_id = job['task_id']
+        spec = job['spec']
+        logger.info(f"📥 Job {task_id} preso in carico (tentativo {job['attempts']}, {len(job['clips'])} clip già completate)")
+
+        priority = spec.get('priority', 'bulk')
+        control = TaskControl(task_id, nice=LANE_NICE.get(priority, 0))
+        done_event = threading.Event()
+        with self._lock:
+            self.active_controls[task_id] = control
+        heartbeat = threading.Thread(target=self._heartbeat, args=(task_id, control, done_event), daemon=True)
+        heartbeat.start()
+
+        def progress_callback(progress, message, eta_seconds=None):
+            if not control.is_cancelled():
+                self.queue.update_progress(task_id, self.worker_id, progress, message, eta_seconds)
+
+        def clip_callback(clip_index, clip):
+            self.queue.mark_clip(task_id, self.worker_id, clip_index, clip)
+
+        try:
+            with log_context(task_id=task_id, priority=priority), Tracer(task_id).activate(), trace_span('task', mode='queue', priority=priority, worker_id=self.worker_id, attempt=job['attempts']):
+                result = self.extractor.extract_clips(
+                    spec['video_url'],
+                    spec['timestamps_input'],
+                    spec['clip_duration'],
+                    task_id,
+                    spec['social_formats'],
+                    spec['subtitles_enabled'],
+                    progress_callback,
+                    control,
+                    job['clips'],
+                    clip_callback,
+                    spec.get('subtitle_mode'),
+                    spec.get('preview_enabled', False)
+                )
+            self.queue.finish(task_id, self.worker_id, 'completed', result=result, message='Completato!')
+            logger.info(f"✅ Job {task_id} completato")
+            self.notify(task_id, 'completed', result=result)
+        except TaskCancelled as e:
+            if control.cleanup == 'partial':
+                self.queue.release(task_id, self.worker_id)
+                logger.warning(f"↩️ Job {task_id} rimesso in coda")
+            elif control.cleanup == 'all':
+                self.queue.finish(task_id, self.worker_id, 'cancelled', message=f'Annullato: {str(e)}')
+                logger.warning(f"🛑 Job {task_id} annullato: {e}")
+                self.notify(task_id, 'cancelled', error=str(e))
+        except Exception as e:
+            self.queue.finish(task_id, self.worker_id, 'failed', error=str(e), message=f'Errore: {str(e)}')
+            logger.error(f"❌ Job {task_id} fallito: {e}")
+            self.notify(task_id, 'failed', error=str(e))
+        finally:
+            done_event.set()
+            with self._lock:
+                self.active_controls.pop(task_id, None)
+
+    def notify(self, task_id, status, result=None, error=None):
+        """Webhook di fine job (spec riletta: callback aggiunti da richieste deduplicate)"""
+        if not self.webhooks:
+            return
+        try:
+            job = self.queue.get(task_id)
+        except Exception as e:
+            logger.error(f"❌ Lettura callback di {task_id} fallita: {e}")
+            return
+        spec = job['spec'] if job else {}
+        self.webhooks.notify_task(spec.get('callback_urls'), task_id, status, result, error, spec.get('public_base_url'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Worker di estrazione clip MAAT')
+    parser.add_argument('--queue', default=os.getenv('JOB_QUEUE_PATH', os.path.join(os.getenv('TEMP_DIR', 'temp_clips'), 'jobs.db')),
+                        help='Percorso del database SQLite della coda (condiviso)')
+    parser.add_argument('--temp-dir', default=os.getenv('TEMP_DIR', 'temp_clips'),
+                        help='Directory output clip (condivisa con l\'app web)')
+    parser.add_argument('--concurrency', type=int, default=int(os.getenv('WORKER_CONCURRENCY', '1')),
+                        help='Job eseguiti in parallelo da questo processo')
+    parser.add_argument('--interactive-slots', type=int, default=int(os.getenv('INTERACTIVE_RESERVED_SLOTS', '1')),
+                        help='Slot riservati ai job interattivi (i job bulk usano solo gli altri)')
+    parser.add_argument('--lease', type=int, default=int(os.getenv('WORKER_LEASE_SECONDS', '60')),
+                        help='Durata lease in secondi (rinnovata ogni lease/3)')
+    parser.add_argument('--poll-interval', type=float, default=2.0,
+                        help='Attesa tra letture della coda vuota')
+    parser.add_argument('--worker-id', default=f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}")
+    args = parser.parse_args()
+
+    # Stessa variabile dell'app web: senza coda non c'è nulla da consumare
+    if os.getenv('EXTRACTION_MODE', 'thread') != 'queue':
+        logger.warning("⏹️ EXTRACTION_MODE non è 'queue': l'estrazione gira nel processo web, worker non necessario - esco")
+        sys.exit(0)
+
+    os.makedirs(args.temp_dir, exist_ok=True)
+    queue = JobQueue(args.queue)
+    extractor = TimestampClipExtractor(args.temp_dir)
+    # Setup degli strumenti in background: il primo job attende solo se arriva prima
+    extractor.warm_up()
+    worker = ExtractionWorker(
+        queue,
+        extractor,
+        args.worker_id,
+        lease_seconds=args.lease,
+        poll_interval=args.poll_interval,
+        abandon_timeout=int(os.getenv('TASK_ABANDON_TIMEOUT', '900')),
+        webhooks=WebhookDispatcher()
+    )
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: worker.stop())
+
+    worker.run(args.concurrency, args.interactive_slots)
+
+if __name__ == '__main__':
+    main()
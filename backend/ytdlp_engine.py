@@ -0,0 +1,262 @@
+# ytdlp_engine.py - Download in-process con la libreria yt-dlp (niente CLI per clip)
+import os
+import copy
+import glob
+import importlib.util
+import signal
+import subprocess
+import threading
+import time
+from task_control import ProcessStalled, set_process_nice
+
+# Import differito: caricare gli estrattori yt-dlp costa secondi, si fa al primo uso
+yt_dlp = None
+_import_lock = threading.Lock()
+
+def load_yt_dlp():
+    """Importa yt_dlp una sola volta (None se non installato come libreria)"""
+    global yt_dlp
+    with _import_lock:
+        if yt_dlp is None and importlib.util.find_spec('yt_dlp') is not None:
+            import yt_dlp as module
+            yt_dlp = module
+    return yt_dlp
+
+def find_child_processes(marker):
+    """PID dei processi figli di questo processo con `marker` nella command line (Linux /proc)"""
+    pids = []
+    for children_file in glob.glob(f'/proc/{os.getpid()}/task/*/children'):
+        try:
+            with open(children_file) as f:
+                pids.extend(int(pid) for pid in f.read().split())
+        except OSError:
+            continue
+    matching = []
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                cmdline = f.read().replace(b'\0', b' ').decode(errors='replace')
+        except OSError:
+            continue
+        if marker in cmdline:
+            matching.append(pid)
+    return matching
+
+def kill_child_processes(marker):
+    """Termina i figli (es. ffmpeg avviato da yt-dlp) che scrivono su `marker`"""
+    for pid in find_child_processes(marker):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+class _CollectingLogger:
+    """Logger per YoutubeDL: silenzioso, conserva warning ed errori per il report"""
+
+    def __init__(self):
+        self.messages = []
+
+    def debug(self, msg):
+        pass
+
+    def info(self, msg):
+        pass
+
+    def warning(self, msg):
+        self.messages.append(msg)
+
+    def error(self, msg):
+        self.messages.append(msg)
+
+class YtDlpEngine:
+    """Motore di download yt-dlp in-process: estrattori caricati una volta per processo,
+    info della sorgente in cache per URL, progress hook strutturati"""
+
+    def __init__(self, format_selector='best[height<=720]', info_ttl=600):
+        self.format_selector = format_selector
+        self.info_ttl = info_ttl
+        self._info_cache = {}  # video_url -> (timestamp, info)
+        self._resolving = {}  # video_url -> lock della risoluzione in corso (single-flight)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_available():
+        # Non importa il modulo: basta sapere che è installato
+        return importlib.util.find_spec('yt_dlp') is not None
+
+    @staticmethod
+    def version():
+        module = load_yt_dlp()
+        return module.version.__version__ if module else None
+
+    def _base_params(self, logger):
+        return {
+            'format': self.format_selector,
+            'nocheckcertificate': True,
+            'quiet': True,
+            'noprogress': True,
+            'logger': logger
+        }
+
+    def _cached_info(self, video_url):
+        with self._lock:
+            cached = self._info_cache.get(video_url)
+            if cached and time.time() - cached[0] < self.info_ttl:
+                return cached[1]
+            return None
+
+    def resolve(self, video_url):
+        """Info della sorgente (formati, URL stream) in cache per info_ttl secondi.
+
+        Single-flight per URL: i task che partono insieme sullo stesso video (es.
+        spezzoni di un batch) attendono la prima risoluzione invece di ripeterla."""
+        info = self._cached_info(video_url)
+        if info is not None:
+            return info
+
+        with self._lock:
+            url_lock = self._resolving.setdefault(video_url, threading.Lock())
+        with url_lock:
+            info = self._cached_info(video_url)
+            if info is not None:
+                return info
+            try:
+                with load_yt_dlp().YoutubeDL(self._base_params(_CollectingLogger())) as ydl:
+                    info = ydl.sanitize_info(ydl.extract_info(video_url, download=False))
+                with self._lock:
+                    self._info_cache[video_url] = (time.time(), info)
+            finally:
+                with self._lock:
+                    self._resolving.pop(video_url, None)
+        return info
+
+    def stream_source(self, video_url):
+        """URL diretto e header HTTP del formato selezionato, per leggerlo con ffmpeg.
+
+        None se il formato richiede il merge di più stream (video + audio separati)."""
+        info = self.resolve(video_url)
+        if info.get('requested_formats') or not info.get('url'):
+            return None
+        return {
+            'url': info['url'],
+            'headers': info.get('http_headers') or {}
+        }
+
+    def download_segment(self, video_url, output_file, start_time, duration, control=None, progress_hook=None, timeout=None, stall_timeout=None, output_args=None, input_seek=False):
+        """Scarica [start_time, start_time+duration] in output_file.
+
+        Stessa semantica di `yt-dlp --external-downloader ffmpeg
+        --external-downloader-args "ffmpeg:-ss S -t D"`; con input_seek il -ss
+        diventa opzione di input (start_time allineato a un keyframe). Ritorna un
+        CompletedProcess per uniformità con il percorso CLI."""
+        logger = _CollectingLogger()
+        last_fraction = [-1.0]
+
+        def hook(d):
+            if control and control.is_cancelled():
+                return
+            if not progress_hook:
+                return
+            downloaded = d.get('downloaded_bytes') or 0
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            if d.get('status') == 'finished':
+                fraction = 1.0
+            elif total:
+                fraction = min(downloaded / total, 1.0)
+            else:
+                return
+            # Limita gli aggiornamenti a passi dell'1%
+            if fraction - last_fraction[0] >= 0.01 or fraction == 1.0:
+                last_fraction[0] = fraction
+                progress_hook('download', fraction, f"{downloaded/1024/1024:.1f}/{(total or downloaded)/1024/1024:.1f} MB")
+
+        params = self._base_params(logger)
+        params.update({
+            'outtmpl': {'default': output_file},
+            'external_downloader': {'default': 'ffmpeg'},
+            'external_downloader_args': {
+                'ffmpeg_i': ['-ss', str(start_time)],
+                'ffmpeg_o': ['-t', str(duration)] + (output_args or [])
+            } if input_seek else {
+                'ffmpeg': ['-ss', str(start_time), '-t', str(duration)] + (output_args or [])
+            },
+            'progress_hooks': [hook]
+        })
+
+        # Cancellazione/timeout: termina il ffmpeg figlio che scrive su output_file
+        cancel_callback = lambda: kill_child_processes(output_file)
+        if control:
+            control.add_cancel_callback(cancel_callback)
+        timed_out = threading.Event()
+
+        def on_timeout():
+            timed_out.set()
+            kill_child_processes(output_file)
+
+        timer = threading.Timer(timeout, on_timeout) if timeout else None
+        if timer:
+            timer.daemon = True
+            timer.start()
+
+        # Stallo: il file .part di ffmpeg non cresce per stall_timeout secondi
+        stalled = threading.Event()
+        finished = threading.Event()
+
+        def watch_stall():
+            last_size, last_growth = -1, time.time()
+            while not finished.wait(1):
+                size = 0
+                for path in (output_file + '.part', output_file):
+                    try:
+                        size += os.path.getsize(path)
+                    except OSError:
+                        pass
+                if size > last_size:
+                    last_size, last_growth = size, time.time()
+                elif time.time() - last_growth > stall_timeout:
+                    stalled.set()
+                    kill_child_processes(output_file)
+                    return
+
+        if stall_timeout:
+            threading.Thread(target=watch_stall, daemon=True).start()
+
+        # Il ffmpeg avviato da yt-dlp non passa da TaskControl.register: niceness della corsia qui
+        def watch_nice():
+            reniced = set()
+            while not finished.wait(0.2):
+                for pid in find_child_processes(output_file):
+                    if pid not in reniced:
+                        set_process_nice(pid, control.nice)
+                        reniced.add(pid)
+
+        if control and control.nice:
+            threading.Thread(target=watch_nice, daemon=True).start()
+
+        returncode = 0
+        yt_dlp = load_yt_dlp()
+        try:
+            if control:
+                control.check()
+            info = copy.deepcopy(self.resolve(video_url))
+            with yt_dlp.YoutubeDL(params) as ydl:
+                ydl.process_ie_result(info, download=True)
+        except yt_dlp.utils.YoutubeDLError as e:
+            returncode = 1
+            if not logger.messages:
+                logger.messages.append(str(e))
+        finally:
+            finished.set()
+            if timer:
+                timer.cancel()
+            if control:
+                control.remove_cancel_callback(cancel_callback)
+
+        if control:
+            control.check()
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(['yt_dlp', video_url], timeout)
+        if stalled.is_set():
+            raise ProcessStalled(['yt_dlp', video_url], stall_timeout)
+
+        return subprocess.CompletedProcess(['yt_dlp', video_url], returncode, '', '\n'.join(logger.messages))
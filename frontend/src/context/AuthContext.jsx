@@ -33,6 +33,62 @@ export const AuthProvider = ({ children }) => {
     }
   };
 
+  // Salva la sessione dopo login/registrazione (access token breve + refresh token)
+  const saveSession = (data) => {
+    localStorage.setItem('auth_token', data.access_token);
+    localStorage.setItem('auth_user', JSON.stringify(data.user));
+    if (data.refresh_token) {
+      localStorage.setItem('auth_refresh_token', data.refresh_token);
+    }
+    setToken(data.access_token);
+    setUser(data.user);
+    setupAxiosInterceptors(data.access_token);
+  };
+
+  const clearSession = () => {
+    localStorage.removeItem('auth_token');
+    localStorage.removeItem('auth_user');
+    localStorage.removeItem('auth_refresh_token');
+    setToken(null);
+    setUser(null);
+    setupAxiosInterceptors(null);
+  };
+
+  // Access token scaduto (401): un solo rinnovo con il refresh token e nuovo tentativo
+  useEffect(() => {
+    let refreshing = null;
+    const interceptor = axios.interceptors.response.use(
+      (response) => response,
+      async (error) => {
+        const original = error.config;
+        const refreshToken = localStorage.getItem('auth_refresh_token');
+        if (error.response?.status !== 401 || !refreshToken || !original || original._retried
+            || original.url?.includes('/api/auth/refresh')) {
+          return Promise.reject(error);
+        }
+        original._retried = true;
+        try {
+          refreshing = refreshing || axios.post(`${API_BASE}/api/auth/refresh`, null, {
+            headers: { Authorization: `Bearer ${refreshToken}` }
+          });
+          const response = await refreshing;
+          const newToken = response.data.access_token;
+          localStorage.setItem('auth_token', newToken);
+          setToken(newToken);
+          setupAxiosInterceptors(newToken);
+          original.headers = { ...original.headers, Authorization: `Bearer ${newToken}` };
+          return axios(original);
+        } catch (refreshError) {
+          clearSession();
+          return Promise.reject(error);
+        } finally {
+          refreshing = null;
+        }
+      }
+    );
+    return () => axios.interceptors.response.eject(interceptor);
+  }, []);
+
   // Verifica token al caricamento dell'app
   useEffect(() => {
     const initAuth = async () => {
@@ -47,18 +103,17 @@ export const AuthProvider = ({ children }) => {
           const response = await axios.get(`${API_BASE}/api/auth/verify-token`);
           
           if (response.data.success) {
-            setToken(savedToken);
+            // L'interceptor può aver rinnovato il token durante la verifica
+            setToken(localStorage.getItem('auth_token'));
             setUser(JSON.parse(savedUser));
           } else {
             // Token non valido, rimuovi tutto
-            localStorage.removeItem('auth_token');
-            localStorage.removeItem('auth_user');
+            clearSession();
           }
         }
       } catch (error) {
         console.error('Errore verifica token:', error);
-        localStorage.removeItem('auth_token');
-        localStorage.removeItem('auth_user');
+        clearSession();
       } finally {
         setLoading(false);
       }
@@ -76,16 +131,10 @@ export const AuthProvider = ({ children }) => {
       });
 
       if (response.data.success) {
-        const { user, access_token } = response.data;
+        const { user } = response.data;
         
-        // Salva in localStorage
-        localStorage.setItem('auth_token', access_token);
-        localStorage.setItem('auth_user', JSON.stringify(user));
-        
-        // Aggiorna stato
-        setToken(access_token);
-        setUser(user);
-        setupAxiosInterceptors(access_token);
+        // Salva in localStorage e aggiorna stato
+        saveSession(response.data);
 
         return { success: true, user };
       } else {
@@ -110,16 +159,10 @@ export const AuthProvider = ({ children }) => {
       });
 
       if (response.data.success) {
-        const { user, access_token } = response.data;
-        
-        // Salva in localStorage
-        localStorage.setItem('auth_token', access_token);
-        localStorage.setItem('auth_user', JSON.stringify(user));
+        const { user } = response.data;
         
-        // Aggiorna stato
-        setToken(access_token);
-        setUser(user);
-        setupAxiosInterceptors(access_token);
+        // Salva in localStorage e aggiorna stato
+        saveSession(response.data);
 
         return { success: true, user };
       } else {
@@ -144,11 +187,7 @@ export const AuthProvider = ({ children }) => {
       console.error('Errore logout:', error);
     } finally {
       // Rimuovi tutto comunque
-      localStorage.removeItem('auth_token');
-      localStorage.removeItem('auth_user');
-      setToken(null);
-      setUser(null);
-      setupAxiosInterceptors(null);
+      clearSession();
     }
   };
 
@@ -160,14 +199,9 @@ export const AuthProvider = ({ children }) => {
       });
 
       if (response.data.success) {
-        const { user, access_token } = response.data;
-        
-        localStorage.setItem('auth_token', access_token);
-        localStorage.setItem('auth_user', JSON.stringify(user));
+        const { user } = response.data;
         
-        setToken(access_token);
-        setUser(user);
-        setupAxiosInterceptors(access_token);
+        saveSession(response.data);
 
         return { success: true, user };
       } else {